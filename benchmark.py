@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Benchmark of insightly_slack_notify sync against local fake insightly api
+and slack webhook servers. Requires python 3 and unix (peak RSS is read with
+resource module).
+
+Each account size is run in a separate process. The account of synthetic
+opportunities, notes, users, categories, pipelines and stages is synced
+twice: initial sync stores all opportunities locally, then churn part of
+opportunities is changed, created and deleted and new notes are added, and
+incremental sync sends slack messages about them. Results are printed as
+JSON:
+
+    $ ./benchmark.py --sizes 1000 10000 100000 --churn 0.01 -o results.json
+
+Fake servers run in the same process as the script, so wall time includes
+their work too.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import random
+import re
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os.path import abspath, exists, getsize, join
+from shutil import rmtree
+from socketserver import ThreadingMixIn
+from tempfile import mkdtemp
+from types import ModuleType
+from urllib.parse import parse_qsl, urlparse
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Number of reference items of the synthetic account.
+USERS = 50
+CATEGORIES = 10
+PIPELINES = 5
+STAGES_PER_PIPELINE = 5
+
+
+class Account(object):
+    """
+    Synthetic insightly account.
+    """
+
+    def __init__(self, size, seed=0):
+        self.random = random.Random(seed)
+        self.users = [{'USER_ID': i, 'FIRST_NAME': 'First%d' % i,
+                       'LAST_NAME': 'Last%d' % i,
+                       'EMAIL_ADDRESS': 'user%d@example.com' % i}
+                      for i in range(1, USERS + 1)]
+        self.categories = [{'CATEGORY_ID': i, 'CATEGORY_NAME': 'Cat%d' % i}
+                           for i in range(1, CATEGORIES + 1)]
+        self.pipelines = [{'PIPELINE_ID': i, 'PIPELINE_NAME': 'Pipe%d' % i}
+                          for i in range(1, PIPELINES + 1)]
+        self.stages = [{'STAGE_ID': (pipeline - 1) * STAGES_PER_PIPELINE + i,
+                        'PIPELINE_ID': pipeline,
+                        'STAGE_NAME': 'Stage%d.%d' % (pipeline, i)}
+                       for pipeline in range(1, PIPELINES + 1)
+                       for i in range(1, STAGES_PER_PIPELINE + 1)]
+
+        self.next_id = 1
+        self.next_note_id = 1
+        # Mapping of id to opportunity, in order of creation.
+        self.opportunities = {}
+        self.notes = []
+
+        past = datetime.utcnow() - timedelta(days=365)
+        for _ in range(size):
+            created = past + timedelta(
+                seconds=self.random.randint(0, 300 * 86400))
+            self.create_opportunity(created)
+        for _ in range(size // 10):
+            self.create_note(self.random.choice(list(self.opportunities)),
+                             past + timedelta(days=300))
+
+    def create_opportunity(self, created):
+        pipeline = self.random.choice(self.pipelines)['PIPELINE_ID']
+        opp_id = self.next_id
+        self.next_id += 1
+        self.opportunities[opp_id] = {
+            'OPPORTUNITY_ID': opp_id,
+            'OPPORTUNITY_NAME': 'Opportunity %d' % opp_id,
+            'OPPORTUNITY_DETAILS': 'Details of opportunity %d' % opp_id,
+            'PROBABILITY': self.random.randint(0, 100),
+            'BID_CURRENCY': 'USD',
+            'BID_AMOUNT': self.random.randint(100, 100000),
+            'BID_TYPE': 'Fixed Bid',
+            'BID_DURATION': None,
+            'FORECAST_CLOSE_DATE': (created + timedelta(days=30))
+            .strftime(DATE_FORMAT),
+            'ACTUAL_CLOSE_DATE': None,
+            'CATEGORY_ID': self.random.randint(1, CATEGORIES),
+            'PIPELINE_ID': pipeline,
+            'STAGE_ID': ((pipeline - 1) * STAGES_PER_PIPELINE +
+                         self.random.randint(1, STAGES_PER_PIPELINE)),
+            'OPPORTUNITY_STATE': 'OPEN',
+            'IMAGE_URL': None,
+            'RESPONSIBLE_USER_ID': self.random.randint(1, USERS),
+            'OWNER_USER_ID': self.random.randint(1, USERS),
+            'DATE_CREATED_UTC': created.strftime(DATE_FORMAT),
+            'DATE_UPDATED_UTC': created.strftime(DATE_FORMAT),
+            'VISIBLE_TO': 'EVERYONE',
+            'VISIBLE_TEAM_ID': None,
+            'VISIBLE_USER_IDS': None,
+            'CUSTOMFIELDS': [],
+            'TAGS': [],
+            'LINKS': [],
+            'EMAILLINKS': [],
+        }
+        return opp_id
+
+    def create_note(self, opp_id, created):
+        note_id = self.next_note_id
+        self.next_note_id += 1
+        self.notes.append({
+            'NOTE_ID': note_id,
+            'TITLE': 'Note %d' % note_id,
+            'BODY': '<p>Body of note %d</p>' % note_id,
+            'DATE_CREATED_UTC': created.strftime(DATE_FORMAT),
+            'DATE_UPDATED_UTC': created.strftime(DATE_FORMAT),
+            'NOTELINKS': [{'NOTE_ID': note_id, 'OPPORTUNITY_ID': opp_id}],
+        })
+
+    def churn(self, part):
+        """
+        Change, create and delete part of opportunities, add new notes.
+        Return dict of numbers of changed, created, deleted opportunities
+        and new notes.
+        """
+        # Later than any watermark of the previous sync.
+        now = datetime.utcnow() + timedelta(seconds=1)
+        count = max(1, int(len(self.opportunities) * part))
+        ids = self.random.sample(list(self.opportunities), count * 3)
+
+        for opp_id in ids[:count]:
+            opp = self.opportunities[opp_id]
+            if self.random.random() < 0.5:
+                opp['STAGE_ID'] = ((opp['PIPELINE_ID'] - 1) *
+                                   STAGES_PER_PIPELINE +
+                                   opp['STAGE_ID'] % STAGES_PER_PIPELINE + 1)
+            else:
+                opp['BID_AMOUNT'] += 1
+            opp['DATE_UPDATED_UTC'] = now.strftime(DATE_FORMAT)
+
+        for opp_id in ids[count:count * 2]:
+            del self.opportunities[opp_id]
+
+        for _ in range(count):
+            self.create_opportunity(now)
+
+        for opp_id in ids[count * 2:]:
+            self.create_note(opp_id, now)
+
+        return {'changed': count, 'created': count, 'deleted': count,
+                'notes': count}
+
+
+def parse_filter(value):
+    """
+    Return (field, datetime) of "FIELD gt DateTime'...'" filter.
+    """
+    match = re.match(r"(\w+) gt DateTime'([^']+)'", value)
+    return (match.group(1),
+            datetime.strptime(match.group(2), '%Y-%m-%dT%H:%M:%S'))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeServer(object):
+    """
+    Local http server answering insightly v2.1 api requests for the account
+    and slack webhook requests. Counts requests by endpoint.
+    """
+
+    def __init__(self, account):
+        self.account = account
+        self.calls = defaultdict(int)
+        self.slack_posts = 0
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, delayed ack would
+            # add latency to every keep-alive request.
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                path = url.path[len('/v2.1'):]
+                with fake.lock:
+                    fake.calls[re.sub(r'/\d+$', '/{id}', path)] += 1
+                data = fake.get(path, dict(parse_qsl(url.query)))
+                if data is None:
+                    self.reply(404, b'{}')
+                else:
+                    self.reply(200, json.dumps(data).encode('utf-8'))
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                with fake.lock:
+                    fake.slack_posts += 1
+                self.reply(200, b'ok')
+
+            def reply(self, status, body):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self, path, query):
+        """
+        Return response data for the api path, None if it is not found.
+        """
+        account = self.account
+        collections = {
+            '/Users': (account.users, 'USER_ID'),
+            '/users': (account.users, 'USER_ID'),
+            '/OpportunityCategories': (account.categories, 'CATEGORY_ID'),
+            '/Pipelines': (account.pipelines, 'PIPELINE_ID'),
+            '/PipelineStages': (account.stages, 'STAGE_ID'),
+        }
+
+        match = re.match(r'(/\w+)/(\d+)$', path)
+        if match and match.group(1) in collections:
+            items, id_field = collections[match.group(1)]
+            for item in items:
+                if item[id_field] == int(match.group(2)):
+                    return item
+            return None
+
+        if path in collections:
+            return collections[path][0]
+
+        if path == '/notes':
+            items = account.notes
+        elif path == '/opportunities':
+            if 'ids' in query:
+                ids = [int(x) for x in query['ids'].split(',')]
+                return [account.opportunities[x] for x in ids
+                        if x in account.opportunities]
+            items = list(account.opportunities.values())
+        else:
+            return None
+
+        if '$filter' in query:
+            field, since = parse_filter(query['$filter'])
+            items = [item for item in items
+                     if datetime.strptime(item[field], DATE_FORMAT) > since]
+        if '$select' in query:
+            fields = query['$select'].split(',')
+            items = [dict((field, item[field]) for field in fields)
+                     for item in items]
+
+        skip = int(query.get('$skip', 0))
+        top = int(query.get('$top', len(items)))
+        return items[skip:skip + top]
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.slack_posts = 0
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def peak_rss():
+    """
+    Return peak resident set size of the process in KiB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB on linux.
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def run_cycle(notify, server, state_file):
+    """
+    Run single sync, return its measurements.
+    """
+    server.reset()
+    started = time.time()
+    notify.run_once()
+    wall_time = time.time() - started
+
+    state_size = sum(getsize(path) for path
+                     in (state_file, state_file + '-wal') if exists(path))
+    return {
+        'wall_time': round(wall_time, 3),
+        'api_calls': sum(server.calls.values()),
+        'api_calls_by_endpoint': dict(server.calls),
+        'slack_posts': server.slack_posts,
+        'peak_rss_kib': peak_rss(),
+        'state_size_bytes': state_size,
+    }
+
+
+def run_single(size, churn, seed, batch_size):
+    """
+    Benchmark sync of the account of given size. Return result dict.
+    """
+    tmpdir = mkdtemp()
+    # Config of the benchmark, user config file is not needed.
+    sys.modules['insightly_slack_notify_config'] = ModuleType(
+        'insightly_slack_notify_config')
+    import insightly_slack_notify as notify
+
+    account = Account(size, seed)
+    server = FakeServer(account)
+    try:
+        notify.INSIGHTLY_URL = server.url + '/v2.1'
+        state_file = join(tmpdir, 'db.sqlite3')
+        for name, value in (('INSIGHTLY_API_KEY',
+                             '00000000-0000-0000-0000-000000000000'),
+                            ('STATE_STORE', 'sqlite'),
+                            ('STATE_FILE', state_file),
+                            ('SLACK_CHANNEL_URL', server.url + '/slack'),
+                            ('SLACK_BATCH_SIZE', batch_size),
+                            ('SLACK_RATE_LIMIT', 0),
+                            ('INSIGHTLY_DAILY_LIMIT', 0),
+                            ('METRICS_FILE', None)):
+            setattr(notify.config, name, value)
+
+        initial = run_cycle(notify, server, state_file)
+        changes = account.churn(churn)
+        incremental = run_cycle(notify, server, state_file)
+    finally:
+        server.stop()
+        rmtree(tmpdir)
+
+    return {
+        'opportunities': size,
+        'churn': churn,
+        'changes': changes,
+        'initial': initial,
+        'incremental': incremental,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark insightly_slack_notify sync with local fake '
+                    'insightly and slack servers.')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help='numbers of opportunities of the accounts')
+    parser.add_argument('--churn', type=float, default=0.01,
+                        help='part of opportunities changed, created and '
+                             'deleted between syncs')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the synthetic accounts')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='SLACK_BATCH_SIZE used by the script')
+    parser.add_argument('-o', '--output',
+                        help='file to write JSON results to, stdout by '
+                             'default')
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        # Child process measuring single account.
+        print(json.dumps(run_single(args.single, args.churn, args.seed,
+                                    args.batch_size)))
+        return
+
+    results = []
+    for size in args.sizes:
+        output = subprocess.check_output([
+            sys.executable, abspath(__file__), '--single', str(size),
+            '--churn', str(args.churn), '--seed', str(args.seed),
+            '--batch-size', str(args.batch_size)])
+        results.append(json.loads(output.decode('utf-8')))
+
+    report = json.dumps({
+        'python': sys.version.split()[0],
+        'created_at': datetime.utcnow().strftime(DATE_FORMAT),
+        'results': results,
+    }, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,28 +2,69 @@
 # -*- coding: UTF-8 -*-
 from __future__ import print_function
 
+import argparse
+import hashlib
 import json
 import logging
-import logging.config
 import os
+import random
 import re
-import shelve
-
-from datetime import datetime
-from collections import defaultdict
-from copy import copy
-from os.path import abspath, dirname, exists, join
+import signal
+import sqlite3
+import sys
+import threading
+import time
+
+from datetime import datetime, timedelta
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from itertools import chain, groupby
+from os.path import abspath, dirname, exists, join, splitext
 from shutil import copyfile
 from textwrap import dedent
 
-import requests
+try:
+    from urllib.parse import urlparse
+except ImportError:  # python 2
+    from urlparse import urlparse
+
+CONFIG_FILE = 'insightly_slack_notify_config.py'
+
+
+class LazyConfig(object):
+    """
+    Proxy of the insightly_slack_notify_config module, which is imported on
+    first attribute access, so import of this module has no side effects.
+    Attributes are set on the config module.
+    """
+
+    def module(self):
+        if '_module' not in self.__dict__:
+            try:
+                import insightly_slack_notify_config as module
+            except ImportError:
+                if exists(CONFIG_FILE):
+                    raise
+                err = Exception('Config file {} is not found, please create '
+                                'it with "./insightly_slack_notify.py init"'
+                                .format(CONFIG_FILE))
+                logging.critical(err)
+                raise err
+            self.__dict__['_module'] = module
+        return self.__dict__['_module']
 
-if not exists('insightly_slack_notify_config.py'):
-    print('*** Creating default config file insightly_slack_notify_config.py')
-    copyfile('insightly_slack_notify_config.py.example',
-             'insightly_slack_notify_config.py')
+    def __getattr__(self, name):
+        return getattr(self.module(), name)
 
-import insightly_slack_notify_config as config # noqa
+    def __setattr__(self, name, value):
+        setattr(self.module(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self.module(), name)
+
+
+config = LazyConfig()
 
 INSIGHTLY_URL = 'https://api.insight.ly/v2.1'
 
@@ -45,44 +86,1846 @@ DELETED_MESSAGE = """\
 Opportunity deleted: {OPPORTUNITY_NAME}
 Description: {OPPORTUNITY_DETAILS}"""
 
+# Opportunity fields kept in local copies: the ones compared by
+# render_changed_message() and used in DELETED_MESSAGE.
+SNAPSHOT_FIELDS = (
+    'OPPORTUNITY_ID', 'OPPORTUNITY_NAME', 'OPPORTUNITY_DETAILS',
+    'DATE_UPDATED_UTC', 'PROBABILITY', 'BID_AMOUNT', 'BID_CURRENCY',
+    'OPPORTUNITY_STATE', 'PIPELINE_ID', 'STAGE_ID', 'CATEGORY_ID',
+    'RESPONSIBLE_USER_ID', 'FORECAST_CLOSE_DATE', 'ACTUAL_CLOSE_DATE',
+    'CUSTOMFIELDS', 'TAGS', 'LINKS', 'EMAILLINKS',
+)
+
+# List fields of the opportunity compared as sets of items: field and key
+# field of its items. Order of the items is ignored.
+COLLECTION_KEYS = {
+    'CUSTOMFIELDS': 'CUSTOM_FIELD_ID',
+    'TAGS': 'TAG_NAME',
+    'LINKS': 'LINK_ID',
+    'EMAILLINKS': 'EMAIL_LINK_ID',
+}
+
+# Listing of all opportunities used to find new, changed and deleted ones.
+# Pages are ordered by id, so they don't overlap or leave gaps.
+SYNC_LISTING_PATH = ('/opportunities?$select=OPPORTUNITY_ID,DATE_CREATED_UTC,'
+                     'DATE_UPDATED_UTC&$orderby=OPPORTUNITY_ID')
+
+# Slack limits: characters of the message text, number of blocks in the
+# message and characters of the section block text.
+SLACK_TEXT_LIMIT = 40000
+SLACK_BLOCKS_LIMIT = 50
+SLACK_SECTION_TEXT_LIMIT = 3000
+
+# Opportunity fields matched by slack routes, see Account.channels().
+ROUTE_FIELDS = ('PIPELINE_ID', 'CATEGORY_ID', 'RESPONSIBLE_USER_ID')
+
+# Seconds sent messages are kept in the outbox.
+OUTBOX_RETENTION = 7 * 86400
+
+# Seconds the outbox worker waits for the state store locked by a sync.
+OUTBOX_LOCK_TIMEOUT = 60
+
+# Reference collections which can be fetched once per run: collection path,
+# id field of the collection item and path of the single item.
+REFERENCE_COLLECTIONS = (
+    ('/Users', 'USER_ID', '/users/{}'),
+    ('/OpportunityCategories', 'CATEGORY_ID', '/OpportunityCategories/{}'),
+    ('/Pipelines', 'PIPELINE_ID', '/Pipelines/{}'),
+    ('/PipelineStages', 'STAGE_ID', '/PipelineStages/{}'),
+)
+
+
+class Metrics(object):
+    """
+    Counters and histograms with labels, rendered in Prometheus text
+    format. Can be updated by several threads.
+    """
 
-def insightly_get(path, auth):
+    PREFIX = 'insightly_slack_'
+
+    # Upper bounds of histogram buckets in seconds.
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        # Mapping of (name, labels) to value, labels is tuple of pairs.
+        self.counters = defaultdict(float)
+        # Mapping of (name, labels) to [bucket counts, sum, count].
+        self.histograms = {}
+        # Objects with enter(phase) and exit(phase, seconds) methods called
+        # around each phase, e.g. Profiler.
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.counters[key] += value
+
+    def observe(self, name, value, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            histogram = self.histograms[key]
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        """
+        Return copy of counters and histograms, e.g. to merge them into
+        metrics of the parent process.
+        """
+        with self.lock:
+            return (dict(self.counters),
+                    dict((key, [list(buckets), total, count])
+                         for key, (buckets, total, count)
+                         in self.histograms.items()))
+
+    def merge(self, snapshot):
+        """
+        Add counters and histograms returned by snapshot().
+        """
+        counters, histograms = snapshot
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] += value
+            for key, (buckets, total, count) in histograms.items():
+                histogram = self.histograms.setdefault(
+                    key, [[0] * len(self.BUCKETS), 0.0, 0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                histogram[1] += total
+                histogram[2] += count
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Observe time spent in the block as phase_duration_seconds.
+        """
+        for listener in self.listeners:
+            listener.enter(name)
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            self.observe('phase_duration_seconds', elapsed, {'phase': name})
+            for listener in reversed(self.listeners):
+                listener.exit(name, elapsed)
+
+    def timed(self, name):
+        """
+        Decorator observing time spent in the function as phase.
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def request(self, method, url, started, response=None):
+        """
+        Record http request latency, status code and received bytes.
+        """
+        labels = {'method': method, 'endpoint': metrics_endpoint(url)}
+        self.observe('http_request_duration_seconds', time.time() - started,
+                     labels)
+        status = 'error' if response is None else str(response.status_code)
+        self.inc('http_responses_total', dict(labels, status=status))
+        if response is not None:
+            self.inc('http_received_bytes_total', labels,
+                     len(response.content or b''))
+
+    def render(self):
+        """
+        Return metrics in Prometheus text format.
+        """
+        def labels_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(
+                '{}="{}"'.format(key, str(value).replace('\\', '\\\\')
+                                 .replace('"', '\\"').replace('\n', '\\n'))
+                for key, value in pairs) + '}'
+
+        lines = []
+        with self.lock:
+            for name in sorted(set(key[0] for key in self.counters)):
+                lines.append('# TYPE {}{} counter'.format(self.PREFIX, name))
+                for (key, labels), value in sorted(self.counters.items()):
+                    if key == name:
+                        lines.append('{}{}{} {}'.format(
+                            self.PREFIX, name, labels_text(labels), value))
+
+            for name in sorted(set(key[0] for key in self.histograms)):
+                lines.append('# TYPE {}{} histogram'
+                             .format(self.PREFIX, name))
+                for (key, labels), (buckets, total, count) in sorted(
+                        self.histograms.items()):
+                    if key != name:
+                        continue
+                    for bound, bucket in zip(self.BUCKETS, buckets):
+                        lines.append('{}{}_bucket{} {}'.format(
+                            self.PREFIX, name,
+                            labels_text(labels, [('le', bound)]), bucket))
+                    lines.append('{}{}_bucket{} {}'.format(
+                        self.PREFIX, name,
+                        labels_text(labels, [('le', '+Inf')]), count))
+                    lines.append('{}{}_sum{} {}'.format(
+                        self.PREFIX, name, labels_text(labels), total))
+                    lines.append('{}{}_count{} {}'.format(
+                        self.PREFIX, name, labels_text(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Write metrics to Prometheus textfile. File is replaced atomically,
+        so the collector never reads it half-written.
+        """
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write(self.render())
+        os.rename(tmp_path, path)
+
+
+# Metrics of the process.
+metrics = Metrics()
+
+
+def metrics_endpoint(url):
+    """
+    Return endpoint label of the url: 'webhook' for slack, insightly
+    endpoint template with names of query parameters otherwise, e.g.
+    '/opportunities?$filter,$skip,$top'.
+    """
+    if urlparse(url).netloc != urlparse(INSIGHTLY_URL).netloc:
+        return 'webhook'
+    query = urlparse(url).query
+    names = sorted(set(param.split('=')[0] for param in query.split('&')
+                       if param))
+    endpoint = endpoint_template(url)
+    if names:
+        endpoint += '?' + ','.join(names)
+    return endpoint
+
+
+def export_metrics():
+    """
+    Write metrics to METRICS_FILE if it is set in config.
+    """
+    path = getattr(config, 'METRICS_FILE', None)
+    if path:
+        metrics.write(path)
+
+
+def start_metrics_server(port, host=''):
+    """
+    Serve metrics on http://host:port/metrics in a background thread.
+    Return the server.
+    """
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:  # python 2
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class HttpClient(object):
+    """
+    Keep one pooled keep-alive session per host, so consecutive requests to
+    insightly and slack reuse already opened TCP+TLS connections.
+    """
+
+    def __init__(self, auth=None, pool_size=10, timeout=30, budget=None,
+                 response_cache=None, adapters=None):
+        # Mapping of host to (user, password) tuple, set once per session.
+        self.auth = auth or {}
+        self.pool_size = pool_size
+        self.timeout = timeout
+        # Optional ApiBudget counting GET requests.
+        self.budget = budget
+        # Optional ResponseCache used by insightly_get().
+        self.response_cache = response_cache
+        self.sessions = {}
+        # Mapping of host to adapter keeping its connection pool, shared
+        # with views of the client.
+        self.adapters = {} if adapters is None else adapters
+        self.lock = threading.Lock()
+
+    def session(self, url):
+        """
+        Return session for the url host, create it on first use. Client can
+        be shared by threads, so each host gets a single session.
+        """
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.sessions:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                # Adapters are shared with views, setdefault() keeps the
+                # first one of the host.
+                adapter = self.adapters.setdefault(
+                    host, HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.pool_size))
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.auth = self.auth.get(host)
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    def view(self, auth=None, budget=None, response_cache=None):
+        """
+        Return client with other authentication, api budget and response
+        cache which shares connection pools with this one.
+        """
+        return HttpClient(auth, self.pool_size, self.timeout, budget,
+                          response_cache, adapters=self.adapters)
+
+    def get(self, url, **kwargs):
+        response = self.request('GET', url, **kwargs)
+        if self.budget is not None:
+            self.budget.record(url, response)
+        return response
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        """
+        Send request and record its metrics.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        started = time.time()
+        try:
+            response = self.session(url).request(method, url, **kwargs)
+        except Exception:
+            metrics.request(method, url, started)
+            raise
+        metrics.request(method, url, started, response)
+        return response
+
+    def connection_stats(self):
+        """
+        Return tuple (opened, reused) with number of connections opened and
+        reused by all sessions.
+        """
+        opened = sent = 0
+        for adapter in self.adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                opened += pools[key].num_connections
+                sent += pools[key].num_requests
+        return opened, sent - opened
+
+    def close(self):
+        """
+        Close sessions and connection pools, shared with views too.
+        """
+        for session in self.sessions.values():
+            session.close()
+        for adapter in self.adapters.values():
+            adapter.close()
+        self.sessions = {}
+        self.adapters.clear()
+
+
+def insightly_auth(account=None):
+    """
+    Return authentication of the account, by default the one configured by
+    INSIGHTLY_API_KEY, for HttpClient.
+    """
+    account = account or default_account()
+    if not account.api_key:
+        return {}
+    # Tuple (user, password) for request authentication.
+    # User should be the api key, password is empty.
+    return {urlparse(INSIGHTLY_URL).netloc: (account.api_key, '')}
+
+
+def make_client(budget=None, response_cache=None, account=None):
+    """
+    Create http client using config. Insightly authentication is set once
+    for the insightly host session.
+    """
+    return HttpClient(auth=insightly_auth(account),
+                      pool_size=getattr(config, 'HTTP_POOL_SIZE', 10),
+                      timeout=getattr(config, 'HTTP_TIMEOUT', 30),
+                      budget=budget, response_cache=response_cache)
+
+
+def endpoint_template(url):
+    """
+    Return insightly endpoint of the url without query and with ids replaced
+    by {id}, e.g. '/users/{id}'.
+    """
+    path = urlparse(url).path
+    prefix = urlparse(INSIGHTLY_URL).path
+    if path.startswith(prefix):
+        path = path[len(prefix):]
+    return re.sub(r'/\d+(?=/|$)', '/{id}', path)
+
+
+class ApiBudget(object):
+    """
+    Daily budget of insightly api calls. Calls are counted per endpoint and
+    per hour, calls of the last 24 hours are kept in the state store, so the
+    budget is shared by consecutive runs.
+
+    Limit is daily_limit or the one reported by X-RateLimit-Limit response
+    header, remaining calls reported by X-RateLimit-Remaining header are
+    preferred to the counted ones. Budget is low when less than reserve part
+    of the limit remains, call-heavy work should be deferred then.
+    """
+
+    WINDOW = 86400
+
+    def __init__(self, daily_limit=0, reserve=0.2, clock=time.time):
+        self.daily_limit = daily_limit
+        self.reserve = reserve
+        self.clock = clock
+        # Mapping of hour start to number of calls made by previous runs.
+        self.usage = {}
+        # Calls of the current run by hour and by endpoint.
+        self.run_usage = defaultdict(int)
+        self.calls = defaultdict(int)
+        self.header_limit = None
+        self.header_remaining = None
+        self.lock = threading.Lock()
+
+    def hour(self):
+        now = self.clock()
+        return int(now - now % 3600)
+
+    def since(self):
+        """
+        Return start of the oldest hour in the budget window.
+        """
+        return self.hour() - self.WINDOW + 3600
+
+    def record(self, url, response):
+        """
+        Count api call and read rate limit headers of its response.
+        """
+        headers = getattr(response, 'headers', None) or {}
+        with self.lock:
+            self.calls[endpoint_template(url)] += 1
+            self.run_usage[self.hour()] += 1
+            try:
+                self.header_limit = int(headers['X-RateLimit-Limit'])
+            except (KeyError, TypeError, ValueError):
+                pass
+            try:
+                self.header_remaining = int(headers['X-RateLimit-Remaining'])
+            except (KeyError, TypeError, ValueError):
+                pass
+
+    def run_calls(self):
+        """
+        Return number of calls made during current run.
+        """
+        return sum(self.calls.values())
+
+    def limit(self):
+        """
+        Return daily limit, or None if it is unknown.
+        """
+        return self.header_limit or self.daily_limit or None
+
+    def remaining(self):
+        """
+        Return number of calls left in the budget, or None if limit is
+        unknown.
+        """
+        # Remaining calls can't be compared with unknown limit.
+        if self.limit() is None:
+            return None
+        if self.header_remaining is not None:
+            return self.header_remaining
+        since = self.since()
+        used = sum(calls for hour, calls in chain(self.usage.items(),
+                                                  self.run_usage.items())
+                   if hour >= since)
+        return max(0, self.limit() - used)
+
+    def low(self):
+        """
+        Return True if call-heavy work should be deferred.
+        """
+        remaining = self.remaining()
+        return (remaining is not None and
+                remaining < self.limit() * self.reserve)
+
+    def poll_interval(self, calls_per_run):
+        """
+        Return minimal interval in seconds between runs making calls_per_run
+        calls each, so the budget lasts for the whole day, or None if limit
+        is unknown.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return None
+        spare = remaining - self.limit() * self.reserve
+        if spare <= 0:
+            return float(self.WINDOW)
+        return self.WINDOW * max(1, calls_per_run) / float(spare)
+
+    def load(self, store):
+        self.usage = store.get_api_usage(self.since())
+
+    def save(self, store):
+        """
+        Add calls of the current run to the state store. Calls are saved
+        once, so the budget can be saved after each daemon cycle.
+        """
+        store.add_api_usage(dict(self.run_usage), self.since())
+        for hour, calls in self.run_usage.items():
+            self.usage[hour] = self.usage.get(hour, 0) + calls
+        self.run_usage.clear()
+
+    def log_stats(self):
+        logging.info('{} insightly api calls: {}.'.format(
+            self.run_calls(), ', '.join(
+                '{} {}'.format(endpoint, calls)
+                for endpoint, calls in sorted(self.calls.items()))))
+
+        remaining = self.remaining()
+        if remaining is not None:
+            logging.info('{} of {} daily api calls remaining, next run in {} '
+                         'seconds or later.'.format(
+                             remaining, self.limit(),
+                             int(self.poll_interval(self.run_calls()))))
+
+
+def make_api_budget(account=None):
+    """
+    Create api budget of the account using config.
+    """
+    daily_limit = getattr(config, 'INSIGHTLY_DAILY_LIMIT', 0)
+    if account is not None and account.daily_limit is not None:
+        daily_limit = account.daily_limit
+    return ApiBudget(daily_limit=daily_limit,
+                     reserve=getattr(config, 'INSIGHTLY_BUDGET_RESERVE', 0.2))
+
+
+def insightly_get(path, client):
     """
     Send GET response. Raise exception if response status code is not 200.
+
+    If client has response cache, cached response validators are sent and
+    cached data is returned if insightly answers 304 Not Modified.
     """
-    response = requests.get(INSIGHTLY_URL + path, auth=auth)
+    url = INSIGHTLY_URL + path
+    cache = client.response_cache
+    headers, cached = (cache.validators(url) if cache is not None
+                       else ({}, None))
+
+    if headers:
+        response = client.get(url, headers=headers)
+        if response.status_code == 304:
+            return cache.hit(url, cached)
+    else:
+        response = client.get(url)
+
     if response.status_code != 200:
         err = Exception('Insightly api GET error: Http status {}. Url:\n{}'
-                        .format(response.status_code, INSIGHTLY_URL + path))
+                        .format(response.status_code, url))
         logging.critical(err)
         raise err
 
-    return json.loads(response.content)
+    data = json.loads(response.content)
+    if cache is not None:
+        cache.update(url, response, data)
+    return data
+
+
+def is_reference_path(url):
+    """
+    Return True if url is a collection or an item of REFERENCE_COLLECTIONS.
+    """
+    path = endpoint_template(url)
+    return any(path in (collection, item_path.format('{id}'))
+               for collection, _, item_path in REFERENCE_COLLECTIONS)
 
 
-def slack_post(url, *args, **kwargs):
+class ResponseCache(object):
     """
-    Send POST response. Raise exception if response status code is not 200.
+    Cache of insightly responses with ETag and Last-Modified validators
+    keyed by url, so unchanged responses are neither downloaded nor parsed
+    again. Only responses of reference collections and items (users,
+    categories, pipelines and stages) are cached, the least recently used
+    entries are evicted when there are more than max_size of them.
     """
-    response = requests.post(url, *args, **kwargs)
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        # Mapping of url to (etag, last modified, data), least recently used
+        # first.
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.lock = threading.Lock()
+
+    def validators(self, url):
+        """
+        Return tuple (conditional request headers, cached data) for the url.
+        Data is taken together with the headers, so not modified response
+        is served even if the entry is evicted by another thread meanwhile.
+        """
+        with self.lock:
+            entry = self.entries.get(url)
+        if entry is None:
+            return {}, None
+
+        headers = {}
+        if entry[0]:
+            headers['If-None-Match'] = entry[0]
+        if entry[1]:
+            headers['If-Modified-Since'] = entry[1]
+        return headers, entry[2]
+
+    def hit(self, url, data):
+        """
+        Count not modified response and mark its entry as recently used.
+        Return cached data of the response.
+        """
+        with self.lock:
+            entry = self.entries.pop(url, None)
+            if entry is not None:
+                self.entries[url] = entry
+            self.hits += 1
+        return data
+
+    def update(self, url, response, data):
+        """
+        Cache response data if it has validators.
+        """
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not (etag or last_modified) or not is_reference_path(url):
+            return
+
+        with self.lock:
+            self.entries.pop(url, None)
+            self.entries[url] = (etag, last_modified, data)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def load(self, store):
+        self.entries = OrderedDict(store.get_response_cache())
+
+    def save(self, store):
+        store.set_response_cache(self.entries.items())
+        logging.info('Response cache: {} not modified responses.'
+                     .format(self.hits))
+
+
+def make_response_cache():
+    """
+    Create response cache using config, return None if it is disabled.
+    """
+    if not getattr(config, 'CONDITIONAL_GET', True):
+        return None
+    return ResponseCache(max_size=getattr(config, 'RESPONSE_CACHE_SIZE',
+                                          1000))
+
+
+def page_path(path, page_size, skip):
+    """
+    Return path of the collection page.
+    """
+    separator = '&' if '?' in path else '?'
+    return '{}{}$top={}&$skip={}'.format(path, separator, page_size, skip)
+
+
+def ids_path(path, ids):
+    """
+    Return path of the collection items with given ids.
+    """
+    return '{}?ids={}'.format(path, ','.join(str(x) for x in ids))
+
+
+def insightly_iter(path, client, page_size=None):
+    """
+    Fetch collection page by page using $top and $skip query parameters.
+    Yield collection items, so only one page is kept in memory.
+    """
+    if page_size is None:
+        page_size = getattr(config, 'INSIGHTLY_PAGE_SIZE', 500)
+
+    skip = 0
+    while True:
+        page = insightly_get(page_path(path, page_size, skip), client)
+        for item in page:
+            yield item
+
+        # Short page is the last one.
+        if len(page) < page_size:
+            break
+        skip += len(page)
+
+
+def insightly_iter_ids(path, ids, client, chunk_size=100):
+    """
+    Fetch collection items with given ids, chunk_size ids per request.
+    Yield collection items.
+    """
+    ids = list(ids)
+    for start in range(0, len(ids), chunk_size):
+        page = insightly_get(ids_path(path, ids[start:start + chunk_size]),
+                             client)
+        for item in page:
+            yield item
+
+
+class SlackPostError(Exception):
+    """
+    Slack api POST error. Keeps the response, so the sender can decide
+    whether to retry.
+    """
+
+    def __init__(self, message, response):
+        super(SlackPostError, self).__init__(message)
+        self.response = response
+
+
+def is_retryable(response):
+    """
+    Return True if slack request failed because of rate limit or server
+    error and can be retried.
+    """
+    return response.status_code == 429 or response.status_code >= 500
+
+
+def slack_post(url, client, **kwargs):
+    """
+    Send POST response. Raise SlackPostError if response status code is not
+    200.
+    """
+    response = client.post(url, **kwargs)
     if response.status_code != 200:
-        err = Exception('Slack api POST error: Http status {}. Url:\n{}'
-                        .format(response.status_code, url))
-        logging.critical(err)
+        err = SlackPostError('Slack api POST error: Http status {}. Url:\n{}'
+                             .format(response.status_code, url), response)
+        # Retryable errors are logged by the sender if retries run out.
+        if not is_retryable(response):
+            logging.critical(err)
         raise err
     return response
 
 
-def configure():
+class TokenBucket(object):
+    """
+    Token bucket rate limiter: rate tokens are added per second, up to
+    burst tokens. No limit if rate is 0.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.time, sleep=time.sleep):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, wait until it is available. Return time waited.
+        """
+        if not self.rate:
+            return 0
+
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            # Negative balance is time to wait for the token.
+            wait = max(0, -self.tokens / float(self.rate))
+
+        if wait:
+            self.sleep(wait)
+        return wait
+
+
+def slack_digest(messages):
+    """
+    Return slack payload with given messages. Single message is sent as plain
+    text, several ones as digest with a section block per message. Long
+    messages are split into several section blocks.
+    """
+    if len(messages) == 1:
+        return {'text': messages[0]}
+
+    blocks = []
+    for message in messages:
+        for start in range(0, len(message), SLACK_SECTION_TEXT_LIMIT):
+            blocks.append({
+                'type': 'section',
+                'text': {
+                    'type': 'plain_text',
+                    'text': message[start:start + SLACK_SECTION_TEXT_LIMIT],
+                },
+            })
+    # Text is shown in notifications instead of blocks.
+    return {'text': '{} insightly opportunities updates'.format(len(messages)),
+            'blocks': blocks}
+
+
+def slack_blocks_count(message):
+    """
+    Return number of section blocks used for the message in the digest.
+    """
+    return max(1, -(-len(message) // SLACK_SECTION_TEXT_LIMIT))
+
+
+class SlackSender(object):
+    """
+    Send messages to slack webhook grouped into digests, so bursts of
+    messages take a few webhook requests instead of one request per message.
+
+    Digest is sent when it has max_size messages, when next message doesn't
+    fit into slack limits or goes to another webhook, or on flush().
+    Messages are sent one by one if max_size is 1.
+
+    Requests are paced by limiter (TokenBucket). Rate limited requests are
+    retried after Retry-After seconds, requests failed with server error
+    after jittered exponential backoff, both up to max_retries times.
+    Counters throttled and retried are numbers of such retries.
+    """
+
+    def __init__(self, url, client, max_size=1, limiter=None, max_retries=5,
+                 backoff=1, sleep=time.sleep):
+        self.url = url
+        self.client = client
+        self.max_size = max(1, min(max_size, SLACK_BLOCKS_LIMIT))
+        self.limiter = limiter or TokenBucket(0)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.sleep = sleep
+        self.pending = []
+        # Webhook url of the pending digest.
+        self.pending_url = None
+        self.requests = 0
+        self.throttled = 0
+        self.retried = 0
+
+    def fits(self, message):
+        """
+        Return True if message can be added to pending digest.
+        """
+        messages = self.pending + [message]
+        return (len(messages) <= self.max_size and
+                sum(len(x) for x in messages) <= SLACK_TEXT_LIMIT and
+                sum(slack_blocks_count(x) for x in messages) <=
+                SLACK_BLOCKS_LIMIT)
+
+    def send(self, message, url=None):
+        """
+        Send message to the webhook url, by default to the sender one.
+        """
+        if not message:
+            return
+        url = url or self.url
+        if self.pending and (url != self.pending_url or
+                             not self.fits(message)):
+            self.flush()
+        if not self.pending:
+            self.pending_url = url
+        self.pending.append(message)
+
+        if len(self.pending) >= self.max_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Send pending digest.
+        """
+        if not self.pending:
+            return
+        messages, self.pending = self.pending, []
+        self.post(slack_digest(messages), self.pending_url)
+
+    def post(self, payload, url=None):
+        """
+        Send payload to the slack webhook url, by default to the sender one.
+        Retry on rate limit and server errors.
+        """
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            self.requests += 1
+            try:
+                return slack_post(url or self.url, self.client,
+                                  json=payload)
+            except SlackPostError as err:
+                if not is_retryable(err.response):
+                    raise
+                if attempt >= self.max_retries:
+                    logging.critical(err)
+                    raise
+                response = err.response
+
+            attempt += 1
+            if response.status_code == 429:
+                self.throttled += 1
+                metrics.inc('slack_throttled_total')
+                delay = self.retry_after(response)
+            else:
+                self.retried += 1
+                metrics.inc('slack_retries_total')
+                # Full jitter keeps retries of parallel runs apart.
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+            logging.warning('Slack api POST error: Http status {}, retry in '
+                            '{:.1f} seconds.'
+                            .format(response.status_code, delay))
+            self.sleep(delay)
+
+    def retry_after(self, response):
+        """
+        Return delay in seconds from Retry-After header of the response.
+        """
+        try:
+            return max(0, float(response.headers.get('Retry-After')))
+        except (TypeError, ValueError):
+            return self.backoff
+
+    def log_stats(self):
+        logging.info('{} slack requests sent, {} throttled, {} retried.'
+                     .format(self.requests, self.throttled, self.retried))
+
+
+def make_slack_sender(client, account=None):
+    """
+    Create slack sender of the account default webhook using config.
+    """
+    account = account or default_account()
+    limiter = TokenBucket(getattr(config, 'SLACK_RATE_LIMIT', 1),
+                          getattr(config, 'SLACK_RATE_BURST', 3))
+    return SlackSender(account.channel_url, client,
+                       max_size=getattr(config, 'SLACK_BATCH_SIZE', 1),
+                       limiter=limiter,
+                       max_retries=getattr(config, 'SLACK_MAX_RETRIES', 5))
+
+
+def outbox_key(kind, opp, text):
+    """
+    Return idempotency key of the slack message about new, changed or
+    deleted opportunity. The same event found again gets the same key, so
+    it is not sent twice.
+    """
+    if kind == 'changed':
+        return 'changed:{}:{}:{}'.format(
+            opp['OPPORTUNITY_ID'], opp.get('DATE_UPDATED_UTC'),
+            hashlib.sha1(text.encode('utf-8')).hexdigest()[:12])
+    return '{}:{}'.format(kind, opp['OPPORTUNITY_ID'])
+
+
+def enqueue_message(store, kind, opp, text, account=None):
+    """
+    Put slack message to the outbox of the state store, once for each
+    channel the account routes the opportunity to.
+    """
+    if not text:
+        return
+    key = outbox_key(kind, opp, text)
+    for channel in (account or default_account()).channels(opp):
+        if channel is None:
+            store.add_outbox(key, text)
+        else:
+            store.add_outbox('{}@{}'.format(key, hashlib.sha1(
+                channel.encode('utf-8')).hexdigest()[:12]), text, channel)
+
+
+def send_messages(sender, texts, channel=None):
+    """
+    Send messages of one channel to slack as a digest. Return None, or the
+    error if slack rejected them with not retryable error. Other errors are
+    raised.
+    """
+    try:
+        for text in texts:
+            sender.send(text, channel)
+        sender.flush()
+    except SlackPostError as err:
+        if is_retryable(err.response):
+            raise
+        return err
+    return None
+
+
+def mark_delivered(store, keys, error=None):
+    """
+    Mark outbox messages sent, or rejected by slack with the error, and
+    commit the store.
+    """
+    if error is not None:
+        logging.critical('Slack messages {} are dropped: {}'
+                         .format(', '.join(keys), error))
+        store.mark_outbox_sent(keys, time.time(), str(error))
+        metrics.inc('slack_dropped_total', value=len(keys))
+    else:
+        store.mark_outbox_sent(keys, time.time())
+        metrics.inc('slack_messages_total', value=len(keys))
+    store.commit()
+
+
+@metrics.timed('deliver')
+def deliver_outbox(store, sender):
+    """
+    Commit the state store and send messages from its outbox to slack,
+    oldest first. Sent messages are marked and committed after each digest,
+    so messages left by a failure or a crash are sent by the next call, at
+    least once.
+
+    Messages slack rejects with not retryable error, e.g. 404 of removed
+    webhook, are marked with the error and kept as dead letters, so they
+    don't block the rest of the outbox. Return number of sent messages.
+    """
+    store.commit()
+
+    sent = 0
+    while True:
+        entries = store.get_outbox(sender.max_size)
+        if not entries:
+            break
+        # Messages of the same channel are sent together, in order.
+        for channel, group in groupby(sorted(entries,
+                                             key=lambda x: x[2] or ''),
+                                      key=lambda x: x[2]):
+            group = list(group)
+            error = send_messages(sender, [entry[1] for entry in group],
+                                  channel)
+            mark_delivered(store, [entry[0] for entry in group], error)
+            if error is None:
+                sent += len(group)
+
+    # Keys of sent messages are kept for a while to skip repeated events.
+    store.purge_outbox(time.time() - OUTBOX_RETENTION)
+    store.commit()
+
+    if sent:
+        sender.log_stats()
+    return sent
+
+
+class OutboxWorker(threading.Thread):
+    """
+    Deliver outbox messages in the background thread with its own state
+    store connection, so slack delivery doesn't slow down syncs. Outbox is
+    checked every interval seconds and on wake().
+    """
+
+    def __init__(self, open_store, sender, interval=5):
+        super(OutboxWorker, self).__init__()
+        self.daemon = True
+        self.open_store = open_store
+        self.sender = sender
+        self.interval = interval
+        self.wakeup = threading.Event()
+        self.stopping = False
+
+    def run(self):
+        with self.open_store() as store:
+            while True:
+                self.wakeup.wait(self.interval)
+                self.wakeup.clear()
+                try:
+                    deliver_outbox(store, self.sender)
+                except Exception as e:
+                    logging.exception('Delivery failed: {}'.format(e))
+                    store.rollback()
+                if self.stopping:
+                    return
+
+    def wake(self):
+        self.wakeup.set()
+
+    def stop(self):
+        """
+        Deliver pending messages and stop.
+        """
+        self.stopping = True
+        self.wakeup.set()
+        self.join()
+
+
+class StateStore(object):
+    """
+    Local state of the script: last poll times (watermarks), local copies of
+    opportunities, ids of existing opportunities and reference cache.
+
+    Changes are applied with commit(). Used as context manager the store is
+    committed if no exception was raised, rolled back otherwise, and closed.
+    """
+
+    def get_watermark(self, name):
+        """
+        Return datetime stored under the name or None.
+        """
+        raise NotImplementedError
+
+    def set_watermark(self, name, value):
+        raise NotImplementedError
+
+    def get_opportunity(self, opp_id):
+        """
+        Return local copy of the opportunity or None if it is not known.
+        """
+        raise NotImplementedError
+
+    def put_opportunity(self, opp):
+        raise NotImplementedError
+
+    def delete_opportunity(self, opp_id):
+        raise NotImplementedError
+
+    def get_opportunities_ids(self):
+        """
+        Return set of ids of opportunities existing on the last poll.
+        """
+        raise NotImplementedError
+
+    def set_opportunities_ids(self, ids):
+        raise NotImplementedError
+
+    def get_reference_cache(self):
+        """
+        Return list of (path, (fetch time, data)) reference cache entries,
+        least recently used first.
+        """
+        raise NotImplementedError
+
+    def set_reference_cache(self, entries):
+        raise NotImplementedError
+
+    def get_response_cache(self):
+        """
+        Return list of (url, (etag, last modified, data)) response cache
+        entries, least recently used first.
+        """
+        raise NotImplementedError
+
+    def set_response_cache(self, entries):
+        raise NotImplementedError
+
+    def get_seen_updates(self):
+        """
+        Return list of keys of recently seen updates, the oldest first.
+        """
+        raise NotImplementedError
+
+    def set_seen_updates(self, keys):
+        raise NotImplementedError
+
+    def get_api_usage(self, since):
+        """
+        Return dict of hour start timestamp to number of insightly api calls
+        made during the hour, for hours starting at since or later.
+        """
+        raise NotImplementedError
+
+    def add_api_usage(self, usage, since):
+        """
+        Add number of calls to the hours of usage dict, drop hours before
+        since.
+        """
+        raise NotImplementedError
+
+    def add_outbox(self, key, text, channel=None):
+        """
+        Put slack message to the outbox unless message with the same key is
+        already there. channel is webhook url, None for the default one.
+        Return True if message was added.
+        """
+        raise NotImplementedError
+
+    def get_outbox(self, limit):
+        """
+        Return list of up to limit (key, text, channel) tuples of messages
+        not sent yet, oldest first.
+        """
+        raise NotImplementedError
+
+    def mark_outbox_sent(self, keys, sent_at, error=None):
+        """
+        Mark messages sent at given timestamp. error is set for messages
+        slack rejected, they are kept as dead letters until purged.
+        """
+        raise NotImplementedError
+
+    def purge_outbox(self, before):
+        """
+        Drop messages sent before given timestamp.
+        """
+        raise NotImplementedError
+
+    def commit(self):
+        raise NotImplementedError
+
+    def rollback(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+        finally:
+            self.close()
+
+
+class ShelveStore(StateStore):
+    """
+    State store kept in a shelve, or any other dict-like object, using keys
+    of the previous versions of the script.
+
+    Shelve has no transactions, so changes are written immediately and
+    rollback() does nothing.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def get_watermark(self, name):
+        return self.db.get(name)
+
+    def set_watermark(self, name, value):
+        self.db[name] = value
+
+    def get_opportunity(self, opp_id):
+        return self.db.get('opportunity_%s' % opp_id)
+
+    def put_opportunity(self, opp):
+        self.db['opportunity_%s' % opp['OPPORTUNITY_ID']] = opp
+
+    def delete_opportunity(self, opp_id):
+        del self.db['opportunity_%s' % opp_id]
+
+    def get_opportunities_ids(self):
+        return set(self.db.get('opportunities_ids', ()))
+
+    def set_opportunities_ids(self, ids):
+        self.db['opportunities_ids'] = set(ids)
+
+    def get_reference_cache(self):
+        return list(self.db.get('reference_cache', {}).items())
+
+    def set_reference_cache(self, entries):
+        self.db['reference_cache'] = OrderedDict(entries)
+
+    def get_response_cache(self):
+        return list(self.db.get('response_cache', {}).items())
+
+    def set_response_cache(self, entries):
+        self.db['response_cache'] = OrderedDict(entries)
+
+    def get_seen_updates(self):
+        return list(self.db.get('seen_updates', ()))
+
+    def set_seen_updates(self, keys):
+        self.db['seen_updates'] = list(keys)
+
+    def get_api_usage(self, since):
+        return dict((hour, calls) for hour, calls
+                    in self.db.get('api_usage', {}).items() if hour >= since)
+
+    def add_api_usage(self, usage, since):
+        stored = self.get_api_usage(since)
+        for hour, calls in usage.items():
+            stored[hour] = stored.get(hour, 0) + calls
+        self.db['api_usage'] = stored
+
+    def add_outbox(self, key, text, channel=None):
+        # Mapping of key to [text, sent time or None, channel, error],
+        # oldest first. Entries of previous versions have no channel and
+        # error.
+        outbox = self.db.get('outbox', OrderedDict())
+        if key in outbox:
+            return False
+        outbox[key] = [text, None, channel, None]
+        self.db['outbox'] = outbox
+        return True
+
+    def get_outbox(self, limit):
+        pending = [(key, entry[0], entry[2] if len(entry) > 2 else None)
+                   for key, entry in self.db.get('outbox', {}).items()
+                   if entry[1] is None]
+        return pending[:limit]
+
+    def mark_outbox_sent(self, keys, sent_at, error=None):
+        outbox = self.db.get('outbox', OrderedDict())
+        for key in keys:
+            entry = outbox[key]
+            outbox[key] = [entry[0], sent_at,
+                           entry[2] if len(entry) > 2 else None, error]
+        self.db['outbox'] = outbox
+
+    def purge_outbox(self, before):
+        self.db['outbox'] = OrderedDict(
+            (key, entry) for key, entry
+            in self.db.get('outbox', {}).items()
+            if entry[1] is None or entry[1] >= before)
+
+    def commit(self):
+        if hasattr(self.db, 'sync'):
+            self.db.sync()
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        if hasattr(self.db, 'close'):
+            self.db.close()
+
+
+class SqliteStore(StateStore):
+    """
+    State store kept in SQLite database. Database is used in WAL mode, so
+    other tools can read it while the script is running. All changes made
+    during a run are applied in a single transaction by commit().
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS watermarks (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS opportunities (
+            id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS opportunities_ids (
+            id INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS reference_cache (
+            path TEXT PRIMARY KEY,
+            fetched_at REAL NOT NULL,
+            position INTEGER NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS reference_cache_position
+            ON reference_cache (position);
+        CREATE TABLE IF NOT EXISTS response_cache (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            position INTEGER NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS api_usage (
+            hour INTEGER PRIMARY KEY,
+            calls INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL UNIQUE,
+            text TEXT NOT NULL,
+            sent_at REAL,
+            channel TEXT,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS outbox_sent_at ON outbox (sent_at);
+        CREATE TABLE IF NOT EXISTS seen_updates (
+            position INTEGER PRIMARY KEY,
+            key TEXT NOT NULL
+        );
+    """
+
+    DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+    def __init__(self, path, timeout=5):
+        # Seconds to wait for the lock held by another connection.
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(self.SCHEMA)
+
+        # Outbox of databases created by previous versions has no channel
+        # and error columns.
+        columns = [row[1] for row in
+                   self.connection.execute('PRAGMA table_info(outbox)')]
+        for column in ('channel', 'error'):
+            if column not in columns:
+                self.connection.execute(
+                    'ALTER TABLE outbox ADD COLUMN {} TEXT'.format(column))
+
+    def get_watermark(self, name):
+        row = self.connection.execute(
+            'SELECT value FROM watermarks WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        return datetime.strptime(row[0], self.DATE_FORMAT)
+
+    def set_watermark(self, name, value):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO watermarks (name, value) VALUES (?, ?)',
+            (name, value.strftime(self.DATE_FORMAT)))
+
+    def get_opportunity(self, opp_id):
+        row = self.connection.execute(
+            'SELECT data FROM opportunities WHERE id = ?', (opp_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put_opportunity(self, opp):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO opportunities (id, data) VALUES (?, ?)',
+            (opp['OPPORTUNITY_ID'], json.dumps(opp)))
+
+    def delete_opportunity(self, opp_id):
+        self.connection.execute('DELETE FROM opportunities WHERE id = ?',
+                                (opp_id,))
+
+    def get_opportunities_ids(self):
+        rows = self.connection.execute('SELECT id FROM opportunities_ids')
+        return set(row[0] for row in rows)
+
+    def set_opportunities_ids(self, ids):
+        self.connection.execute('DELETE FROM opportunities_ids')
+        self.connection.executemany(
+            'INSERT INTO opportunities_ids (id) VALUES (?)',
+            ((x,) for x in ids))
+
+    def get_reference_cache(self):
+        rows = self.connection.execute(
+            'SELECT path, fetched_at, data FROM reference_cache '
+            'ORDER BY position')
+        return [(path, (fetched_at, json.loads(data)))
+                for path, fetched_at, data in rows]
+
+    def set_reference_cache(self, entries):
+        self.connection.execute('DELETE FROM reference_cache')
+        self.connection.executemany(
+            'INSERT INTO reference_cache (path, fetched_at, position, data) '
+            'VALUES (?, ?, ?, ?)',
+            ((path, fetched_at, position, json.dumps(data))
+             for position, (path, (fetched_at, data)) in enumerate(entries)))
+
+    def get_response_cache(self):
+        rows = self.connection.execute(
+            'SELECT url, etag, last_modified, data FROM response_cache '
+            'ORDER BY position')
+        return [(url, (etag, last_modified, json.loads(data)))
+                for url, etag, last_modified, data in rows]
+
+    def set_response_cache(self, entries):
+        self.connection.execute('DELETE FROM response_cache')
+        self.connection.executemany(
+            'INSERT INTO response_cache '
+            '(url, etag, last_modified, position, data) '
+            'VALUES (?, ?, ?, ?, ?)',
+            ((url, etag, last_modified, position, json.dumps(data))
+             for position, (url, (etag, last_modified, data))
+             in enumerate(entries)))
+
+    def get_seen_updates(self):
+        rows = self.connection.execute(
+            'SELECT key FROM seen_updates ORDER BY position')
+        return [row[0] for row in rows]
+
+    def set_seen_updates(self, keys):
+        self.connection.execute('DELETE FROM seen_updates')
+        self.connection.executemany(
+            'INSERT INTO seen_updates (position, key) VALUES (?, ?)',
+            enumerate(keys))
+
+    def get_api_usage(self, since):
+        rows = self.connection.execute(
+            'SELECT hour, calls FROM api_usage WHERE hour >= ?', (since,))
+        return dict(rows.fetchall())
+
+    def add_api_usage(self, usage, since):
+        self.connection.execute('DELETE FROM api_usage WHERE hour < ?',
+                                (since,))
+        for hour, calls in usage.items():
+            self.connection.execute(
+                'INSERT OR IGNORE INTO api_usage (hour, calls) VALUES (?, 0)',
+                (hour,))
+            self.connection.execute(
+                'UPDATE api_usage SET calls = calls + ? WHERE hour = ?',
+                (calls, hour))
+
+    def add_outbox(self, key, text, channel=None):
+        cursor = self.connection.execute(
+            'INSERT OR IGNORE INTO outbox (key, text, channel) '
+            'VALUES (?, ?, ?)', (key, text, channel))
+        return cursor.rowcount == 1
+
+    def get_outbox(self, limit):
+        rows = self.connection.execute(
+            'SELECT key, text, channel FROM outbox WHERE sent_at IS NULL '
+            'ORDER BY id LIMIT ?', (limit,))
+        return rows.fetchall()
+
+    def mark_outbox_sent(self, keys, sent_at, error=None):
+        self.connection.executemany(
+            'UPDATE outbox SET sent_at = ?, error = ? WHERE key = ?',
+            ((sent_at, error, key) for key in keys))
+
+    def purge_outbox(self, before):
+        self.connection.execute('DELETE FROM outbox WHERE sent_at < ?',
+                                (before,))
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+
+def route_matches(route, opp):
+    """
+    Return True if opportunity matches all conditions of the route: value
+    or list of values of PIPELINE_ID, CATEGORY_ID, RESPONSIBLE_USER_ID and
+    MIN_BID_AMOUNT.
+    """
+    for field in ROUTE_FIELDS:
+        if field in route:
+            values = route[field]
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            if opp.get(field) not in values:
+                return False
+    if 'MIN_BID_AMOUNT' in route:
+        return (opp.get('BID_AMOUNT') or 0) >= route['MIN_BID_AMOUNT']
+    return True
+
+
+class Account(object):
+    """
+    Insightly account synced by the script: its api key, default slack
+    webhook url, routes of messages to other webhooks and optional state
+    file and daily limit of api calls. Account without name is the one
+    configured by top level INSIGHTLY_API_KEY, SLACK_CHANNEL_URL and
+    SLACK_ROUTES.
+    """
+
+    def __init__(self, name=None, api_key=None, channel_url=None, routes=(),
+                 state_file=None, daily_limit=None):
+        self.name = name
+        self.api_key = api_key
+        self.channel_url = channel_url
+        self.routes = list(routes)
+        self.state_file = state_file
+        # Overrides INSIGHTLY_DAILY_LIMIT if not None.
+        self.daily_limit = daily_limit
+
+    def channels(self, opp):
+        """
+        Return webhook urls of all routes matching the opportunity, or [None]
+        for the default webhook if no route matches.
+        """
+        channels = []
+        for route in self.routes:
+            channel = route['SLACK_CHANNEL_URL']
+            if route_matches(route, opp) and channel not in channels:
+                channels.append(channel)
+        return channels or [None]
+
+
+def default_account():
+    """
+    Create account from top level config variables.
+    """
+    return Account(api_key=getattr(config, 'INSIGHTLY_API_KEY', None),
+                   channel_url=getattr(config, 'SLACK_CHANNEL_URL', None),
+                   routes=getattr(config, 'SLACK_ROUTES', ()))
+
+
+def load_accounts():
+    """
+    Create accounts listed in ACCOUNTS config, or the default account if it
+    is not set.
+    """
+    if not getattr(config, 'ACCOUNTS', None):
+        return [default_account()]
+    return [Account(account['NAME'], account['INSIGHTLY_API_KEY'],
+                    account['SLACK_CHANNEL_URL'], account.get('ROUTES', ()),
+                    account.get('STATE_FILE'),
+                    account.get('INSIGHTLY_DAILY_LIMIT'))
+            for account in config.ACCOUNTS]
+
+
+def state_file_path(account=None, backend=None):
+    """
+    Return state file of the account using config, backend is 'sqlite' or
+    'shelve', by default the configured one. Named accounts keep state in
+    separate files, e.g. db.sales.sqlite3, unless their STATE_FILE is set.
+    """
+    if account is not None and account.state_file:
+        return account.state_file
+
+    if (backend or getattr(config, 'STATE_STORE', 'sqlite')) == 'shelve':
+        path = getattr(config, 'STATE_FILE', 'db.shelve')
+    else:
+        path = getattr(config, 'STATE_FILE', 'db.sqlite3')
+    if account is not None and account.name:
+        root, ext = splitext(path)
+        path = '{}.{}{}'.format(root, account.name, ext)
+    return path
+
+
+def migrate_store(source, target):
+    """
+    Copy watermarks, local copies of existing opportunities, caches, api
+    usage and pending outbox messages from source store to target one.
+    """
+    for _, name in WATERMARKS:
+        if source.get_watermark(name) is not None:
+            target.set_watermark(name, source.get_watermark(name))
+
+    ids = source.get_opportunities_ids()
+    for opp_id in ids:
+        opp = source.get_opportunity(opp_id)
+        if opp is not None:
+            target.put_opportunity(opp)
+    target.set_opportunities_ids(ids)
+
+    target.set_reference_cache(source.get_reference_cache())
+    target.set_response_cache(source.get_response_cache())
+    target.set_seen_updates(source.get_seen_updates())
+    target.add_api_usage(source.get_api_usage(0), 0)
+    for key, text, channel in source.get_outbox(sys.maxsize):
+        target.add_outbox(key, text, channel)
+
+
+def open_store(account=None, timeout=5):
+    """
+    Open state store of the account using config, timeout is seconds sqlite
+    waits for the lock held by another connection. If sqlite database
+    doesn't exist yet, state kept in shelve by previous versions is migrated
+    to it.
+    """
+    import shelve
+
+    if getattr(config, 'STATE_STORE', 'sqlite') == 'shelve':
+        return ShelveStore(shelve.open(state_file_path(account)))
+
+    path = state_file_path(account)
+    legacy_path = state_file_path(account, 'shelve')
+    # Some dbm modules add an extension to the shelve file name.
+    if exists(path) or not any(exists(legacy_path + ext)
+                               for ext in ('', '.db', '.dat')):
+        return SqliteStore(path, timeout)
+
+    logging.warning('Migrating local state of the previous version from {} '
+                    'to {}.'.format(legacy_path, path))
+    store = SqliteStore(path, timeout)
+    try:
+        legacy = ShelveStore(shelve.open(legacy_path, 'r'))
+        try:
+            migrate_store(legacy, store)
+        finally:
+            legacy.close()
+        store.commit()
+    except Exception:
+        # Migration is retried by the next run.
+        store.close()
+        for suffix in ('', '-wal', '-shm'):
+            if exists(path + suffix):
+                os.remove(path + suffix)
+        raise
+    return store
+
+
+class ReferenceCache(object):
+    """
+    Cache of rarely changed insightly objects (users, categories, pipelines
+    and stages) keyed by api path. Entries are kept in the state store
+    between runs, expire after ttl seconds and the least recently used
+    entries are evicted when there are more than max_size of them.
+
+    Objects prefetched during current run are served before the stored ones.
+    Expired entries are served too if api budget is low. Cache can be shared
+    by threads rendering messages concurrently, each path is fetched by one
+    thread at a time and the others wait for its result.
+    """
+
+    def __init__(self, store, ttl=86400, max_size=1000, prefetched=None,
+                 budget=None):
+        self.store = store
+        self.ttl = ttl
+        self.max_size = max_size
+        self.prefetched = prefetched or {}
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        # Mapping of path to (fetch time, data), least recently used first.
+        self.entries = OrderedDict(store.get_reference_cache())
+        self.lock = threading.Lock()
+        # Mapping of path being fetched to event set when it is done.
+        self.fetching = {}
+
+    def get(self, path, client):
+        """
+        Return cached data for the path, fetch it from insightly on miss.
+        """
+        while True:
+            with self.lock:
+                if path in self.prefetched:
+                    self.hits += 1
+                    return self.prefetched[path]
+
+                entry = self.entries.get(path)
+                if entry is not None and (
+                        time.time() - entry[0] < self.ttl or
+                        self.budget is not None and self.budget.low()):
+                    self.hits += 1
+                    self.touch(path, entry)
+                    return entry[1]
+
+                fetched = self.fetching.get(path)
+                if fetched is None:
+                    self.misses += 1
+                    fetched = self.fetching[path] = threading.Event()
+                    break
+
+            # Path is fetched by another thread, the entry is checked again
+            # when it is done. If the fetch failed, this thread fetches it.
+            fetched.wait()
+
+        # Api is called without the lock, so other threads are not blocked.
+        try:
+            entry = (time.time(), insightly_get(path, client))
+            with self.lock:
+                self.touch(path, entry)
+        finally:
+            with self.lock:
+                del self.fetching[path]
+            fetched.set()
+
+        return entry[1]
+
+    def touch(self, path, entry):
+        """
+        Put the entry as the most recently used, evict the least recently
+        used entries if cache is full.
+        """
+        self.entries.pop(path, None)
+        self.entries[path] = entry
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, path=None):
+        """
+        Drop cached data for the path or the whole cache if path is None.
+        """
+        if path is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(path, None)
+
+    def save(self):
+        """
+        Store cache in the state store and log hit and miss counters.
+        """
+        self.store.set_reference_cache(self.entries.items())
+        logging.info('Reference cache: {} hits, {} misses.'
+                     .format(self.hits, self.misses))
+
+
+def make_reference_cache(store, prefetched=None, budget=None):
+    """
+    Create reference cache using config.
+    """
+    return ReferenceCache(
+        store, ttl=getattr(config, 'REFERENCE_CACHE_TTL', 86400),
+        max_size=getattr(config, 'REFERENCE_CACHE_SIZE', 1000),
+        prefetched=prefetched, budget=budget)
+
+
+@metrics.timed('prefetch')
+def prefetch_reference_data(client):
+    """
+    Fetch all users, categories, pipelines and stages with one request per
+    collection. Return dict of single item path to item data, so notifiers
+    don't need separate api call for each referenced item.
+    """
+    prefetched = {}
+    for collection, id_field, item_path in REFERENCE_COLLECTIONS:
+        for item in insightly_get(collection, client):
+            prefetched[item_path.format(item[id_field])] = item
+
+    logging.info('{} reference items prefetched.'.format(len(prefetched)))
+    return prefetched
+
+
+def invalidate_reference_cache():
+    """
+    Drop all cached users, categories, pipelines and stages of all accounts.
+    """
+    for account in load_accounts():
+        with open_store(account) as store:
+            cache = make_reference_cache(store)
+            cache.invalidate()
+            cache.save()
+
+
+def log_file_path():
     """
-    Apply configuration from config.py
+    Return absolute path of the log file from config.
     """
+    return abspath(getattr(config, 'LOG_FILE',
+                           '/var/log/insightly_notify.log'))
 
+
+def init_config():
+    """
+    Create default config file if it does not exist and test write
+    permissions in the log file directory.
+    """
+    if not exists(CONFIG_FILE):
+        print('*** Creating default config file {}'.format(CONFIG_FILE))
+        copyfile(CONFIG_FILE + '.example', CONFIG_FILE)
+
+    LOG_FILE = log_file_path()
     if hasattr(config, 'LOG_FILE'):
-        LOG_FILE = abspath(config.LOG_FILE)
         print('Log messages will be sent to {}'.format(LOG_FILE))
     else:
-        LOG_FILE = '/var/log/insightly_notify.log'
         print('Log messages will be sent to {}. You can change LOG_FILE in '
               'the config.'.format(LOG_FILE))
 
@@ -98,353 +1941,1378 @@ def configure():
                                'Original error was: {}.'
                                .format(dirname(LOG_FILE), e)))
 
+
+@metrics.timed('configure')
+def configure():
+    """
+    Apply configuration from config.py. Config file is created and log
+    directory is checked once by init_config().
+    """
+    import logging.handlers
+
+    LOG_FILE = log_file_path()
     LOG_LEVEL = getattr(config, 'LOG_LEVEL', 'INFO')
 
-    logging.config.dictConfig({
-        'version': 1,
-        'formatters': {
-            'verbose': {
-                'format': '%(levelname)s %(asctime)s %(module)s.py: '
-                          '%(message)s',
-                'datefmt': '<%Y-%m-%d %H:%M:%S>'
-            },
-            'simple': {'format': '%(levelname)s %(module)s.py: %(message)s'},
-        },
-        'handlers': {
-            'log_file': {
-                'level': LOG_LEVEL,
-                'class': 'logging.handlers.WatchedFileHandler',
-                'filename': LOG_FILE,
-                'formatter': 'verbose'
-            },
-            'console': {
-                'level': LOG_LEVEL,
-                'class': 'logging.StreamHandler',
-                'formatter': 'simple'
-            },
-        },
-        'loggers': {
-            '': {'handlers': ['log_file', 'console'], 'level': LOG_LEVEL},
-        }
-    })
+    try:
+        log_file = logging.handlers.WatchedFileHandler(LOG_FILE)
+    except (OSError, IOError) as e:
+        raise Exception('Open of the log file "{}" failed. Please check '
+                        'permissions, change LOG_FILE config or run '
+                        '"./insightly_slack_notify.py init". Original error '
+                        'was: {}.'.format(LOG_FILE, e))
+    log_file.setFormatter(logging.Formatter(
+        '%(levelname)s %(asctime)s %(module)s.py: %(message)s',
+        '<%Y-%m-%d %H:%M:%S>'))
+    console = logging.StreamHandler()
+    console.setFormatter(
+        logging.Formatter('%(levelname)s %(module)s.py: %(message)s'))
+
+    # Same handlers as logging.config.dictConfig() would set, without
+    # import of logging.config.
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in (log_file, console):
+        handler.setLevel(LOG_LEVEL)
+        root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
 
     try:
-        from insightly_slack_notify_config import INSIGHTLY_API_KEY
-        from insightly_slack_notify_config import SLACK_CHANNEL_URL
+        if not getattr(config, 'ACCOUNTS', None):
+            config.INSIGHTLY_API_KEY
+            config.SLACK_CHANNEL_URL
+        accounts = load_accounts()
     except Exception as e:
         logging.critical('Please set required config varialble in '
                          'insightly_slack_notify_config.py:\n{}'.format(e))
         raise
 
-    if not re.match(r'\w{8}-\w{4}-\w{4}-\w{4}-\w{12}', INSIGHTLY_API_KEY):
-        err = Exception('INSIGHTLY_API_KEY has wrong format "{}", please set '
-                        'the right value in insightly_slack_notify_config.py'
-                        .format(INSIGHTLY_API_KEY))
+    names = set()
+    for account in accounts:
+        # Account name is a part of its state file name.
+        prefix = ''
+        if account.name is not None:
+            prefix = 'Account "{}": '.format(account.name)
+            check_config(re.match(r'\w+$', account.name) and
+                         account.name not in names,
+                         'NAME "{}" should be unique and consist of letters, '
+                         'digits and underscores', account.name)
+            names.add(account.name)
+
+        check_config(re.match(r'\w{8}-\w{4}-\w{4}-\w{4}-\w{12}',
+                              account.api_key),
+                     prefix + 'INSIGHTLY_API_KEY has wrong format "{}"',
+                     account.api_key)
+        for url in [account.channel_url] + [route.get('SLACK_CHANNEL_URL')
+                                            for route in account.routes]:
+            check_config(
+                re.match(r'https://hooks.slack.com/services/\w+/\w+/\w+',
+                         url or ''),
+                prefix + 'SLACK_CHANNEL_URL has wrong format "{}"', url)
+
+
+def check_config(valid, message, value):
+    """
+    Log and raise error with formatted message unless valid is true.
+    """
+    if not valid:
+        err = Exception((message + ', please set the right value in '
+                         'insightly_slack_notify_config.py').format(value))
         logging.critical(err)
         raise err
 
-    if not re.match(r'https://hooks.slack.com/services/\w+/\w+/\w+',
-                    SLACK_CHANNEL_URL):
-        err = Exception('SLACK_CHANNEL_URL has wrong format "{}", please set '
-                        'the right value in insightly_slack_notify_config.py'
-                        .format(SLACK_CHANNEL_URL))
-        logging.critical(err)
-        raise err
 
+def parse_date(value):
+    """
+    Parse insightly date string, e.g. '2016-03-28 13:11:50'.
+    """
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
 
-def notify_new_opportunities():
+
+@metrics.timed('notes')
+def fetch_new_notes(client, last_poll, seen=None):
     """
-    Fetch new opportunities using insightly api. Send slack message on each
-    new opportunity.
+    Fetch notes created after last_poll datetime. Return dict of opportunity
+    id to list of its new notes. Notes already recorded in optional
+    SeenUpdates are skipped.
     """
-    # Persistent file storage will keep track of last poll time.
-    db = shelve.open('db.shelve')
+    new_notes = insightly_iter(
+        '/notes?$filter=DATE_CREATED_UTC%20gt%20DateTime\'{}\''
+        '&$orderby=NOTE_ID'
+        .format(last_poll.strftime('%Y-%m-%dT%H:%M:%S')),
+        client
+    )
+    opportunities_with_new_notes = defaultdict(list)
 
-    # Tuple (user, password) for request authentication.
-    # User should be the api key, password is empty.
-    auth = (config.INSIGHTLY_API_KEY, '')
+    for note in new_notes:
+        if seen is not None and not seen.add('note', note.get('NOTE_ID'),
+                                             note['DATE_CREATED_UTC']):
+            continue
+        for link in note['NOTELINKS']:
+            if link.get('OPPORTUNITY_ID'):
+                opp_id = link.get('OPPORTUNITY_ID')
+                opportunities_with_new_notes[opp_id].append(note)
 
-    now = datetime.utcnow()
+    return opportunities_with_new_notes
 
-    if 'last_poll' not in db:
-        db['last_poll'] = now
-        logging.info('*** insightly_notify is launched first time, previously '
-                     'created opportunities are ignored.')
 
-    last_poll = db['last_poll'].strftime('%Y-%m-%dT%H:%M:%S')
+# Names of referenced items used in change messages: id field, name field
+# of the item and name used if the id is empty.
+REFERENCE_NAMES = {
+    'PIPELINE_ID': ('PIPELINE_NAME', 'No pipeline'),
+    'STAGE_ID': ('STAGE_NAME', 'No stage'),
+    'CATEGORY_ID': ('CATEGORY_NAME', 'No category'),
+}
 
-    new_opportunities = insightly_get(
-        '/opportunities?$filter=DATE_CREATED_UTC%20gt%20DateTime\'{}\''
-        .format(last_poll),
-        auth
-    )
 
-    db['last_poll'] = now
+def value_change(label, field):
+    """
+    Return formatter of the change of plain field value.
+    """
+    def formatter(old, new, name):
+        return '{} changed from {} to {}'.format(label, old[field],
+                                                 new[field])
+    return formatter
 
-    logging.info('%d new opportunities found.' % len(new_opportunities))
 
-    for opp in new_opportunities:
+def pipeline_change(old, new, name):
+    if not new['PIPELINE_ID']:
+        return 'Pipeline changed from {} ({}) to None'.format(
+            name(old, 'PIPELINE_ID'), name(old, 'STAGE_ID'))
+    return 'Pipeline changed from {} ({}) to {} ({})'.format(
+        name(old, 'PIPELINE_ID'), name(old, 'STAGE_ID'),
+        name(new, 'PIPELINE_ID'), name(new, 'STAGE_ID'))
 
-        # Fetch responsible user info.
-        if opp['RESPONSIBLE_USER_ID']:
-            userdata = insightly_get(
-                '/users/{}'.format(opp['RESPONSIBLE_USER_ID']), auth)
-            opp['RESPONSIBLE_USER'] = ('{FIRST_NAME} {LAST_NAME} '
-                                       '{EMAIL_ADDRESS}'.format(**userdata))
-        else:
-            opp['RESPONSIBLE_USER'] = None
-
-        # Fetch category info.
-        if opp['CATEGORY_ID']:
-            category = insightly_get(
-                '/OpportunityCategories/{}'.format(opp['CATEGORY_ID']),
-                auth)
-            opp['CATEGORY'] = category['CATEGORY_NAME']
-        else:
-            opp['CATEGORY'] = None
 
-        # The message template to send to slack.
-        message = NEW_MESSAGE.format(**opp)
+def reference_change(label, field):
+    """
+    Return formatter of the change of referenced item, e.g. category.
+    """
+    def formatter(old, new, name):
+        return '{} changed from {} to {}'.format(
+            label, name(old, field), name(new, field) if new[field] else None)
+    return formatter
 
-        # Send message to slack.
-        slack_post(config.SLACK_CHANNEL_URL, json={'text': dedent(message)})
 
+def keyed_items(field, items):
+    """
+    Return OrderedDict of key to item of the COLLECTION_KEYS list field.
+    """
+    key = COLLECTION_KEYS[field]
+    return OrderedDict((item.get(key), item) for item in items or ())
 
-def notify_changed_opportunities():
+
+def field_differs(field, value, local_value):
+    """
+    Return True if field value differs from local one. Items of
+    COLLECTION_KEYS fields are compared by their keys in any order.
+    """
+    if field in COLLECTION_KEYS:
+        return (dict(keyed_items(field, value)) !=
+                dict(keyed_items(field, local_value)))
+    return value != local_value
+
+
+def diff_collection(field, old, new):
+    """
+    Return lists of added items, removed items and (old, new) pairs of
+    modified items of the COLLECTION_KEYS field of the records.
+    """
+    old_items = keyed_items(field, old.get(field))
+    new_items = keyed_items(field, new.get(field))
+    added = [item for key, item in new_items.items() if key not in old_items]
+    removed = [item for key, item in old_items.items()
+               if key not in new_items]
+    modified = [(old_items[key], item) for key, item in new_items.items()
+                if key in old_items and item != old_items[key]]
+    return added, removed, modified
+
+
+def custom_fields_change(old, new, name):
+    added, removed, modified = diff_collection('CUSTOMFIELDS', old, new)
+    lines = ['Custom field {} set to {}'.format(
+        item['CUSTOM_FIELD_ID'], item.get('FIELD_VALUE')) for item in added]
+    lines.extend('Custom field {} changed from {} to {}'.format(
+        item['CUSTOM_FIELD_ID'], old_item.get('FIELD_VALUE'),
+        item.get('FIELD_VALUE')) for old_item, item in modified)
+    lines.extend('Custom field {} removed'.format(item['CUSTOM_FIELD_ID'])
+                 for item in removed)
+    return '\n'.join(lines)
+
+
+def tags_change(old, new, name):
+    added, removed, _ = diff_collection('TAGS', old, new)
+    lines = []
+    if added:
+        lines.append('Tags added: {}'.format(
+            ', '.join(item['TAG_NAME'] for item in added)))
+    if removed:
+        lines.append('Tags removed: {}'.format(
+            ', '.join(item['TAG_NAME'] for item in removed)))
+    return '\n'.join(lines)
+
+
+# Linked records of the LINKS items: id field and its label.
+LINK_TARGETS = (
+    ('CONTACT_ID', 'contact'),
+    ('ORGANISATION_ID', 'organisation'),
+    ('PROJECT_ID', 'project'),
+    ('SECOND_OPPORTUNITY_ID', 'opportunity'),
+)
+
+
+def describe_link(link):
+    """
+    Return text of the LINKS item, e.g. 'contact 12 (Buyer)'.
+    """
+    text = 'link {}'.format(link.get('LINK_ID'))
+    for field, label in LINK_TARGETS:
+        if link.get(field):
+            text = '{} {}'.format(label, link[field])
+            break
+    if link.get('ROLE'):
+        text += ' ({})'.format(link['ROLE'])
+    return text
+
+
+def links_change(label, field, describe):
+    """
+    Return formatter of added, changed and removed links of the field.
+    """
+    def formatter(old, new, name):
+        added, removed, modified = diff_collection(field, old, new)
+        lines = ['{} added: {}'.format(label, describe(item))
+                 for item in added]
+        lines.extend('{} changed: {}'.format(label, describe(item))
+                     for _, item in modified)
+        lines.extend('{} removed: {}'.format(label, describe(item))
+                     for item in removed)
+        return '\n'.join(lines)
+    return formatter
+
+
+# Changes reported by render_changed_message(), in message order: (fields,
+# formatter). Change is reported if the first field differs from the local
+# copy and is not reported yet, so stage change is reported with pipeline
+# change. Referenced items of the fields are resolved in both records.
+FIELD_CHANGES = (
+    (('PROBABILITY',), value_change('Probability', 'PROBABILITY')),
+    (('BID_AMOUNT',), value_change('Bid amount', 'BID_AMOUNT')),
+    (('BID_CURRENCY',), value_change('Bid currency', 'BID_CURRENCY')),
+    (('OPPORTUNITY_STATE',), value_change('State', 'OPPORTUNITY_STATE')),
+    (('PIPELINE_ID', 'STAGE_ID'), pipeline_change),
+    (('STAGE_ID',), reference_change('Stage', 'STAGE_ID')),
+    (('CATEGORY_ID',), reference_change('Category', 'CATEGORY_ID')),
+    (('RESPONSIBLE_USER_ID',),
+     lambda old, new, name: 'Responsible user changed'),
+    (('FORECAST_CLOSE_DATE',),
+     value_change('Forecast close date', 'FORECAST_CLOSE_DATE')),
+    (('ACTUAL_CLOSE_DATE',),
+     value_change('Actual close date', 'ACTUAL_CLOSE_DATE')),
+    (('CUSTOMFIELDS',), custom_fields_change),
+    (('TAGS',), tags_change),
+    (('LINKS',), links_change('Link', 'LINKS', describe_link)),
+    (('EMAILLINKS',),
+     links_change('Email link', 'EMAILLINKS',
+                  lambda item: 'email {}'.format(item.get('EMAIL_ID')))),
+)
+
+
+def field_changes(opp, local_opp):
+    """
+    Return FIELD_CHANGES entries of the opportunity changed since the local
+    copy. Fields missing in local copies stored by previous versions are
+    not compared.
+    """
+    changed = set(x for x in SNAPSHOT_FIELDS
+                  if x in local_opp and
+                  field_differs(x, opp.get(x), local_opp[x]))
+    reported = set()
+    entries = []
+    for fields, formatter in FIELD_CHANGES:
+        if fields[0] in changed and fields[0] not in reported:
+            reported.update(fields)
+            entries.append((fields, formatter))
+    return entries
+
+
+def reference_paths(opp, local_opp=None):
+    """
+    Return paths of users, categories, pipelines and stages needed to render
+    message about new opportunity, or changed one if local_opp is given.
+    Paths are unique and in order of use.
+    """
+    if local_opp is None:
+        references = [(opp, 'CATEGORY_ID')]
+    else:
+        references = [(record, field)
+                      for fields, _ in field_changes(opp, local_opp)
+                      for record in (local_opp, opp)
+                      for field in fields if field in REFERENCE_NAMES]
+
+    paths = []
+    if opp.get('RESPONSIBLE_USER_ID'):
+        paths.append('/users/{}'.format(opp['RESPONSIBLE_USER_ID']))
+
+    templates = dict((field, item_path) for _, field, item_path
+                     in REFERENCE_COLLECTIONS if field != 'USER_ID')
+    for record, field in references:
+        if record.get(field):
+            path = templates[field].format(record[field])
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+def resolve_references(paths, cache, client):
+    """
+    Return dict of path to referenced item fetched through the cache.
+    """
+    return dict((path, cache.get(path, client)) for path in paths)
+
+
+def map_concurrently(func, items, concurrency=None):
+    """
+    Call func for each item using bounded thread pool. Return list of
+    results in the same order as items.
+
+    concurrency is maximum number of threads, by default
+    ENRICH_CONCURRENCY from config. Items are processed one by one in the
+    current thread if it is 1.
+    """
+    if concurrency is None:
+        concurrency = getattr(config, 'ENRICH_CONCURRENCY', 4)
+
+    items = list(items)
+    if concurrency <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(func, items))
+
+
+def render_new_message(opp, cache, client):
+    """
+    Fetch responsible user and category of the new opportunity.
+    Return slack message text.
+    """
+    # Fetch responsible user info.
+    if opp['RESPONSIBLE_USER_ID']:
+        userdata = cache.get(
+            '/users/{}'.format(opp['RESPONSIBLE_USER_ID']), client)
+        opp['RESPONSIBLE_USER'] = ('{FIRST_NAME} {LAST_NAME} '
+                                   '{EMAIL_ADDRESS}'.format(**userdata))
+    else:
+        opp['RESPONSIBLE_USER'] = None
+
+    # Fetch category info.
+    if opp['CATEGORY_ID']:
+        category = cache.get(
+            '/OpportunityCategories/{}'.format(opp['CATEGORY_ID']), client)
+        opp['CATEGORY'] = category['CATEGORY_NAME']
+    else:
+        opp['CATEGORY'] = None
+
+    # The message template to send to slack.
+    return dedent(NEW_MESSAGE.format(**opp))
+
+
+def opportunity_digest(opp):
+    """
+    Return stable digest of the full opportunity record. Order of items of
+    COLLECTION_KEYS fields does not change the digest.
+    """
+    normalized = dict(opp)
+    for field in COLLECTION_KEYS:
+        if opp.get(field):
+            normalized[field] = sorted(json.dumps(item, sort_keys=True)
+                                       for item in opp[field])
+    content = json.dumps(normalized, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def make_snapshot(opp):
     """
-    Fetch changed opportunities using insightly api.
-    Send slack message on each changed opportunity.
+    Return compact local copy of the opportunity: SNAPSHOT_FIELDS and
+    DIGEST of the full record. Should be called before the opportunity is
+    enriched by render_*_message().
     """
-    db = shelve.open('db.shelve')
+    snapshot = dict((x, opp.get(x)) for x in SNAPSHOT_FIELDS)
+    snapshot['DIGEST'] = opportunity_digest(opp)
+    return snapshot
+
+
+def is_changed(opp, local_opp, notes):
+    """
+    Return True if opportunity differs from local copy or opportunity has
+    new notes.
+    """
+    # Insightly seems to cache the response list and we can get
+    # false positives, so opportunity content is compared.
+    if notes:
+        return True
+    if 'DIGEST' in local_opp:
+        return opportunity_digest(opp) != local_opp['DIGEST']
+
+    # Full local copy stored by previous versions.
+    return any(field_differs(x, opp.get(x), local_opp.get(x)) for x in opp)
+
+
+def render_changed_message(opp, local_opp, notes, cache, client):
+    """
+    Compare opportunity with local copy, fetch names of changed users,
+    categories, pipelines and stages. Return slack message text or None if
+    there are no changes worth a message.
+    """
+    entries = field_changes(opp, local_opp)
+    items = resolve_references(reference_paths(opp, local_opp), cache,
+                               client)
+    templates = dict((field, item_path) for _, field, item_path
+                     in REFERENCE_COLLECTIONS)
+
+    def name(record, field):
+        """
+        Return name of the item referenced by the record field.
+        """
+        if not record[field]:
+            return REFERENCE_NAMES[field][1]
+        item = items[templates[field].format(record[field])]
+        return item[REFERENCE_NAMES[field][0]]
+
+    # Responsible user info.
+    if opp['RESPONSIBLE_USER_ID']:
+        opp['RESPONSIBLE_USER'] = (
+            '{FIRST_NAME} {LAST_NAME} {EMAIL_ADDRESS}'.format(
+                **items['/users/{}'.format(opp['RESPONSIBLE_USER_ID'])]))
+    else:
+        opp['RESPONSIBLE_USER'] = None
+
+    # Formatter returns empty text if the change is not worth a message.
+    lines = [formatter(local_opp, opp, name) for _, formatter in entries]
+    changes = [line + '\n' for line in lines if line]
 
-    auth = (config.INSIGHTLY_API_KEY, '')
+    for note in notes or ():
+        body = re.sub('<.*?>', '', note['BODY']).strip()
+        changes.append('New note added: {}\nText: {}\n'
+                       .format(note['TITLE'], body))
 
-    now = datetime.utcnow()
+    if not changes:
+        return None
 
-    if 'changed_opportunities_last_poll_time' not in db:
-        db['changed_opportunities_last_poll_time'] = now
+    message = CHANGED_MESSAGE.format(changes='\n'.join(changes), **opp)
+    return dedent(message).strip()
+
+
+def render_deleted_message(local_opp):
+    """
+    Return slack message text about deleted opportunity.
+    """
+    return dedent(DELETED_MESSAGE.format(**local_opp))
+
+
+# Watermarks: kind of the server date and name of the watermark set to the
+# latest date of the kind seen.
+WATERMARKS = (
+    ('created', 'last_poll'),
+    ('updated', 'changed_opportunities_last_poll_time'),
+    ('note', 'notes_last_poll'),
+)
+
+
+class SeenUpdates(object):
+    """
+    Latest server dates of created and updated opportunities and created
+    notes seen during the run, used to advance watermarks, and bounded set of
+    recently seen (kind, id, date) updates, so items fetched again because
+    of the watermark overlap are not reported twice. The oldest entries are
+    evicted when there are more than max_size of them.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.keys = OrderedDict()
+        # Mapping of kind to the latest date string seen.
+        self.latest = {}
+
+    def observe(self, kind, date):
+        """
+        Record server date of the kind.
+        """
+        # Insightly dates are compared as strings, e.g. '2016-03-28 13:11:50'.
+        if date and date > self.latest.get(kind, ''):
+            self.latest[kind] = date
+
+    def add(self, kind, item_id, date):
+        """
+        Record update of the item. Return False if it was seen already.
+        """
+        self.observe(kind, date)
+        key = '{}:{}:{}'.format(kind, item_id, date)
+        if key in self.keys:
+            return False
+        self.keys[key] = None
+        while len(self.keys) > self.max_size:
+            self.keys.popitem(last=False)
+        return True
+
+    def load(self, store):
+        self.keys = OrderedDict((key, None)
+                                for key in store.get_seen_updates())
+
+    def save(self, store):
+        store.set_seen_updates(self.keys)
+
+
+def load_seen_updates(store):
+    """
+    Create SeenUpdates using config and load it from the store.
+    """
+    seen = SeenUpdates(max_size=getattr(config, 'SEEN_UPDATES_SIZE', 10000))
+    seen.load(store)
+    return seen
+
+
+def watermark_since(watermark, now):
+    """
+    Return datetime to fetch items since: the watermark moved back by
+    WATERMARK_OVERLAP seconds, so items which appear in insightly responses
+    late are fetched again. Return now if there is no watermark yet.
+    """
+    if watermark is None:
+        return now
+    return watermark - timedelta(
+        seconds=getattr(config, 'WATERMARK_OVERLAP', 300))
+
+
+def init_watermarks(store):
+    """
+    Return dict of stored watermarks by name, None for the missing ones on
+    the first launch. Nothing is stored until advance_watermarks(), so a
+    sync doesn't start its write transaction before fetching.
+    """
+    if store.get_watermark('last_poll') is None:
         logging.info('*** insightly_notify is launched first time, previously '
-                     'changed opportunities are ignored.')
+                     'created opportunities are ignored.')
 
-    last_poll = (db['changed_opportunities_last_poll_time']
-                 .strftime('%Y-%m-%dT%H:%M:%S'))
+    watermarks = dict((name, store.get_watermark(name))
+                      for _, name in WATERMARKS)
+    # Notes shared the watermark with changed opportunities.
+    if watermarks['notes_last_poll'] is None:
+        watermarks['notes_last_poll'] = (
+            watermarks['changed_opportunities_last_poll_time'])
 
-    changed_opportunities = insightly_get(
-        '/opportunities?$filter=DATE_UPDATED_UTC%20gt%20DateTime\'{}\''
-        .format(last_poll),
-        auth
-    )
+    return watermarks
 
-    new_notes = insightly_get(
-        '/notes?$filter=DATE_CREATED_UTC%20gt%20DateTime\'{}\''
-        .format(last_poll),
-        auth
-    )
-    opportunities_with_new_notes = defaultdict(list)
 
-    for note in new_notes:
-        for link in note['NOTELINKS']:
-            if link.get('OPPORTUNITY_ID'):
-                opp_id = link.get('OPPORTUNITY_ID')
-                opportunities_with_new_notes[opp_id].append(note)
+def advance_watermarks(store, seen, watermarks, now):
+    """
+    Store watermarks moved to the latest server dates seen, now for the
+    missing ones. Watermarks never move back, so the local clock is used
+    only on the first launch.
+    """
+    for kind, name in WATERMARKS:
+        watermark = watermarks[name] or now
+        if kind in seen.latest:
+            watermark = max(watermark, parse_date(seen.latest[kind]))
+        store.set_watermark(name, watermark)
 
-    db['changed_opportunities_last_poll_time'] = now
 
-    for opp in copy(changed_opportunities):
-        # Assign LOCAL_ID to opportunity.
-        opp['LOCAL_ID'] = 'opportunity_%s' % opp['OPPORTUNITY_ID']
+def is_listed_unchanged(opp, local_opp, notes):
+    """
+    Return True if opportunity from SYNC_LISTING_PATH listing has the same
+    DATE_UPDATED_UTC as local copy and has no new notes, so its full record
+    doesn't need to be fetched.
+    """
+    return (local_opp is not None and not notes and
+            local_opp.get('DATE_UPDATED_UTC') == opp['DATE_UPDATED_UTC'])
 
-        # Clear list from new opportunities, we only handle changed ones here.
-        if opp['LOCAL_ID'] not in db:
-            # This is new opportunitiy, add to the local database and
-            # remove from changed list.
-            db[opp['LOCAL_ID']] = opp
-            changed_opportunities.remove(opp)
-        else:
-            local_opp = db[opp['LOCAL_ID']]
-
-            # Make list of changed fields.
-            changed_fields = [x for x in opp if opp.get(x) != local_opp.get(x)]
-
-            nnotes = opp['OPPORTUNITY_ID'] not in opportunities_with_new_notes
-            if not changed_fields and nnotes:
-                # This opportunity is not really changed.
-                # Insightly seems to cache the response list and we can get
-                # false positives. Remove this opportunity from changed list.
-                changed_opportunities.remove(opp)
-
-    logging.info('{} changed opportunities found.'
-                 .format(len(changed_opportunities)))
-
-    for opp in changed_opportunities:
-        local_opp = db[opp['LOCAL_ID']]
-
-        # Fetch responsible user info.
-        if opp['RESPONSIBLE_USER_ID']:
-            userdata = insightly_get(
-                '/users/{}'.format(opp['RESPONSIBLE_USER_ID']), auth)
-            opp['RESPONSIBLE_USER'] = ('{FIRST_NAME} {LAST_NAME} '
-                                       '{EMAIL_ADDRESS}'.format(**userdata))
-        else:
-            opp['RESPONSIBLE_USER'] = None
-
-        # Make list of changed fields.
-        changed_fields = [x for x in opp if opp.get(x) != local_opp.get(x)]
-
-        changes = []
-        if 'PROBABILITY' in changed_fields:
-            changes.append(
-                'Probability changed from {} to {}\n'
-                .format(local_opp['PROBABILITY'], opp['PROBABILITY']))
-        if 'BID_AMOUNT' in changed_fields:
-            changes.append('Bid amount changed from {} to {}\n'
-                           .format(local_opp['BID_AMOUNT'], opp['BID_AMOUNT']))
-        if 'BID_CURRENCY' in changed_fields:
-            changes.append(
-                'Bid currency changed from {} to {}\n'
-                .format(local_opp['BID_CURRENCY'], opp['BID_CURRENCY']))
-        if 'OPPORTUNITY_STATE' in changed_fields:
-            changes.append('State changed from {} to {}\n'
-                           .fromat(local_opp['OPPORTUNITY_STATE'],
-                                   opp['OPPORTUNITY_STATE']))
-        if 'PIPELINE_ID' in changed_fields:
-            if local_opp['PIPELINE_ID']:
-                old_pipeline = insightly_get(
-                    '/Pipelines/{}'.format(local_opp['PIPELINE_ID']), auth)
-            else:
-                old_pipeline = {'PIPELINE_NAME': 'No pipeline'}
-            if local_opp['STAGE_ID']:
-                old_stage = insightly_get(
-                    '/PipelineStages/{}'.format(local_opp['STAGE_ID']), auth)
-            else:
-                old_stage = {'STAGE_NAME': 'No stage'}
-            if opp['PIPELINE_ID']:
-                pipeline = insightly_get(
-                    '/Pipelines/{}'.format(opp['PIPELINE_ID']), auth)
-                if opp['STAGE_ID']:
-                    stage = insightly_get(
-                        '/PipelineStages/{}'.format(opp['STAGE_ID']), auth)
-                else:
-                    stage = {'STAGE_NAME': 'No stage'}
-                changes.append(
-                    'Pipeline changed from {} ({}) to {} ({})\n'
-                    .format(old_pipeline['PIPELINE_NAME'],
-                            old_stage['STAGE_NAME'], pipeline['PIPELINE_NAME'],
-                            stage['STAGE_NAME']))
-            else:
-                changes.append('Pipeline changed from {} ({}) to None\n'
-                               .format(old_pipeline['PIPELINE_NAME'],
-                                       old_stage['STAGE_NAME']))
-        elif 'STAGE_ID' in changed_fields:
-            if local_opp['STAGE_ID']:
-                old_stage = insightly_get(
-                    '/PipelineStages/{}'.format(local_opp['STAGE_ID']), auth)
-            else:
-                old_stage = {'STAGE_NAME': 'No stage'}
-            if opp['STAGE_ID']:
-                stage = insightly_get('/PipelineStages/' + opp['STAGE_ID'],
-                                      auth)
-                changes.append('Stage changed from {} to {}\n'
-                               .format(old_stage['STAGE_NAME'],
-                                       stage['STAGE_NAME']))
-            else:
-                changes.append('Stage changed from {} to None\n'
-                               .format(old_stage['STAGE_NAME']))
-        elif 'CATEGORY_ID' in changed_fields:
-            if local_opp['CATEGORY_ID']:
-                old_category = insightly_get(
-                    '/PipelineStages/{}'.format(local_opp['CATEGORY_ID']),
-                    auth)
-            else:
-                old_category = {'STAGE_NAME': 'No stage'}
-            if opp['CATEGORY_ID']:
-                category = insightly_get(
-                    '/OpportunityCategories/{}'.format(opp['CATEGORY_ID']),
-                    auth)
-                changes.append('Category changed from {} to {}\n'
-                               .format(old_category['CATEGORY_NAME'],
-                                       category['CATEGORY_NAME']))
-            else:
-                changes.append('Category changed from {} to None\n'
-                               .format(old_category['CATEGORY_NAME']))
-        elif 'RESPONSIBLE_USER_ID' in changed_fields:
-            changes.append('Responsible user changed\n')
-
-        notes = opportunities_with_new_notes.get(opp['OPPORTUNITY_ID'])
-        if notes is not None:
-            for note in notes:
-                body = re.sub('<.*?>', '', note['BODY']).strip()
-                changes.append('New note added: {}\nText: {}\n'
-                               .format(note['TITLE'], body))
-
-        # Send message to slack.
-        if changes:
-            message = CHANGED_MESSAGE.format(changes='\n'.join(changes), **opp)
-            slack_post(config.SLACK_CHANNEL_URL,
-                       json={'text': dedent(message).strip()})
+
+def sync_listing_path(last_poll, budget=None, reconcile=True):
+    """
+    Return tuple (listing path, True if listing is full). Full listing is
+    needed to find deleted opportunities, it is used if reconcile is True
+    and api budget is not low. Otherwise only opportunities updated since
+    the last poll are listed and deleted ones are found by a later run.
+    """
+    if reconcile:
+        if budget is None or not budget.low():
+            return SYNC_LISTING_PATH, True
+        logging.warning('Api budget is low, search of deleted opportunities '
+                        'is deferred.')
+
+    return ('{}&$filter=DATE_UPDATED_UTC%20gt%20DateTime\'{}\''
+            .format(SYNC_LISTING_PATH,
+                    last_poll.strftime('%Y-%m-%dT%H:%M:%S')), False)
+
+
+# Kinds of slack messages in order they are sent by a sync.
+MESSAGE_KINDS = ('new', 'changed', 'deleted')
+
+
+class SyncRun(object):
+    """
+    Comparison of opportunities fetched by a single sync with their local
+    copies, shared by sync_opportunities() and the asyncio pipeline.
+
+    Opportunities of the listing are passed to listed(), full records of the
+    ones it selects to fetched(). Opportunities missing in the full listing,
+    deletion_candidates(), are fetched again by ids and the result is passed
+    to deleted(), which returns local copies of deleted opportunities. Then
+    finish() puts messages to the outbox and updates the state store.
+    """
+
+    def __init__(self, store, now):
+        self.store = store
+        self.now = now
+        self.watermarks = init_watermarks(store)
+        self.last_poll, self.updated_last_poll, self.notes_last_poll = (
+            watermark_since(self.watermarks[name], now)
+            for _, name in WATERMARKS)
+        self.seen = load_seen_updates(store)
+        # Mapping of opportunity id to its new notes, see fetch_new_notes().
+        self.notes = {}
+        self.full_listing = False
+        # Ids of listed opportunities which have local copies. Ids are not
+        # known until full records are fetched, so opportunity listed but
+        # not returned by ids request is fetched again by the next sync.
+        self.server_ids = set()
+        self.deleted_ids = set()
+        # Mapping of opportunity id to its new local copy. Copies are stored
+        # by finish(), so the store isn't written while fetching.
+        self.snapshots = {}
+
+    def listing_path(self, budget=None, reconcile=True):
+        """
+        Return path of the opportunities listing, see sync_listing_path().
+        """
+        path, self.full_listing = sync_listing_path(self.updated_last_poll,
+                                                    budget, reconcile)
+        return path
+
+    def listed(self, opp):
+        """
+        Record opportunity of the listing. Return True if its full record
+        should be fetched.
+        """
+        self.seen.observe('created', opp.get('DATE_CREATED_UTC'))
+        self.seen.observe('updated', opp['DATE_UPDATED_UTC'])
+        local_opp = self.store.get_opportunity(opp['OPPORTUNITY_ID'])
+        if local_opp is not None:
+            self.server_ids.add(opp['OPPORTUNITY_ID'])
+        return not is_listed_unchanged(opp, local_opp,
+                                       self.notes.get(opp['OPPORTUNITY_ID']))
+
+    def fetched(self, opp):
+        """
+        Compare full record with the local copy and update the copy. Return
+        tuple (kind of message or None, local copy, new notes).
+        """
+        local_opp = self.store.get_opportunity(opp['OPPORTUNITY_ID'])
+        notes = self.notes.get(opp['OPPORTUNITY_ID'])
+        kind = None
+        if local_opp is None:
+            if (parse_date(opp['DATE_CREATED_UTC']) > self.last_poll and
+                    self.seen.add('created', opp['OPPORTUNITY_ID'],
+                                  opp['DATE_CREATED_UTC'])):
+                kind = 'new'
+        elif is_changed(opp, local_opp, notes):
+            kind = 'changed'
 
         # Update local opportunity.
-        db[opp['LOCAL_ID']] = opp
+        self.snapshots[opp['OPPORTUNITY_ID']] = make_snapshot(opp)
+        self.server_ids.add(opp['OPPORTUNITY_ID'])
+        return kind, local_opp, notes
+
+    def deletion_candidates(self):
+        """
+        Return sorted ids of known opportunities missing in the full listing.
+        """
+        if not self.full_listing:
+            return []
+        return sorted(self.store.get_opportunities_ids()
+                      .difference(self.server_ids))
+
+    def deleted(self, returned=()):
+        """
+        Return local copies of deletion candidates which are not in returned,
+        opportunities fetched by ids of the candidates. Listing misses
+        opportunities if its pages shift during the listing or the server
+        caps $top, so only the ones the server doesn't return by ids are
+        deleted. Deleted opportunities without local copies are skipped.
+        """
+        self.deleted_ids = set(self.deletion_candidates())
+        for opp in returned:
+            self.deleted_ids.discard(opp['OPPORTUNITY_ID'])
+            if self.store.get_opportunity(opp['OPPORTUNITY_ID']) is None:
+                self.snapshots[opp['OPPORTUNITY_ID']] = make_snapshot(opp)
+            self.server_ids.add(opp['OPPORTUNITY_ID'])
+
+        deleted = []
+        for opp_id in sorted(self.deleted_ids):
+            local_opp = self.store.get_opportunity(opp_id)
+            if local_opp is None:
+                logging.warning('Opportunity {} was deleted, but it has no '
+                                'local copy to report.'.format(opp_id))
+            else:
+                deleted.append(local_opp)
+        return deleted
+
+    def finish(self, messages, account=None):
+        """
+        Put messages, list of (kind, opportunity, text), to the outbox in
+        order of MESSAGE_KINDS and update local copies, list of
+        opportunities ids and watermarks, all in the same transaction. It is
+        called after all fetching and rendering, so the write transaction
+        isn't held during http requests.
+        """
+        messages = sorted(messages, key=lambda x: MESSAGE_KINDS.index(x[0]))
+        counts = dict((kind, len([x for x in messages if x[0] == kind and
+                                  x[2]]))
+                      for kind in MESSAGE_KINDS)
+        logging.info('{new} new, {changed} changed, {deleted} deleted '
+                     'opportunities found.'.format(**counts))
+        for kind, count in counts.items():
+            metrics.inc('opportunities_total', {'kind': kind}, count)
+
+        for kind, opp, message in messages:
+            enqueue_message(self.store, kind, opp, message, account)
+
+        for snapshot in self.snapshots.values():
+            self.store.put_opportunity(snapshot)
+
+        # Update local list of existing opportunities ids. Partial listing
+        # only adds ids, so new opportunities are found deleted by the next
+        # full listing.
+        if self.full_listing:
+            self.store.set_opportunities_ids(self.server_ids)
+        else:
+            self.store.set_opportunities_ids(
+                self.store.get_opportunities_ids() | self.server_ids)
+
+        # Delete not needed details of deleted opportunities.
+        for opp_id in self.deleted_ids:
+            self.store.delete_opportunity(opp_id)
+
+        advance_watermarks(self.store, self.seen, self.watermarks, self.now)
+        self.seen.save(self.store)
 
 
-def notify_deleted_opportunities():
+@metrics.timed('sync')
+def sync_opportunities(client, store, prefetched=None, budget=None,
+                       reconcile=True, cache=None, deliver=True,
+                       account=None):
+    """
+    Fetch opportunities once and compare them with local copies in a single
+    pass. Send slack message on each new, changed and deleted opportunity.
+    Details of deleted opportunities are known only from their local copies,
+    which are updated by each sync.
+
+    Only ids and dates of all opportunities are fetched. Full records are
+    fetched for new opportunities and the ones with changed DATE_UPDATED_UTC
+    or new notes.
+
+    prefetched is optional result of prefetch_reference_data(), budget is
+    optional ApiBudget used to defer call-heavy work. If reconcile is False,
+    only opportunities updated since the last poll are fetched and deleted
+    ones are not searched. cache is optional ReferenceCache kept between
+    calls, prefetched is ignored if it is given.
+
+    Messages are put to the outbox of the state store, routed to slack
+    channels by account (see Account.channels()), by default the one of top
+    level config. If deliver is True, the store is committed and the outbox
+    is delivered to slack.
+    """
+    run = SyncRun(store, datetime.utcnow())
+    run.notes = fetch_new_notes(client, run.notes_last_poll, run.seen)
+
+    # Full records, returned if api ignores $select, and ids of
+    # opportunities which full records should be fetched.
+    candidates = []
+    candidates_ids = []
+
+    for opp in insightly_iter(run.listing_path(budget, reconcile), client):
+        if not run.listed(opp):
+            continue
+        if 'OPPORTUNITY_NAME' in opp:
+            candidates.append(opp)
+        else:
+            candidates_ids.append(opp['OPPORTUNITY_ID'])
+
+    if cache is None:
+        cache = make_reference_cache(store, prefetched, budget)
+
+    new = []
+    # List of (opportunity, local copy, new notes).
+    changed = []
+
+    for opp in chain(candidates, insightly_iter_ids('/opportunities',
+                                                    candidates_ids, client)):
+        kind, local_opp, notes = run.fetched(opp)
+        if kind == 'new':
+            new.append(opp)
+        elif kind == 'changed':
+            changed.append((opp, local_opp, notes))
+
+    # Users, categories, pipelines and stages are fetched concurrently.
+    with metrics.phase('render'):
+        new_messages = map_concurrently(
+            lambda opp: render_new_message(opp, cache, client), new)
+        changed_messages = map_concurrently(
+            lambda item: render_changed_message(item[0], item[1], item[2],
+                                                cache, client),
+            changed)
+
+    # Messages are put to the outbox in the same transaction as state
+    # updates.
+    run.finish(
+        [('new', opp, message) for opp, message in zip(new, new_messages)] +
+        [('changed', item[0], message)
+         for item, message in zip(changed, changed_messages)] +
+        [('deleted', local_opp, render_deleted_message(local_opp))
+         for local_opp in run.deleted(insightly_iter_ids(
+             '/opportunities', run.deletion_candidates(), client))],
+        account)
+    cache.save()
+
+    if deliver:
+        deliver_outbox(store, make_slack_sender(client, account))
+
+
+class Daemon(object):
+    """
+    Keep the process running and sync opportunities periodically with warm
+    http connections, reference cache and open state store.
+
+    Opportunities updated since the last poll are synced every poll_interval
+    seconds, full listing used to find deleted opportunities is fetched every
+    reconcile_interval seconds. Intervals are extended if api budget doesn't
+    allow so frequent cycles. Changes of each cycle are committed at once.
+
+    Outbox is delivered by optional OutboxWorker, or after each cycle if
+    worker is None. stopping is optional threading.Event shared by daemons
+    of several accounts and set by stop_handler(), account is the synced
+    Account.
+    """
+
+    def __init__(self, client, store, budget, poll_interval=300,
+                 reconcile_interval=3600, prefetch=True, clock=time.time,
+                 worker=None, stopping=None, account=None):
+        self.client = client
+        self.store = store
+        self.budget = budget
+        self.poll_interval = poll_interval
+        self.reconcile_interval = reconcile_interval
+        self.prefetch = prefetch
+        self.clock = clock
+        self.worker = worker
+        self.cache = make_reference_cache(store, budget=budget)
+        self.next_reconcile = clock()
+        self.stopping = stopping or threading.Event()
+        self.account = account
+
+    def run(self):
+        logging.info('*** Daemon started.')
+        while not self.stopping.is_set():
+            reconcile = self.clock() >= self.next_reconcile
+            if reconcile:
+                self.next_reconcile = self.clock() + self.reconcile_interval
+
+            calls = self.budget.run_calls()
+            self.cycle(reconcile)
+            self.stopping.wait(self.delay(self.budget.run_calls() - calls))
+        logging.info('*** Daemon stopped.')
+
+    def cycle(self, reconcile):
+        """
+        Run single sync. Errors are logged, so the next cycle can retry.
+        """
+        try:
+            # Reference data is refreshed with the full listing.
+            if reconcile and self.prefetch and not self.budget.low():
+                self.cache.prefetched = prefetch_reference_data(self.client)
+            sync_opportunities(self.client, self.store, budget=self.budget,
+                               reconcile=reconcile, cache=self.cache,
+                               deliver=self.worker is None,
+                               account=self.account)
+            self.store.commit()
+            if self.worker is not None:
+                self.worker.wake()
+        except Exception as e:
+            logging.exception('Sync failed: {}'.format(e))
+            self.store.rollback()
+        finally:
+            self.budget.save(self.store)
+            if self.client.response_cache is not None:
+                self.client.response_cache.save(self.store)
+            self.store.commit()
+            self.budget.log_stats()
+            self.budget.calls.clear()
+            export_metrics()
+
+    def delay(self, calls):
+        """
+        Return seconds to wait before the next cycle which made given
+        number of api calls.
+        """
+        interval = self.budget.poll_interval(calls) or 0
+        return max(self.poll_interval, interval)
+
+
+def stop_handler(stopping):
     """
-    Fetch all opportunities using insightly api. Compare with local copy.
-    Send slack message on each deleted opportunity.
+    Return signal handler which stops daemons sharing stopping event after
+    their current cycles.
+    """
+    def stop(*args):
+        logging.info('*** Stopping daemon.')
+        stopping.set()
+    return stop
+
 
-    NOTE: Details of the deleted opportunity can only be known from local db.
-    These details should be periodically updated
-    using notify_changed_opportunities() function. So periodically running
-    script should always run both functions, as done in the main().
+def run_account_daemon(client, account, stopping):
     """
-    db = shelve.open('db.shelve')
+    Run daemon of the account until stopping event is set. The account has
+    its own api budget, response cache and state store, connection pools are
+    shared with other accounts by the http client view.
+    """
+    budget = make_api_budget(account)
+    response_cache = make_response_cache()
+    client = client.view(insightly_auth(account), budget, response_cache)
 
-    auth = (config.INSIGHTLY_API_KEY, '')
+    worker = None
+    try:
+        with open_store(account) as store:
+            budget.load(store)
+            if response_cache is not None:
+                response_cache.load(store)
+
+            # Worker opens its own connection after the store is created or
+            # migrated from shelve. Shelve can't be opened twice, so it is
+            # delivered by the daemon itself.
+            if getattr(config, 'STATE_STORE', 'sqlite') == 'sqlite':
+                worker = OutboxWorker(
+                    lambda: open_store(account, timeout=OUTBOX_LOCK_TIMEOUT),
+                    make_slack_sender(client, account))
+                worker.start()
+
+            daemon = Daemon(
+                client, store, budget,
+                poll_interval=getattr(config, 'DAEMON_POLL_INTERVAL', 300),
+                reconcile_interval=getattr(
+                    config, 'DAEMON_RECONCILE_INTERVAL', 3600),
+                prefetch=getattr(config, 'PREFETCH_REFERENCE_DATA', True),
+                worker=worker, stopping=stopping, account=account)
+            daemon.run()
+    finally:
+        if worker is not None:
+            worker.stop()
+
+
+def daemon_main():
+    configure()
+    accounts = load_accounts()
+    client = make_client()
+    stopping = threading.Event()
+    stop = stop_handler(stopping)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
 
-    if 'opportunities_ids' not in db:
-        db['opportunities_ids'] = set()
+    server = None
+    if getattr(config, 'METRICS_PORT', None):
+        server = start_metrics_server(config.METRICS_PORT)
 
-    server_opportunities = insightly_get('/opportunities', auth)
+    try:
+        if len(accounts) == 1:
+            run_account_daemon(client, accounts[0], stopping)
+        else:
+            threads = [threading.Thread(target=run_account_daemon,
+                                        args=(client, account, stopping),
+                                        name='account-' + account.name)
+                       for account in accounts]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            # Signals are handled by the main thread between the joins.
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(1)
+    finally:
+        stopping.set()
+        if server is not None:
+            server.shutdown()
+
+        opened, reused = client.connection_stats()
+        logging.info('{} connections opened, {} connections reused.'
+                     .format(opened, reused))
+        client.close()
+
+
+def sync_account(client, account, sync=None, budget=None):
+    """
+    Single sync run of the account with its own api budget, response cache
+    and state store. client is view of the shared http client. sync is
+    called as sync(client, store, prefetched, budget=budget,
+    account=account), by default it is sync_opportunities().
+    """
+    sync = sync or sync_opportunities
+    budget = budget or make_api_budget(account)
+    response_cache = make_response_cache()
+    with open_store(account) as store:
+        budget.load(store)
+        if response_cache is not None:
+            response_cache.load(store)
+
+    client = client.view(insightly_auth(account), budget, response_cache)
+    try:
+        # Cached reference data is used instead when budget is low.
+        prefetched = None
+        if (getattr(config, 'PREFETCH_REFERENCE_DATA', True) and
+                not budget.low()):
+            prefetched = prefetch_reference_data(client)
+
+        # All changes of the run are committed at once.
+        with open_store(account) as store:
+            sync(client, store, prefetched, budget=budget, account=account)
+    finally:
+        # Calls are counted even if the run failed.
+        with open_store(account) as store:
+            budget.save(store)
+            if response_cache is not None:
+                response_cache.save(store)
+        budget.log_stats()
+
+
+def run_account(account, sync=None, client=None):
+    """
+    Sync the account and return its result: dict of account name, time in
+    seconds, number of api calls and error message or None. Errors are
+    logged, not raised. client is the shared http client, account gets its
+    own one if it is None.
+    """
+    started = time.time()
+    budget = make_api_budget(account)
+    own_client = client is None
+    if own_client:
+        client = make_client(account=account)
+    error = None
+    try:
+        sync_account(client, account, sync, budget)
+    except Exception as e:
+        logging.exception('Sync of account {} failed: {}'
+                          .format(account.name, e))
+        error = str(e) or e.__class__.__name__
+    finally:
+        if own_client:
+            client.close()
+    return {'account': account.name, 'time': time.time() - started,
+            'api_calls': budget.run_calls(), 'error': error}
 
-    # Store locally opportunity details which was not known previously.
-    for opp in server_opportunities:
-        opp['LOCAL_ID'] = 'opportunity_%s' % opp['OPPORTUNITY_ID']
 
-        if opp['LOCAL_ID'] not in db:
-            db[opp['LOCAL_ID']] = opp
+def account_worker(name, sync, results):
+    """
+    Target of the worker process: sync the account with its own http client
+    and put the result with metrics of the process to results queue.
+    """
+    # Spawned processes don't inherit logging configuration.
+    if not logging.getLogger().handlers:
+        configure()
+    # Forked processes inherit metrics of the parent.
+    metrics.reset()
+    account = [account for account in load_accounts()
+               if account.name == name][0]
+    result = run_account(account, sync)
+    result['metrics'] = metrics.snapshot()
+    results.put(result)
+
+
+def run_parallel(accounts, sync=None, workers=2, timeout=None,
+                 target=account_worker):
+    """
+    Sync accounts in up to workers processes at once, one process per
+    account. Process running longer than timeout seconds is terminated,
+    its uncommitted changes are rolled back by the state store. Return
+    results of run_account() in order of accounts, crashed and terminated
+    processes are reported as errors. Metrics of the processes are merged.
+    """
+    import multiprocessing
+    try:
+        from queue import Empty
+    except ImportError:
+        from Queue import Empty
+
+    results = multiprocessing.Queue()
+    pending = list(accounts)
+    # Mapping of account name to (process, start time).
+    running = {}
+    finished = {}
+
+    def collect(wait):
+        try:
+            while True:
+                result = results.get(timeout=wait)
+                metrics.merge(result.pop('metrics'))
+                finished[result['account']] = result
+                wait = 0.001
+        except Empty:
+            pass
+
+    while pending or running:
+        while pending and len(running) < workers:
+            account = pending.pop(0)
+            process = multiprocessing.Process(
+                target=target, args=(account.name, sync, results),
+                name='account-' + account.name)
+            process.daemon = True
+            process.start()
+            running[account.name] = (process, time.time())
+
+        collect(0.1)
+        for name, (process, started) in list(running.items()):
+            elapsed = time.time() - started
+            if name not in finished and not process.is_alive():
+                # Result put right before the exit may be still queued.
+                collect(0.1)
+            if name in finished:
+                process.join()
+            elif not process.is_alive():
+                finished[name] = {
+                    'account': name, 'time': elapsed, 'api_calls': None,
+                    'error': 'worker process exited with code {}'
+                             .format(process.exitcode)}
+            elif timeout and elapsed > timeout:
+                process.terminate()
+                process.join()
+                finished[name] = {
+                    'account': name, 'time': elapsed, 'api_calls': None,
+                    'error': 'worker process terminated after {} seconds'
+                             .format(timeout)}
+            else:
+                continue
+            del running[name]
 
-    # Determine deleted ids.
-    server_opportunities_ids = set(x['OPPORTUNITY_ID'] for x in
-                                   server_opportunities)
-    deleted_opportunities_ids = (db['opportunities_ids']
-                                 .difference(server_opportunities_ids))
+    return [finished[account.name] for account in accounts]
 
-    logging.info('%d deleted opportunities found.'
-                 % len(deleted_opportunities_ids))
 
-    for opp_id in deleted_opportunities_ids:
-        local_id = 'opportunity_%s' % opp_id
+def report_results(results):
+    """
+    Log results of run_account() and record them in metrics. Return names
+    of failed accounts.
+    """
+    failed = []
+    for result in results:
+        labels = {'account': result['account']}
+        metrics.observe('account_sync_duration_seconds', result['time'],
+                        labels)
+        if result['error']:
+            metrics.inc('account_sync_errors_total', labels)
+            failed.append(result['account'])
+            logging.error('Account {account} failed after {time:.1f} '
+                          'seconds: {error}'.format(**result))
+        else:
+            logging.info('Account {account} synced in {time:.1f} seconds, '
+                         '{api_calls} api calls.'.format(**result))
+    return failed
 
-        message = DELETED_MESSAGE.format(**db[local_id])
 
-        # Send message to slack.
-        slack_post(config.SLACK_CHANNEL_URL, json={'text': dedent(message)})
+def run_once(sync=None):
+    """
+    Single sync run of all accounts, with http client and state stores
+    created from config. Up to ACCOUNT_WORKERS accounts are synced in
+    parallel worker processes, otherwise accounts are synced one by one
+    with shared http client. Failure of one account doesn't stop sync of
+    the others, failed ones are reported at the end.
+    """
+    accounts = load_accounts()
+    workers = min(getattr(config, 'ACCOUNT_WORKERS', 1), len(accounts))
+    client = None if workers > 1 else make_client()
+    try:
+        if workers > 1:
+            results = run_parallel(accounts, sync, workers,
+                                   getattr(config, 'ACCOUNT_TIMEOUT', 900))
+        elif len(accounts) == 1:
+            sync_account(client, accounts[0], sync)
+            results = []
+        else:
+            results = []
+            for account in accounts:
+                logging.info('*** Account {}.'.format(account.name))
+                results.append(run_account(account, sync, client))
+        failed = report_results(results)
+    finally:
+        export_metrics()
 
-    # Update local list of existing opportunities ids.
-    db['opportunities_ids'] = server_opportunities_ids
+        if client is not None:
+            opened, reused = client.connection_stats()
+            logging.info('{} connections opened, {} connections reused.'
+                         .format(opened, reused))
+            client.close()
 
-    # Delete not needed details of deleted opportunities.
-    for opp_id in deleted_opportunities_ids:
-        local_id = 'opportunity_%s' % opp_id
-        del db[local_id]
+    if failed:
+        raise Exception('Sync of accounts failed: {}'
+                        .format(', '.join(failed)))
 
 
 def main():
     configure()
-    notify_new_opportunities()
-    notify_changed_opportunities()
-    notify_deleted_opportunities()
+    run_once()
+
+
+class Profiler(object):
+    """
+    Collect wall time, peak memory and top allocation sites of each phase
+    (see Metrics.phase) using tracemalloc. Memory is not measured if
+    tracemalloc is not available (python 2).
+    """
+
+    def __init__(self, top=10):
+        self.top = top
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        self.tracemalloc = tracemalloc
+        # Entries of the running phases, innermost last.
+        self.stack = []
+        # Mapping of phase to dict of calls, wall time, peak memory and
+        # allocation statistics, in order of first call.
+        self.phases = OrderedDict()
+
+    def start(self):
+        if self.tracemalloc is not None:
+            self.tracemalloc.start(5)
+
+    def stop(self):
+        if self.tracemalloc is not None:
+            self.tracemalloc.stop()
+
+    def peak(self):
+        return self.tracemalloc.get_traced_memory()[1]
+
+    def snapshot(self):
+        """
+        Take snapshot without allocations of tracemalloc itself.
+        """
+        return self.tracemalloc.take_snapshot().filter_traces([
+            self.tracemalloc.Filter(False, self.tracemalloc.__file__),
+            self.tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+
+    def reset_peak(self):
+        # Available since python 3.9, global peak is reported before.
+        if hasattr(self.tracemalloc, 'reset_peak'):
+            self.tracemalloc.reset_peak()
+
+    def enter(self, name):
+        entry = {'peak': 0, 'snapshot': None}
+        if self.tracemalloc is not None and self.tracemalloc.is_tracing():
+            # Peak of the outer phase so far is kept before reset.
+            if self.stack:
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'],
+                                             self.peak())
+            self.reset_peak()
+            entry['snapshot'] = self.snapshot()
+        self.stack.append(entry)
+
+    def exit(self, name, seconds):
+        entry = self.stack.pop()
+        phase = self.phases.setdefault(
+            name, {'calls': 0, 'seconds': 0.0, 'peak': 0, 'stats': []})
+        phase['calls'] += 1
+        phase['seconds'] += seconds
+
+        if entry['snapshot'] is not None:
+            peak = max(entry['peak'], self.peak())
+            phase['peak'] = max(phase['peak'], peak)
+            if self.stack:
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+            phase['stats'] = self.snapshot().compare_to(
+                entry['snapshot'], 'lineno')[:self.top]
+
+    def report(self):
+        """
+        Return text report of the phases.
+        """
+        lines = []
+        for name, phase in self.phases.items():
+            lines.append('{}: {} calls, {:.3f} seconds wall time, {:.1f} KiB '
+                         'peak memory'.format(name, phase['calls'],
+                                              phase['seconds'],
+                                              phase['peak'] / 1024.0))
+            for stat in phase['stats']:
+                lines.append('    {}'.format(stat))
+        return '\n'.join(lines) + '\n'
+
+
+def profile_run(func, directory=None):
+    """
+    Call func under cProfile and Profiler. Write cProfile stats (run.prof),
+    cProfile report sorted by cumulative time (run.txt) and report of the
+    phases (phases.txt) to a new subdirectory of PROFILE_DIR.
+    """
+    if directory is None:
+        directory = join(getattr(config, 'PROFILE_DIR', 'profiles'),
+                         datetime.utcnow().strftime('%Y%m%d-%H%M%S'))
+    if not exists(directory):
+        os.makedirs(directory)
+
+    import cProfile
+    import pstats
+
+    profiler = Profiler()
+    profile = cProfile.Profile()
+    metrics.listeners.append(profiler)
+    profiler.start()
+    profile.enable()
+    try:
+        return func()
+    finally:
+        profile.disable()
+        profiler.stop()
+        metrics.listeners.remove(profiler)
+
+        profile.dump_stats(join(directory, 'run.prof'))
+        with open(join(directory, 'run.txt'), 'w') as report:
+            stats = pstats.Stats(profile, stream=report)
+            stats.sort_stats('cumulative').print_stats(50)
+        with open(join(directory, 'phases.txt'), 'w') as report:
+            report.write(profiler.report())
+        print('Profile is written to {}'.format(directory))
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(
+        description='Send slack messages about new, changed and deleted '
+                    'insightly opportunities.')
+    parser.add_argument('command', nargs='?', choices=['init'],
+                        help='create default config file, check log file '
+                             'directory permissions and exit')
+    parser.add_argument('--invalidate-cache', action='store_true',
+                        help='drop cached users, categories, pipelines and '
+                             'stages and exit')
+    parser.add_argument('--async', action='store_true', dest='use_async',
+                        help='run asyncio pipeline, requires python 3.6+')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and sync periodically until '
+                             'SIGTERM')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the run, reports are written to '
+                             'PROFILE_DIR')
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        init_config()
+    elif args.invalidate_cache:
+        invalidate_reference_cache()
+    elif args.daemon:
+        daemon_main()
+    else:
+        run = main
+        if args.use_async:
+            from insightly_slack_notify_async import async_main
+            run = async_main
+
+        if args.profile:
+            profile_run(run)
+        else:
+            run()
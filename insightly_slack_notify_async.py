@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Alternative asyncio entry point of insightly_slack_notify. Requires python
+3.6 or later.
+
+Work is done by stages connected with bounded queues, so fetching of the
+next opportunities pages overlaps with enrichment, rendering and delivery
+of already fetched ones:
+
+    fetch -> enrich (ENRICH_CONCURRENCY workers) -> render -> collect
+        -> outbox -> deliver
+
+Messages are committed to the outbox as they are collected and delivered
+from it while the next ones are fetched. Local copies and watermarks are
+stored when all stages are done, messages found again after a failed run
+are skipped by their outbox keys.
+
+Blocking http requests are made in a thread pool with the shared
+HttpClient. State store is used only from the event loop thread.
+"""
+import asyncio
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import groupby
+
+import insightly_slack_notify as notify
+from insightly_slack_notify import config
+
+# Marks the end of the queue.
+DONE = None
+
+
+class Pipeline(object):
+    """
+    Single sync run, same as notify.sync_opportunities() does: changes are
+    found by the same notify.SyncRun and messages are sent in the same
+    order, routed by optional account. New messages are sent while the
+    listing is fetched, changed ones after it, so they follow all new ones.
+    """
+
+    def __init__(self, client, store, prefetched=None, concurrency=None,
+                 queue_size=None, page_size=None, chunk_size=100,
+                 budget=None, account=None):
+        self.client = client
+        self.store = store
+        self.budget = budget
+        self.account = account
+        self.cache = notify.make_reference_cache(store, prefetched, budget)
+        self.concurrency = (concurrency or
+                            getattr(config, 'ENRICH_CONCURRENCY', 4))
+        self.queue_size = (queue_size or
+                           getattr(config, 'ASYNC_QUEUE_SIZE', 100))
+        self.page_size = (page_size or
+                          getattr(config, 'INSIGHTLY_PAGE_SIZE', 500))
+        self.chunk_size = chunk_size
+        self.sync_run = None
+        # List of (kind, opportunity, message) in order they are sent.
+        self.messages = []
+        self.sender = notify.make_slack_sender(client, account)
+        # Set when messages are committed to the outbox, or all are done.
+        self.outbox_ready = asyncio.Event()
+        self.collected = False
+
+    def call(self, func, *args):
+        """
+        Call blocking function in the thread pool.
+        """
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, func, *args)
+
+    async def run(self):
+        # Threads for enrich workers, render, deliver and page fetches.
+        self.executor = ThreadPoolExecutor(self.concurrency + 3)
+        enrich_queue = asyncio.Queue(self.queue_size)
+        render_queue = asyncio.Queue(self.queue_size)
+        outbox_queue = asyncio.Queue(self.queue_size)
+
+        stages = [
+            asyncio.ensure_future(self.fetch(enrich_queue)),
+            asyncio.ensure_future(
+                self.enrich_workers(enrich_queue, render_queue)),
+            asyncio.ensure_future(self.render(render_queue, outbox_queue)),
+            asyncio.ensure_future(self.enqueue(outbox_queue)),
+            asyncio.ensure_future(self.deliver()),
+        ]
+        try:
+            await asyncio.gather(*stages)
+        except Exception:
+            # Other stages would wait for the failed one forever.
+            for stage in stages:
+                stage.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+            raise
+        finally:
+            self.executor.shutdown(wait=False)
+
+        # Messages are already in the outbox, their keys are kept.
+        self.sync_run.finish(self.messages, self.account)
+        self.cache.save()
+
+        # Messages left by failed delivery stage are sent, or the error is
+        # raised, same as sync_opportunities() does.
+        notify.deliver_outbox(self.store, self.sender)
+
+    async def fetch(self, queue):
+        """
+        Fetch notes and opportunities, compare opportunities with local
+        copies. Put items (sequence number, kind, opportunity, local copy,
+        notes) to the queue.
+        """
+        run = self.sync_run = notify.SyncRun(self.store, datetime.utcnow())
+        run.notes = await self.call(notify.fetch_new_notes, self.client,
+                                    run.notes_last_poll, run.seen)
+        listing_path = run.listing_path(self.budget)
+
+        seq = 0
+        candidates_ids = []
+        # Changed opportunities are put after the listing, so messages are
+        # in order of notify.MESSAGE_KINDS.
+        changed = []
+
+        async def put(kind, opp, local_opp, notes):
+            nonlocal seq
+            await queue.put((seq, kind, opp, local_opp, notes))
+            seq += 1
+
+        async def classify(opp):
+            kind, local_opp, notes = run.fetched(opp)
+            if kind == 'new':
+                await put(kind, opp, local_opp, notes)
+            elif kind == 'changed':
+                changed.append((opp, local_opp, notes))
+
+        async def fetch_candidates(ids):
+            page = await self.call(notify.insightly_get,
+                                   notify.ids_path('/opportunities', ids),
+                                   self.client)
+            for opp in page:
+                await classify(opp)
+
+        skip = 0
+        while True:
+            page = await self.call(
+                notify.insightly_get,
+                notify.page_path(listing_path, self.page_size, skip),
+                self.client)
+
+            for opp in page:
+                if not run.listed(opp):
+                    continue
+
+                if 'OPPORTUNITY_NAME' in opp:
+                    await classify(opp)
+                else:
+                    candidates_ids.append(opp['OPPORTUNITY_ID'])
+
+                if len(candidates_ids) >= self.chunk_size:
+                    await fetch_candidates(candidates_ids)
+                    candidates_ids = []
+
+            # Short page is the last one.
+            if len(page) < self.page_size:
+                break
+            skip += len(page)
+
+        if candidates_ids:
+            await fetch_candidates(candidates_ids)
+
+        for opp, local_opp, notes in changed:
+            await put('changed', opp, local_opp, notes)
+
+        candidates_ids = run.deletion_candidates()
+        returned = await self.call(
+            lambda: list(notify.insightly_iter_ids(
+                '/opportunities', candidates_ids, self.client)))
+        for local_opp in run.deleted(returned):
+            await put('deleted', None, local_opp, None)
+
+        for _ in range(self.concurrency):
+            await queue.put(DONE)
+
+    async def enrich_workers(self, in_queue, out_queue):
+        """
+        Fetch users, categories, pipelines and stages needed to render the
+        messages into the reference cache.
+        """
+        async def worker():
+            while True:
+                item = await in_queue.get()
+                if item is DONE:
+                    return
+                seq, kind, opp, local_opp, notes = item
+                if kind != 'deleted':
+                    for path in notify.reference_paths(opp, local_opp):
+                        await self.call(self.cache.get, path, self.client)
+                await out_queue.put(item)
+
+        await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+        await out_queue.put(DONE)
+
+    async def render(self, in_queue, out_queue):
+        """
+        Render messages using enriched reference cache. Put items (sequence
+        number, kind, opportunity or local copy, message text or None) to the
+        queue.
+        """
+        while True:
+            item = await in_queue.get()
+            if item is DONE:
+                await out_queue.put(DONE)
+                return
+
+            seq, kind, opp, local_opp, notes = item
+            if kind == 'new':
+                message = await self.call(notify.render_new_message, opp,
+                                          self.cache, self.client)
+            elif kind == 'changed':
+                message = await self.call(notify.render_changed_message, opp,
+                                          local_opp, notes, self.cache,
+                                          self.client)
+            else:
+                message = notify.render_deleted_message(local_opp)
+
+            await out_queue.put((seq, kind, opp or local_opp, message))
+
+    async def enqueue(self, queue):
+        """
+        Collect messages in order of their sequence numbers and put them to
+        the outbox. Outbox is committed when no more messages are waiting,
+        so the deliver stage can send them.
+        """
+        pending = {}
+        next_seq = 0
+        while True:
+            item = await queue.get()
+            if item is DONE:
+                self.collected = True
+                self.outbox_ready.set()
+                return
+
+            pending[item[0]] = item[1:]
+            while next_seq in pending:
+                kind, opp, message = pending.pop(next_seq)
+                self.messages.append((kind, opp, message))
+                notify.enqueue_message(self.store, kind, opp, message,
+                                       self.account)
+                next_seq += 1
+
+            if queue.empty():
+                self.store.commit()
+                self.outbox_ready.set()
+
+    async def deliver(self):
+        """
+        Send messages from the outbox to slack while the next ones are
+        collected, see notify.deliver_outbox(). If delivery fails, the rest
+        of the outbox is left to the end of the run.
+        """
+        try:
+            while True:
+                # Store is used only from the event loop thread.
+                entries = self.store.get_outbox(self.sender.max_size)
+                if not entries:
+                    if self.collected:
+                        return
+                    self.outbox_ready.clear()
+                    await self.outbox_ready.wait()
+                    continue
+
+                for channel, group in groupby(
+                        sorted(entries, key=lambda x: x[2] or ''),
+                        key=lambda x: x[2]):
+                    group = list(group)
+                    error = await self.call(
+                        notify.send_messages, self.sender,
+                        [entry[1] for entry in group], channel)
+                    notify.mark_delivered(
+                        self.store, [entry[0] for entry in group], error)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.exception('Delivery failed: {}'.format(e))
+
+
+def run_pipeline(client, store, prefetched=None, **kwargs):
+    """
+    Run the pipeline in a new event loop.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        pipeline = Pipeline(client, store, prefetched, **kwargs)
+        loop.run_until_complete(pipeline.run())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def async_main():
+    notify.configure()
+    notify.run_once(run_pipeline)
+
+
+if __name__ == '__main__':
+    async_main()
@@ -1,13 +1,39 @@
 # -*- coding: UTF-8 -*-
 # You can run this test script with `python -m unittest test`
 
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+from datetime import datetime
+from shutil import rmtree
+from tempfile import mkdtemp
 from textwrap import dedent
-from unittest import TestCase
-
-from mock import Mock, patch
+from types import ModuleType
+from unittest import TestCase, skipIf
+
+from mock import Mock, call, patch
+from requests.compat import unquote
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+# Config of the tests, user config file is not needed.
+config = ModuleType('insightly_slack_notify_config')
+config.INSIGHTLY_API_KEY = ''
+config.SLACK_CHANNEL_URL = ''
+config.LOG_FILE = '/var/log/insightly_notify.log'
+config.LOG_LEVEL = 'INFO'
+sys.modules['insightly_slack_notify_config'] = config
 
 import insightly_slack_notify
-import insightly_slack_notify_config as config
 
 
 NOTE_TEMPLATE = {
@@ -63,34 +89,75 @@ OPPORTUNITY_TEMPLATE = {
 }
 
 
+class FakeInsightly(object):
+    """
+    Fake of insightly_get() serving remote opportunities, notes and
+    reference data by path, so requests can be made in any order.
+    """
+
+    def __init__(self, opportunities=(), notes=(), references=None):
+        self.opportunities = list(opportunities)
+        self.notes = list(notes)
+        self.references = references or {}
+
+    def __call__(self, path, client):
+        path, _, query = unquote(path).partition('?')
+        params = dict(param.split('=', 1) for param in query.split('&')
+                      if param)
+        if path == '/notes':
+            return self.notes
+        if path != '/opportunities':
+            return self.references[path]
+
+        items = self.opportunities
+        if 'ids' in params:
+            ids = set(int(x) for x in params['ids'].split(','))
+            items = [opp for opp in items if opp['OPPORTUNITY_ID'] in ids]
+        if '$select' in params:
+            fields = params['$select'].split(',')
+            items = [dict((field, opp[field]) for field in fields)
+                     for opp in items]
+        skip = int(params.get('$skip', 0))
+        return items[skip:skip + int(params.get('$top', len(items)))]
+
+
 class ChangedOpportunitiesTestCase(TestCase):
 
     def setUp(self):
         # GIVEN local database with one opportunity
-        self.local_db = {'opportunity_111': OPPORTUNITY_TEMPLATE}
-        patch('insightly_slack_notify.shelve.open',
-              lambda x: self.local_db).start()
+        self.store = insightly_slack_notify.SqliteStore(':memory:')
+        self.store.put_opportunity(
+            insightly_slack_notify.make_snapshot(OPPORTUNITY_TEMPLATE))
+        self.store.set_opportunities_ids({111})
+        for name in ('last_poll', 'changed_opportunities_last_poll_time'):
+            self.store.set_watermark(name, datetime(2016, 3, 29))
 
         patch('insightly_slack_notify.slack_post', Mock()).start()
+        self.client = Mock()
 
     def tearDown(self):
         patch.stopall()
 
-    def test_added_note(self):
-        # WHEN new note was added on the server.
-        insightly_response_chain = [
-            [self.local_db['opportunity_111']],  # opportunity not changed
-            [NOTE_TEMPLATE],
-        ]
+    def sync(self, opp, notes=(), references=None):
+        """
+        Call sync_opportunities() with remote opportunity updated after the
+        local copy.
+        """
+        if not notes:
+            opp = dict(opp, DATE_UPDATED_UTC='2016-03-30 10:00:00')
         patch('insightly_slack_notify.insightly_get',
-              Mock(side_effect=insightly_response_chain)).start()
+              Mock(side_effect=FakeInsightly([opp], notes,
+                                             references))).start()
+        insightly_slack_notify.sync_opportunities(self.client, self.store)
 
-        # AND notify_changed_opportunities() is called
-        insightly_slack_notify.notify_changed_opportunities()
+    def test_added_note(self):
+        # WHEN new note was added on the server.
+        # AND sync_opportunities() is called
+        self.sync(OPPORTUNITY_TEMPLATE, notes=[NOTE_TEMPLATE])
 
         # THEN one slack message should be sent
         insightly_slack_notify.slack_post.assert_called_once_with(
-            config.SLACK_CHANNEL_URL,
+            config.SLACK_CHANNEL_URL, self.client,
             json={'text': dedent(
                   'Opportunity op111 changed:\n'
                   'New note added: lol2\n'
@@ -101,19 +168,12 @@ class ChangedOpportunitiesTestCase(TestCase):
 
     def test_changed_bid_amount(self):
         # WHEN BID_AMOUNT changed
-        insightly_response_chain = [
-            [dict(self.local_db['opportunity_111'], BID_AMOUNT=2)],
-            [],  # No new notes
-        ]
-        patch('insightly_slack_notify.insightly_get',
-              Mock(side_effect=insightly_response_chain)).start()
-
-        # AND notify_changed_opportunities() is called
-        insightly_slack_notify.notify_changed_opportunities()
+        # AND sync_opportunities() is called
+        self.sync(dict(OPPORTUNITY_TEMPLATE, BID_AMOUNT=2))
 
         # THEN one slack message should be sent
         insightly_slack_notify.slack_post.assert_called_once_with(
-            config.SLACK_CHANNEL_URL,
+            config.SLACK_CHANNEL_URL, self.client,
             json={'text': dedent(
                   'Opportunity op111 changed:\n'
                   'Bid amount changed from 1 to 2\n'
@@ -122,28 +182,21 @@ class ChangedOpportunitiesTestCase(TestCase):
                   'Responsible user: None')})
 
         # AND local db opportunity should get updated
-        assert(self.local_db['opportunity_111']['BID_AMOUNT'] == 2)
+        assert(self.store.get_opportunity(111)['BID_AMOUNT'] == 2)
 
     def test_changed_pipeline(self):
         # WHEN PIPELINE_ID and STAGE_ID changed
-        insightly_response_chain = [
-            [dict(self.local_db['opportunity_111'], PIPELINE_ID=222,
-                  STAGE_ID=222)],
-            [],  # No new notes
-            {'PIPELINE_NAME': 'Old pipe'},
-            {'STAGE_NAME': 'Old stage'},
-            {'PIPELINE_NAME': 'New pipe'},
-            {'STAGE_NAME': 'New stage'}
-        ]
-        patch('insightly_slack_notify.insightly_get',
-              Mock(side_effect=insightly_response_chain)).start()
-
-        # AND notify_changed_opportunities() is called
-        insightly_slack_notify.notify_changed_opportunities()
+        # AND sync_opportunities() is called
+        self.sync(dict(OPPORTUNITY_TEMPLATE, PIPELINE_ID=222, STAGE_ID=222),
+                  references={
+                      '/Pipelines/111': {'PIPELINE_NAME': 'Old pipe'},
+                      '/PipelineStages/111': {'STAGE_NAME': 'Old stage'},
+                      '/Pipelines/222': {'PIPELINE_NAME': 'New pipe'},
+                      '/PipelineStages/222': {'STAGE_NAME': 'New stage'}})
 
         # THEN one slack message should be sent
         insightly_slack_notify.slack_post.assert_called_once_with(
-            config.SLACK_CHANNEL_URL,
+            config.SLACK_CHANNEL_URL, self.client,
             json={'text': dedent(
                   'Opportunity op111 changed:\n'
                   'Pipeline changed from Old pipe (Old stage) '
@@ -153,27 +206,20 @@ class ChangedOpportunitiesTestCase(TestCase):
                   'Responsible user: None')})
 
         # AND local db opportunity should get updated
-        assert(self.local_db['opportunity_111']['PIPELINE_ID'] == 222)
-        assert(self.local_db['opportunity_111']['STAGE_ID'] == 222)
+        assert(self.store.get_opportunity(111)['PIPELINE_ID'] == 222)
+        assert(self.store.get_opportunity(111)['STAGE_ID'] == 222)
 
     def test_changed_pipeline_to_none(self):
         # WHEN PIPELINE_ID changed to None
-        insightly_response_chain = [
-            [dict(self.local_db['opportunity_111'], PIPELINE_ID=None,
-                  STAGE_ID=None)],
-            [],  # No new notes
-            {'PIPELINE_NAME': 'Old pipe'},
-            {'STAGE_NAME': 'Old stage'},
-        ]
-        patch('insightly_slack_notify.insightly_get',
-              Mock(side_effect=insightly_response_chain)).start()
-
-        # AND notify_changed_opportunities() is called
-        insightly_slack_notify.notify_changed_opportunities()
+        # AND sync_opportunities() is called
+        self.sync(dict(OPPORTUNITY_TEMPLATE, PIPELINE_ID=None, STAGE_ID=None),
+                  references={
+                      '/Pipelines/111': {'PIPELINE_NAME': 'Old pipe'},
+                      '/PipelineStages/111': {'STAGE_NAME': 'Old stage'}})
 
         # THEN one slack message should be sent
         insightly_slack_notify.slack_post.assert_called_once_with(
-            config.SLACK_CHANNEL_URL,
+            config.SLACK_CHANNEL_URL, self.client,
             json={'text': dedent(
                 'Opportunity op111 changed:\n'
                 'Pipeline changed from Old pipe (Old stage) to None\n'
@@ -182,28 +228,21 @@ class ChangedOpportunitiesTestCase(TestCase):
                 'Responsible user: None')})
 
         # AND local db opportunity should get updated
-        assert(self.local_db['opportunity_111']['PIPELINE_ID'] is None)
-        assert(self.local_db['opportunity_111']['STAGE_ID'] is None)
+        assert(self.store.get_opportunity(111)['PIPELINE_ID'] is None)
+        assert(self.store.get_opportunity(111)['STAGE_ID'] is None)
 
     def test_changed_pipeline_without_stage(self):
         # WHEN PIPELINE_ID changed and STAGE_ID changed to None
-        insightly_response_chain = [
-            [dict(self.local_db['opportunity_111'], PIPELINE_ID=222,
-                  STAGE_ID=None)],
-            [],  # No new notes
-            {'PIPELINE_NAME': 'Old pipe'},
-            {'STAGE_NAME': 'Old stage'},
-            {'PIPELINE_NAME': 'New pipe'},
-        ]
-        patch('insightly_slack_notify.insightly_get',
-              Mock(side_effect=insightly_response_chain)).start()
-
-        # AND notify_changed_opportunities() is called
-        insightly_slack_notify.notify_changed_opportunities()
+        # AND sync_opportunities() is called
+        self.sync(dict(OPPORTUNITY_TEMPLATE, PIPELINE_ID=222, STAGE_ID=None),
+                  references={
+                      '/Pipelines/111': {'PIPELINE_NAME': 'Old pipe'},
+                      '/PipelineStages/111': {'STAGE_NAME': 'Old stage'},
+                      '/Pipelines/222': {'PIPELINE_NAME': 'New pipe'}})
 
         # THEN one slack message should be sent
         insightly_slack_notify.slack_post.assert_called_once_with(
-            config.SLACK_CHANNEL_URL,
+            config.SLACK_CHANNEL_URL, self.client,
             json={'text': dedent(
                  'Opportunity op111 changed:\n'
                  'Pipeline changed from Old pipe (Old stage) '
@@ -213,26 +252,20 @@ class ChangedOpportunitiesTestCase(TestCase):
                  'Responsible user: None')})
 
         # AND local db opportunity should get updated
-        assert(self.local_db['opportunity_111']['PIPELINE_ID'] == 222)
-        assert(self.local_db['opportunity_111']['STAGE_ID'] is None)
+        assert(self.store.get_opportunity(111)['PIPELINE_ID'] == 222)
+        assert(self.store.get_opportunity(111)['STAGE_ID'] is None)
 
     def test_changed_stage_to_none(self):
         # WHEN STAGE_ID changed to None
-        insightly_response_chain = [
-            [dict(self.local_db['opportunity_111'], STAGE_ID=None)],
-            [],  # No new notes
-            {'STAGE_NAME': 'Old stage'},
-            {'PIPELINE_NAME': 'New pipe'},
-        ]
-        patch('insightly_slack_notify.insightly_get',
-              Mock(side_effect=insightly_response_chain)).start()
-
-        # AND notify_changed_opportunities() is called
-        insightly_slack_notify.notify_changed_opportunities()
+        # AND sync_opportunities() is called
+        self.sync(dict(OPPORTUNITY_TEMPLATE, STAGE_ID=None),
+                  references={
+                      '/Pipelines/111': {'PIPELINE_NAME': 'New pipe'},
+                      '/PipelineStages/111': {'STAGE_NAME': 'Old stage'}})
 
         # THEN one slack message should be sent
         insightly_slack_notify.slack_post.assert_called_once_with(
-            config.SLACK_CHANNEL_URL,
+            config.SLACK_CHANNEL_URL, self.client,
             json={'text': dedent(
                   'Opportunity op111 changed:\n'
                   'Stage changed from Old stage to None\n'
@@ -241,26 +274,22 @@ class ChangedOpportunitiesTestCase(TestCase):
                   'Responsible user: None')})
 
         # AND local db opportunity should get updated
-        assert(self.local_db['opportunity_111']['PIPELINE_ID'] == 111)
-        assert(self.local_db['opportunity_111']['STAGE_ID'] is None)
+        assert(self.store.get_opportunity(111)['PIPELINE_ID'] == 111)
+        assert(self.store.get_opportunity(111)['STAGE_ID'] is None)
 
     def test_changed_category(self):
         # WHEN CATEGORY_ID changed
-        insightly_response_chain = [
-            [dict(self.local_db['opportunity_111'], CATEGORY_ID=222)],
-            [],  # No new notes
-            {'CATEGORY_NAME': 'Old category'},
-            {'CATEGORY_NAME': 'New category'},
-        ]
-        patch('insightly_slack_notify.insightly_get',
-              Mock(side_effect=insightly_response_chain)).start()
-
-        # AND notify_changed_opportunities() is called
-        insightly_slack_notify.notify_changed_opportunities()
+        # AND sync_opportunities() is called
+        self.sync(dict(OPPORTUNITY_TEMPLATE, CATEGORY_ID=222),
+                  references={
+                      '/OpportunityCategories/111':
+                          {'CATEGORY_NAME': 'Old category'},
+                      '/OpportunityCategories/222':
+                          {'CATEGORY_NAME': 'New category'}})
 
         # THEN one slack message should be sent
         insightly_slack_notify.slack_post.assert_called_once_with(
-            config.SLACK_CHANNEL_URL,
+            config.SLACK_CHANNEL_URL, self.client,
             json={'text': dedent(
                   'Opportunity op111 changed:\n'
                   'Category changed from Old category to New category\n'
@@ -269,24 +298,19 @@ class ChangedOpportunitiesTestCase(TestCase):
                   'Responsible user: None')})
 
         # AND local db opportunity should get updated
-        assert(self.local_db['opportunity_111']['CATEGORY_ID'] == 222)
+        assert(self.store.get_opportunity(111)['CATEGORY_ID'] == 222)
 
     def test_changed_category_to_none(self):
         # WHEN CATEGORY_ID changed to None
-        insightly_response_chain = [
-            [dict(self.local_db['opportunity_111'], CATEGORY_ID=None)],
-            [],  # No new notes
-            {'CATEGORY_NAME': 'Old category'},
-        ]
-        patch('insightly_slack_notify.insightly_get',
-              Mock(side_effect=insightly_response_chain)).start()
-
-        # AND notify_changed_opportunities() is called
-        insightly_slack_notify.notify_changed_opportunities()
+        # AND sync_opportunities() is called
+        self.sync(dict(OPPORTUNITY_TEMPLATE, CATEGORY_ID=None),
+                  references={
+                      '/OpportunityCategories/111':
+                          {'CATEGORY_NAME': 'Old category'}})
 
         # THEN one slack message should be sent
         insightly_slack_notify.slack_post.assert_called_once_with(
-            config.SLACK_CHANNEL_URL,
+            config.SLACK_CHANNEL_URL, self.client,
             json={'text': dedent(
                   'Opportunity op111 changed:\n'
                   'Category changed from Old category to None\n'
@@ -295,25 +319,20 @@ class ChangedOpportunitiesTestCase(TestCase):
                   'Responsible user: None')})
 
         # AND local db opportunity should get updated
-        assert(self.local_db['opportunity_111']['CATEGORY_ID'] is None)
+        assert(self.store.get_opportunity(111)['CATEGORY_ID'] is None)
 
     def test_changed_user(self):
         # WHEN RESPONSIBLE_USER_ID changed
-        insightly_response_chain = [
-            [dict(self.local_db['opportunity_111'], RESPONSIBLE_USER_ID=333)],
-            [],  # No new notes
-            {'FIRST_NAME': 'First', 'LAST_NAME': 'Last',
-             'EMAIL_ADDRESS': 'email@test.com'},
-        ]
-        patch('insightly_slack_notify.insightly_get',
-              Mock(side_effect=insightly_response_chain)).start()
-
-        # AND notify_changed_opportunities() is called
-        insightly_slack_notify.notify_changed_opportunities()
+        # AND sync_opportunities() is called
+        self.sync(dict(OPPORTUNITY_TEMPLATE, RESPONSIBLE_USER_ID=333),
+                  references={
+                      '/users/333': {'FIRST_NAME': 'First',
+                                     'LAST_NAME': 'Last',
+                                     'EMAIL_ADDRESS': 'email@test.com'}})
 
         # THEN one slack message should be sent
         insightly_slack_notify.slack_post.assert_called_once_with(
-            config.SLACK_CHANNEL_URL,
+            config.SLACK_CHANNEL_URL, self.client,
             json={'text': dedent(
                 'Opportunity op111 changed:\n'
                 'Responsible user changed\n'
@@ -322,25 +341,19 @@ class ChangedOpportunitiesTestCase(TestCase):
                 'Responsible user: First Last email@test.com')})
 
         # AND local db opportunity should get updated
-        assert(self.local_db['opportunity_111']['RESPONSIBLE_USER_ID'] == 333)
+        assert(self.store.get_opportunity(111)['RESPONSIBLE_USER_ID'] == 333)
 
     def test_changed_user_to_none(self):
         # GIVEN local opportunity with non-empty responsible user
-        self.local_db['opportunity_111']['RESPONSIBLE_USER_ID'] = 111
+        self.store.put_opportunity(insightly_slack_notify.make_snapshot(
+            dict(OPPORTUNITY_TEMPLATE, RESPONSIBLE_USER_ID=111)))
         # WHEN RESPONSIBLE_USER_ID changed to None
-        insightly_response_chain = [
-            [dict(self.local_db['opportunity_111'], RESPONSIBLE_USER_ID=None)],
-            [],  # No new notes
-        ]
-        patch('insightly_slack_notify.insightly_get',
-              Mock(side_effect=insightly_response_chain)).start()
-
-        # AND notify_changed_opportunities() is called
-        insightly_slack_notify.notify_changed_opportunities()
+        # AND sync_opportunities() is called
+        self.sync(dict(OPPORTUNITY_TEMPLATE, RESPONSIBLE_USER_ID=None))
 
         # THEN one slack message should be sent
         insightly_slack_notify.slack_post.assert_called_once_with(
-            config.SLACK_CHANNEL_URL,
+            config.SLACK_CHANNEL_URL, self.client,
             json={'text': dedent(
                   'Opportunity op111 changed:\n'
                   'Responsible user changed\n'
@@ -349,37 +362,154 @@ class ChangedOpportunitiesTestCase(TestCase):
                   'Responsible user: None')})
 
         # AND local db opportunity should get updated
-        assert(self.local_db['opportunity_111']['RESPONSIBLE_USER_ID'] is None)
+        assert(self.store.get_opportunity(111)['RESPONSIBLE_USER_ID'] is None)
+
+    def test_changed_state(self):
+        # WHEN OPPORTUNITY_STATE changed
+        # AND sync_opportunities() is called
+        self.sync(dict(OPPORTUNITY_TEMPLATE, OPPORTUNITY_STATE='WON'))
+
+        # THEN one slack message should be sent
+        insightly_slack_notify.slack_post.assert_called_once_with(
+            config.SLACK_CHANNEL_URL, self.client,
+            json={'text': dedent(
+                  'Opportunity op111 changed:\n'
+                  'State changed from OPEN to WON\n'
+                  'Url: https://googleapps.insight.ly'
+                  '/opportunities/details/111\n'
+                  'Responsible user: None')})
+
+    def test_changed_pipeline_category_and_close_date(self):
+        # WHEN pipeline, category and forecast close date changed at once
+        # AND sync_opportunities() is called
+        self.sync(dict(OPPORTUNITY_TEMPLATE, PIPELINE_ID=222, STAGE_ID=222,
+                       CATEGORY_ID=222,
+                       FORECAST_CLOSE_DATE='2016-04-30 00:00:00'),
+                  references={
+                      '/Pipelines/111': {'PIPELINE_NAME': 'Old pipe'},
+                      '/PipelineStages/111': {'STAGE_NAME': 'Old stage'},
+                      '/Pipelines/222': {'PIPELINE_NAME': 'New pipe'},
+                      '/PipelineStages/222': {'STAGE_NAME': 'New stage'},
+                      '/OpportunityCategories/111':
+                          {'CATEGORY_NAME': 'Old category'},
+                      '/OpportunityCategories/222':
+                          {'CATEGORY_NAME': 'New category'}})
+
+        # THEN all changes should be sent in one message
+        insightly_slack_notify.slack_post.assert_called_once_with(
+            config.SLACK_CHANNEL_URL, self.client,
+            json={'text': dedent(
+                  'Opportunity op111 changed:\n'
+                  'Pipeline changed from Old pipe (Old stage) '
+                  'to New pipe (New stage)\n\n'
+                  'Category changed from Old category to New category\n\n'
+                  'Forecast close date changed from 2016-03-31 00:00:00 '
+                  'to 2016-04-30 00:00:00\n'
+                  'Url: https://googleapps.insight.ly'
+                  '/opportunities/details/111\n'
+                  'Responsible user: None')})
+
+    def test_close_date_missing_in_old_local_copy(self):
+        # GIVEN local copy stored without close dates
+        local_opp = insightly_slack_notify.make_snapshot(OPPORTUNITY_TEMPLATE)
+        del local_opp['FORECAST_CLOSE_DATE']
+        del local_opp['ACTUAL_CLOSE_DATE']
+
+        # WHEN changes are found
+        changes = insightly_slack_notify.field_changes(
+            dict(OPPORTUNITY_TEMPLATE, BID_AMOUNT=2), local_opp)
+
+        # THEN only bid amount change should be reported
+        self.assertEqual([fields for fields, _ in changes],
+                         [('BID_AMOUNT',)])
+
+    def test_changed_collections(self):
+        # GIVEN local opportunity with custom fields, tags and links
+        self.store.put_opportunity(insightly_slack_notify.make_snapshot(
+            dict(OPPORTUNITY_TEMPLATE,
+                 CUSTOMFIELDS=[
+                     {'CUSTOM_FIELD_ID': 'FIELD_1', 'FIELD_VALUE': 'a'},
+                     {'CUSTOM_FIELD_ID': 'FIELD_2', 'FIELD_VALUE': 'b'}],
+                 TAGS=[{'TAG_NAME': 'hot'}, {'TAG_NAME': 'cold'}],
+                 LINKS=[{'LINK_ID': 1, 'CONTACT_ID': 10}])))
+
+        # WHEN custom fields, tags and links changed
+        # AND sync_opportunities() is called
+        self.sync(dict(OPPORTUNITY_TEMPLATE,
+                       CUSTOMFIELDS=[
+                           {'CUSTOM_FIELD_ID': 'FIELD_3', 'FIELD_VALUE': 'c'},
+                           {'CUSTOM_FIELD_ID': 'FIELD_1', 'FIELD_VALUE': 'd'}],
+                       TAGS=[{'TAG_NAME': 'cold'}, {'TAG_NAME': 'big'}],
+                       LINKS=[{'LINK_ID': 1, 'CONTACT_ID': 10,
+                               'ROLE': 'Buyer'},
+                              {'LINK_ID': 2, 'ORGANISATION_ID': 20}]))
+
+        # THEN added, modified and removed items should be sent
+        insightly_slack_notify.slack_post.assert_called_once_with(
+            config.SLACK_CHANNEL_URL, self.client,
+            json={'text': dedent(
+                  'Opportunity op111 changed:\n'
+                  'Custom field FIELD_3 set to c\n'
+                  'Custom field FIELD_1 changed from a to d\n'
+                  'Custom field FIELD_2 removed\n\n'
+                  'Tags added: big\n'
+                  'Tags removed: hot\n\n'
+                  'Link added: organisation 20\n'
+                  'Link changed: contact 10 (Buyer)\n'
+                  'Url: https://googleapps.insight.ly'
+                  '/opportunities/details/111\n'
+                  'Responsible user: None')})
+
+    def test_reordered_collections(self):
+        # GIVEN local opportunity with tags
+        opp = dict(OPPORTUNITY_TEMPLATE,
+                   TAGS=[{'TAG_NAME': 'hot'}, {'TAG_NAME': 'cold'}])
+        local_opp = insightly_slack_notify.make_snapshot(opp)
+
+        # WHEN tags are listed in other order
+        opp = dict(opp, TAGS=list(reversed(opp['TAGS'])))
+
+        # THEN opportunity should not be changed
+        self.assertFalse(insightly_slack_notify.is_changed(opp, local_opp,
+                                                           None))
+        self.assertEqual(insightly_slack_notify.field_changes(opp,
+                                                              local_opp), [])
 
 
 class NewOpportunitiesTestCase(TestCase):
     def setUp(self):
-        # GIVEN empty local db
-        self.local_db = {}
-        patch('insightly_slack_notify.shelve.open',
-              lambda x: self.local_db).start()
+        # GIVEN empty local db polled before the opportunities were created
+        self.store = insightly_slack_notify.SqliteStore(':memory:')
+        for name in ('last_poll', 'changed_opportunities_last_poll_time'):
+            self.store.set_watermark(name, datetime(2016, 3, 28))
 
         patch('insightly_slack_notify.slack_post', Mock()).start()
+        self.client = Mock()
 
     def tearDown(self):
         patch.stopall()
 
+    def sync(self, opp, references):
+        """
+        Call sync_opportunities() with remote new opportunity.
+        """
+        patch('insightly_slack_notify.insightly_get',
+              Mock(side_effect=FakeInsightly([opp],
+                                             references=references))).start()
+        insightly_slack_notify.sync_opportunities(self.client, self.store)
+
     def test_new_opportunity_with_category_and_user(self):
         # GIVEN remote new opportunity with category and responsible user
         new_opportunity = dict(OPPORTUNITY_TEMPLATE, CATEGORY_ID=111,
                                RESPONSIBLE_USER_ID=111)
 
-        insightly_response_chain = [
-            [new_opportunity],
-            {'FIRST_NAME': 'First', 'LAST_NAME': 'Last',
-             'EMAIL_ADDRESS': 'email@test.com'},
-            {'CATEGORY_NAME': 'New category'},
-        ]
-        patch('insightly_slack_notify.insightly_get',
-              Mock(side_effect=insightly_response_chain)).start()
-
-        # WHEN notify_changed_opportunities() is called
-        insightly_slack_notify.notify_new_opportunities()
+        # WHEN sync_opportunities() is called
+        self.sync(new_opportunity, {
+            '/users/111': {'FIRST_NAME': 'First', 'LAST_NAME': 'Last',
+                           'EMAIL_ADDRESS': 'email@test.com'},
+            '/OpportunityCategories/111':
+                {'CATEGORY_NAME': 'New category'},
+        })
 
         # THEN one slack message should be sent
         expected_message = '''\
@@ -391,23 +521,20 @@ class NewOpportunitiesTestCase(TestCase):
             Description: dddddd
             Url: https://googleapps.insight.ly/opportunities/details/111'''
         insightly_slack_notify.slack_post.assert_called_once_with(
-            config.SLACK_CHANNEL_URL, json={'text': dedent(expected_message)})
+            config.SLACK_CHANNEL_URL, self.client,
+            json={'text': dedent(expected_message)})
 
     def test_new_opportunity_without_category(self):
         # GIVEN remote new opportunity without category
         new_opportunity_without_category = dict(OPPORTUNITY_TEMPLATE,
-                                                CATEGORY_ID=None)
-
-        insightly_response_chain = [
-            [new_opportunity_without_category],
-            {'FIRST_NAME': 'First', 'LAST_NAME': 'Last',
-             'EMAIL_ADDRESS': 'email@test.com'},
-        ]
-        patch('insightly_slack_notify.insightly_get',
-              Mock(side_effect=insightly_response_chain)).start()
+                                                CATEGORY_ID=None,
+                                                RESPONSIBLE_USER_ID=111)
 
-        # WHEN notify_changed_opportunities() is called
-        insightly_slack_notify.notify_new_opportunities()
+        # WHEN sync_opportunities() is called
+        self.sync(new_opportunity_without_category, {
+            '/users/111': {'FIRST_NAME': 'First', 'LAST_NAME': 'Last',
+                           'EMAIL_ADDRESS': 'email@test.com'},
+        })
 
         # THEN one slack message should be sent
         expected_message = '''\
@@ -419,22 +546,19 @@ class NewOpportunitiesTestCase(TestCase):
             Description: dddddd
             Url: https://googleapps.insight.ly/opportunities/details/111'''
         insightly_slack_notify.slack_post.assert_called_once_with(
-            config.SLACK_CHANNEL_URL, json={'text': dedent(expected_message)})
+            config.SLACK_CHANNEL_URL, self.client,
+            json={'text': dedent(expected_message)})
 
     def test_new_opportunity_without_user(self):
         # GIVEN remote new opportunity without responsible user
         new_opportunity_without_user = dict(OPPORTUNITY_TEMPLATE,
                                             RESPONSIBLE_USER_ID=None)
 
-        insightly_response_chain = [
-            [new_opportunity_without_user],
-            {'CATEGORY_NAME': 'New category'},
-        ]
-        patch('insightly_slack_notify.insightly_get',
-              Mock(side_effect=insightly_response_chain)).start()
-
-        # WHEN notify_changed_opportunities() is called
-        insightly_slack_notify.notify_new_opportunities()
+        # WHEN sync_opportunities() is called
+        self.sync(new_opportunity_without_user, {
+            '/OpportunityCategories/111':
+                {'CATEGORY_NAME': 'New category'},
+        })
 
         # THEN one slack message should be sent
         expected_message = '''\
@@ -446,81 +570,1943 @@ class NewOpportunitiesTestCase(TestCase):
             Description: dddddd
             Url: https://googleapps.insight.ly/opportunities/details/111'''
         insightly_slack_notify.slack_post.assert_called_once_with(
-            config.SLACK_CHANNEL_URL, json={'text': dedent(expected_message)})
+            config.SLACK_CHANNEL_URL, self.client,
+            json={'text': dedent(expected_message)})
 
 
 class DeletedOpportunitiesTestCase(TestCase):
     def setUp(self):
         # GIVEN local db with one known opportunity
-        self.local_db = {'opportunity_111': OPPORTUNITY_TEMPLATE,
-                         'opportunities_ids': {111}}
-        patch('insightly_slack_notify.shelve.open',
-              lambda x: self.local_db).start()
+        self.store = insightly_slack_notify.SqliteStore(':memory:')
+        self.store.put_opportunity(OPPORTUNITY_TEMPLATE)
+        self.store.set_opportunities_ids({111})
+        for name in ('last_poll', 'changed_opportunities_last_poll_time'):
+            self.store.set_watermark(name, datetime(2016, 3, 29))
 
         patch('insightly_slack_notify.slack_post', Mock()).start()
+        self.client = Mock()
 
     def tearDown(self):
         patch.stopall()
 
     def test_delete_known_opportunity(self):
         # GIVEN remote end deleted all opportunities
-        insightly_response_chain = [[], ]
         patch('insightly_slack_notify.insightly_get',
-              Mock(side_effect=insightly_response_chain)).start()
+              Mock(side_effect=FakeInsightly())).start()
 
-        # WHEN notify_deleted_opportunities() is called
-        insightly_slack_notify.notify_deleted_opportunities()
+        # WHEN sync_opportunities() is called
+        insightly_slack_notify.sync_opportunities(self.client, self.store)
 
         # THEN one slack message should be sent
         expected_message = '''\
             Opportunity deleted: op111
             Description: dddddd'''
         insightly_slack_notify.slack_post.assert_called_once_with(
-            config.SLACK_CHANNEL_URL, json={'text': dedent(expected_message)})
+            config.SLACK_CHANNEL_URL, self.client,
+            json={'text': dedent(expected_message)})
 
     def test_delete_unknown_opportunity(self):
-        # GIVEN remote end with one new opportunity op222
+        # GIVEN remote end with op222 created before the last poll, which is
+        # not known locally
+        op222 = dict(OPPORTUNITY_TEMPLATE, OPPORTUNITY_ID=222,
+                     OPPORTUNITY_NAME='op222', OPPORTUNITY_DETAILS='2')
+        insightly = FakeInsightly([OPPORTUNITY_TEMPLATE, op222])
+        patch('insightly_slack_notify.insightly_get',
+              Mock(side_effect=insightly)).start()
+
+        # WHEN sync_opportunities() is called first time
+        insightly_slack_notify.sync_opportunities(self.client, self.store)
+
+        # THEN details should be fetched only for unknown opportunity
+        insightly_slack_notify.insightly_get.assert_called_with(
+            '/opportunities?ids=222', self.client)
+
+        # AND unknown opportunity should be added to local db
+        self.assertIsNotNone(self.store.get_opportunity(222))
+
+        # AND no slack message should be sent
+        self.assertEqual(insightly_slack_notify.slack_post.call_count, 0)
+
+        # WHEN remote end deleted opportunity op222
+        insightly.opportunities.remove(op222)
+
+        # AND sync_opportunities() is called second time
+        insightly_slack_notify.sync_opportunities(self.client, self.store)
+
+        # THEN one slack message should be sent
+        expected_message = '''\
+            Opportunity deleted: op222
+            Description: 2'''
+        insightly_slack_notify.slack_post.assert_called_once_with(
+            config.SLACK_CHANNEL_URL, self.client,
+            json={'text': dedent(expected_message)})
+
+        # AND deleted opportunity should be deleted drom local db
+        self.assertIsNone(self.store.get_opportunity(222))
+        self.assertFalse(222 in self.store.get_opportunities_ids())
+
+
+class HttpClientTestCase(TestCase):
+    def test_session_per_host(self):
+        # GIVEN client with authentication for insightly host
+        client = insightly_slack_notify.HttpClient(
+            auth={'api.insight.ly': ('key', '')})
+
+        # WHEN sessions for insightly and slack urls are requested
+        insightly = client.session('https://api.insight.ly/v2.1/users/1')
+        slack = client.session('https://hooks.slack.com/services/a/b/c')
+
+        # THEN the same insightly session should be reused
+        self.assertIs(insightly,
+                      client.session('https://api.insight.ly/v2.1/notes'))
+
+        # AND authentication should be set only for insightly session
+        self.assertEqual(insightly.auth, ('key', ''))
+        self.assertIsNone(slack.auth)
+
+    def test_connection_stats_of_unused_client(self):
+        # GIVEN client without sent requests
+        client = insightly_slack_notify.HttpClient()
+        client.session('https://api.insight.ly/v2.1/users/1')
+
+        # THEN no connections should be opened or reused
+        self.assertEqual(client.connection_stats(), (0, 0))
+
+    def test_view_shares_connection_pools(self):
+        # GIVEN client and its view with other authentication
+        client = insightly_slack_notify.HttpClient(
+            auth={'api.insight.ly': ('key', '')})
+        view = client.view({'api.insight.ly': ('other', '')})
+
+        # WHEN sessions for insightly are requested
+        session = client.session('https://api.insight.ly/v2.1/users/1')
+        view_session = view.session('https://api.insight.ly/v2.1/users/1')
+
+        # THEN each session should have its own authentication
+        self.assertEqual(view_session.auth, ('other', ''))
+
+        # AND connection pool should be shared
+        self.assertIs(session.get_adapter('https://api.insight.ly'),
+                      view_session.get_adapter('https://api.insight.ly'))
+
+
+class ResponseCacheTestCase(TestCase):
+    def setUp(self):
+        self.client = Mock(
+            response_cache=insightly_slack_notify.ResponseCache())
+
+    def response(self, status, content=b'', headers=None):
+        return Mock(status_code=status, content=content,
+                    headers=headers or {})
+
+    def test_not_modified_response_is_served_from_cache(self):
+        # GIVEN pipeline fetched with ETag
+        self.client.get.return_value = self.response(
+            200, b'{"PIPELINE_NAME": "Sales"}', {'ETag': '"v1"'})
+        insightly_slack_notify.insightly_get('/Pipelines/1', self.client)
+
+        # WHEN it is fetched again and not modified
+        self.client.get.return_value = self.response(304)
+        pipeline = insightly_slack_notify.insightly_get('/Pipelines/1',
+                                                        self.client)
+
+        # THEN request should be conditional
+        self.client.get.assert_called_with(
+            insightly_slack_notify.INSIGHTLY_URL + '/Pipelines/1',
+            headers={'If-None-Match': '"v1"'})
+
+        # AND cached pipeline should be returned
+        self.assertEqual(pipeline, {'PIPELINE_NAME': 'Sales'})
+
+    def test_modified_response_replaces_cached(self):
+        # GIVEN user fetched with Last-Modified
+        self.client.get.return_value = self.response(
+            200, b'{"FIRST_NAME": "Old"}',
+            {'Last-Modified': 'Tue, 29 Mar 2016 12:00:00 GMT'})
+        insightly_slack_notify.insightly_get('/users/1', self.client)
+
+        # WHEN it is fetched again and modified
+        self.client.get.return_value = self.response(
+            200, b'{"FIRST_NAME": "New"}',
+            {'Last-Modified': 'Wed, 30 Mar 2016 12:00:00 GMT'})
+        user = insightly_slack_notify.insightly_get('/users/1', self.client)
+
+        # THEN new user should be returned and cached
+        self.assertEqual(user, {'FIRST_NAME': 'New'})
+        self.assertEqual(
+            self.client.response_cache.validators(
+                insightly_slack_notify.INSIGHTLY_URL + '/users/1'),
+            ({'If-Modified-Since': 'Wed, 30 Mar 2016 12:00:00 GMT'},
+             {'FIRST_NAME': 'New'}))
+
+    def test_entry_evicted_during_request_is_served(self):
+        # GIVEN pipeline fetched with ETag
+        self.client.get.return_value = self.response(
+            200, b'{"PIPELINE_NAME": "Sales"}', {'ETag': '"v1"'})
+        insightly_slack_notify.insightly_get('/Pipelines/1', self.client)
+
+        # WHEN it is evicted by another thread during conditional request
+        # which answers not modified
+        def get(url, headers=None):
+            self.client.response_cache.entries.clear()
+            return self.response(304)
+        self.client.get.side_effect = get
+        pipeline = insightly_slack_notify.insightly_get('/Pipelines/1',
+                                                        self.client)
+
+        # THEN cached pipeline should be returned
+        self.assertEqual(pipeline, {'PIPELINE_NAME': 'Sales'})
+
+    def test_opportunities_are_not_cached(self):
+        # WHEN opportunities are fetched with ETag
+        self.client.get.return_value = self.response(
+            200, b'[]', {'ETag': '"v1"'})
+        insightly_slack_notify.insightly_get('/opportunities?ids=1',
+                                             self.client)
+
+        # THEN they should not be cached
+        self.assertEqual(len(self.client.response_cache.entries), 0)
+
+
+class ReferenceCacheTestCase(TestCase):
+    def setUp(self):
+        # GIVEN empty local db
+        self.store = insightly_slack_notify.SqliteStore(':memory:')
+        self.client = Mock()
+        patch('insightly_slack_notify.insightly_get',
+              Mock(side_effect=lambda path, client: {'PATH': path})).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_cached_path_is_fetched_once(self):
+        # GIVEN empty reference cache
+        cache = insightly_slack_notify.ReferenceCache(self.store)
+
+        # WHEN the same user is requested twice
+        cache.get('/users/1', self.client)
+        data = cache.get('/users/1', self.client)
+
+        # THEN it should be fetched from api only once
+        self.assertEqual(data, {'PATH': '/users/1'})
+        self.assertEqual(insightly_slack_notify.insightly_get.call_count, 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_concurrent_misses_fetch_path_once(self):
+        # GIVEN empty reference cache and slow api
+        cache = insightly_slack_notify.ReferenceCache(self.store)
+        release = threading.Event()
+
+        def insightly_get(path, client):
+            release.wait()
+            return {'PATH': path}
+        insightly_slack_notify.insightly_get.side_effect = insightly_get
+
+        # WHEN the same user is requested by several threads at once
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            cache.get('/users/1', self.client))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        # THEN it should be fetched from api only once
+        self.assertEqual(results, [{'PATH': '/users/1'}] * 4)
+        self.assertEqual(insightly_slack_notify.insightly_get.call_count, 1)
+
+    def test_cache_is_kept_between_runs(self):
+        # GIVEN reference cache saved by previous run
+        cache = insightly_slack_notify.ReferenceCache(self.store)
+        cache.get('/users/1', self.client)
+        cache.save()
+
+        # WHEN the user is requested by the next run
+        cache = insightly_slack_notify.ReferenceCache(self.store)
+        cache.get('/users/1', self.client)
+
+        # THEN it should be served from the cache
+        self.assertEqual(insightly_slack_notify.insightly_get.call_count, 1)
+
+    def test_expired_entry_is_fetched_again(self):
+        # GIVEN reference cache with zero ttl
+        cache = insightly_slack_notify.ReferenceCache(self.store, ttl=0)
+
+        # WHEN the same stage is requested twice
+        cache.get('/PipelineStages/1', self.client)
+        cache.get('/PipelineStages/1', self.client)
+
+        # THEN it should be fetched from api twice
+        self.assertEqual(insightly_slack_notify.insightly_get.call_count, 2)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        # GIVEN reference cache limited to two entries
+        cache = insightly_slack_notify.ReferenceCache(self.store, max_size=2)
+
+        # WHEN third entry is added after the first one was used again
+        cache.get('/users/1', self.client)
+        cache.get('/users/2', self.client)
+        cache.get('/users/1', self.client)
+        cache.get('/users/3', self.client)
+
+        # THEN the least recently used entry should be evicted
+        self.assertEqual(list(cache.entries), ['/users/1', '/users/3'])
+
+    def test_invalidate(self):
+        # GIVEN reference cache with two entries
+        cache = insightly_slack_notify.ReferenceCache(self.store)
+        cache.get('/users/1', self.client)
+        cache.get('/users/2', self.client)
+
+        # WHEN one entry is invalidated
+        cache.invalidate('/users/1')
+
+        # THEN only that entry should be dropped
+        self.assertEqual(list(cache.entries), ['/users/2'])
+
+        # WHEN the whole cache is invalidated
+        cache.invalidate()
+
+        # THEN cache should be empty
+        self.assertEqual(len(cache.entries), 0)
+
+
+class PrefetchReferenceDataTestCase(TestCase):
+    def setUp(self):
+        self.client = Mock()
+        patch('insightly_slack_notify.slack_post', Mock()).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_prefetch(self):
+        # GIVEN remote end with one user, category, pipeline and stage
         insightly_response_chain = [
+            [{'USER_ID': 1, 'FIRST_NAME': 'First', 'LAST_NAME': 'Last',
+              'EMAIL_ADDRESS': 'email@test.com'}],
+            [{'CATEGORY_ID': 2, 'CATEGORY_NAME': 'Category'}],
+            [{'PIPELINE_ID': 3, 'PIPELINE_NAME': 'Pipeline'}],
+            [{'STAGE_ID': 4, 'STAGE_NAME': 'Stage'}],
+        ]
+        patch('insightly_slack_notify.insightly_get',
+              Mock(side_effect=insightly_response_chain)).start()
+
+        # WHEN reference data is prefetched
+        prefetched = insightly_slack_notify.prefetch_reference_data(
+            self.client)
+
+        # THEN items should be available by their single item paths
+        self.assertEqual(sorted(prefetched), [
+            '/OpportunityCategories/2', '/PipelineStages/4', '/Pipelines/3',
+            '/users/1'])
+        self.assertEqual(prefetched['/Pipelines/3']['PIPELINE_NAME'],
+                         'Pipeline')
+
+    def test_new_opportunity_with_prefetched_data(self):
+        # GIVEN empty local db polled before the opportunity was created
+        store = insightly_slack_notify.SqliteStore(':memory:')
+        store.set_watermark('last_poll', datetime(2016, 3, 28))
+
+        # AND prefetched user and category
+        prefetched = {
+            '/users/111': {'FIRST_NAME': 'First', 'LAST_NAME': 'Last',
+                           'EMAIL_ADDRESS': 'email@test.com'},
+            '/OpportunityCategories/111': {'CATEGORY_NAME': 'New category'},
+        }
+
+        # AND remote new opportunity with category and responsible user
+        new_opportunity = dict(OPPORTUNITY_TEMPLATE, CATEGORY_ID=111,
+                               RESPONSIBLE_USER_ID=111)
+        patch('insightly_slack_notify.insightly_get',
+              Mock(side_effect=FakeInsightly([new_opportunity]))).start()
+
+        # WHEN sync_opportunities() is called
+        insightly_slack_notify.sync_opportunities(self.client, store,
+                                                  prefetched)
+
+        # THEN only notes and opportunities should be fetched from api
+        self.assertEqual(
+            [c[0][0].split('?')[0] for c in
+             insightly_slack_notify.insightly_get.call_args_list],
+            ['/notes', '/opportunities', '/opportunities'])
+
+        # AND message should contain prefetched user and category
+        message = insightly_slack_notify.slack_post.call_args[1]['json']
+        self.assertIn('Category: New category', message['text'])
+        self.assertIn('Responsible user: First Last email@test.com',
+                      message['text'])
+
+
+class InsightlyIterTestCase(TestCase):
+    def tearDown(self):
+        patch.stopall()
+
+    def test_pages(self):
+        # GIVEN remote end with five notes
+        insightly_response_chain = [[1, 2], [3, 4], [5]]
+        patch('insightly_slack_notify.insightly_get',
+              Mock(side_effect=insightly_response_chain)).start()
+
+        # WHEN notes are fetched by two per page
+        client = Mock()
+        items = insightly_slack_notify.insightly_iter('/notes', client,
+                                                      page_size=2)
+
+        # THEN all notes should be yielded
+        self.assertEqual(list(items), [1, 2, 3, 4, 5])
+
+        # AND each page should be requested with $top and $skip
+        insightly_slack_notify.insightly_get.assert_has_calls([
+            call('/notes?$top=2&$skip=0', client),
+            call('/notes?$top=2&$skip=2', client),
+            call('/notes?$top=2&$skip=4', client),
+        ])
+
+    def test_filtered_full_last_page(self):
+        # GIVEN remote end with two filtered opportunities
+        insightly_response_chain = [[1, 2], []]
+        patch('insightly_slack_notify.insightly_get',
+              Mock(side_effect=insightly_response_chain)).start()
+
+        # WHEN opportunities are fetched by two per page
+        client = Mock()
+        items = insightly_slack_notify.insightly_iter(
+            '/opportunities?$filter=x', client, page_size=2)
+
+        # THEN all opportunities should be yielded
+        self.assertEqual(list(items), [1, 2])
+
+        # AND empty page should end the fetch
+        insightly_slack_notify.insightly_get.assert_called_with(
+            '/opportunities?$filter=x&$top=2&$skip=2', client)
+
+
+class SyncOpportunitiesTestCase(TestCase):
+    def setUp(self):
+        # GIVEN local db with two known opportunities polled at 2016-03-29
+        last_poll = datetime(2016, 3, 29)
+        self.store = insightly_slack_notify.SqliteStore(':memory:')
+        self.store.put_opportunity(OPPORTUNITY_TEMPLATE)
+        self.store.put_opportunity(dict(OPPORTUNITY_TEMPLATE,
+                                        OPPORTUNITY_ID=333,
+                                        OPPORTUNITY_NAME='op333'))
+        self.store.set_opportunities_ids({111, 333})
+        self.store.set_watermark('last_poll', last_poll)
+        self.store.set_watermark('changed_opportunities_last_poll_time',
+                                 last_poll)
+
+        patch('insightly_slack_notify.slack_post', Mock()).start()
+        self.client = Mock()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_new_changed_and_deleted(self):
+        # GIVEN remote end where op111 changed, op222 was created and op333
+        # was deleted
+        insightly_response_chain = [
+            [],  # No new notes
+            [
+                {'OPPORTUNITY_ID': 111,
+                 'DATE_CREATED_UTC': '2016-03-28 13:11:50',
+                 'DATE_UPDATED_UTC': '2016-03-30 10:00:00'},
+                {'OPPORTUNITY_ID': 222,
+                 'DATE_CREATED_UTC': '2016-03-30 11:00:00',
+                 'DATE_UPDATED_UTC': '2016-03-30 11:00:00'},
+            ],
             [
-                {'OPPORTUNITY_ID': 111, 'OPPORTUNITY_NAME': 'op111',
-                 'OPPORTUNITY_DETAILS': 'dddddd'},
-                {'OPPORTUNITY_ID': 222, 'OPPORTUNITY_NAME': 'op222',
-                 'OPPORTUNITY_DETAILS': '2'},
-            ]
+                dict(OPPORTUNITY_TEMPLATE, BID_AMOUNT=2,
+                     DATE_UPDATED_UTC='2016-03-30 10:00:00'),
+                dict(OPPORTUNITY_TEMPLATE, OPPORTUNITY_ID=222,
+                     OPPORTUNITY_NAME='op222', CATEGORY_ID=None,
+                     DATE_CREATED_UTC='2016-03-30 11:00:00',
+                     DATE_UPDATED_UTC='2016-03-30 11:00:00'),
+            ],
+            [],  # op333 is not returned by id
         ]
         patch('insightly_slack_notify.insightly_get',
               Mock(side_effect=insightly_response_chain)).start()
 
-        # WHEN notify_deleted_opportunities() is called first time
-        insightly_slack_notify.notify_deleted_opportunities()
+        # WHEN sync_opportunities() is called
+        insightly_slack_notify.sync_opportunities(self.client, self.store)
+
+        # THEN full records should be fetched only for op111 and op222
+        insightly_slack_notify.insightly_get.assert_any_call(
+            '/opportunities?ids=111,222', self.client)
+
+        # AND deleted op333 should be checked again by id
+        insightly_slack_notify.insightly_get.assert_called_with(
+            '/opportunities?ids=333', self.client)
+
+        # AND new, changed and deleted messages should be sent in order
+        texts = [c[1]['json']['text'] for c in
+                 insightly_slack_notify.slack_post.call_args_list]
+        self.assertEqual(len(texts), 3)
+        self.assertTrue(texts[0].startswith('New opportunity created: op222'))
+        self.assertEqual(texts[1], dedent(
+            'Opportunity op111 changed:\n'
+            'Bid amount changed from 1 to 2\n'
+            'Url: https://googleapps.insight.ly'
+            '/opportunities/details/111\n'
+            'Responsible user: None'))
+        self.assertEqual(texts[2], 'Opportunity deleted: op333\n'
+                                   'Description: dddddd')
+
+        # AND local db should be updated
+        self.assertEqual(self.store.get_opportunity(111)['BID_AMOUNT'], 2)
+        self.assertIsNotNone(self.store.get_opportunity(222))
+        self.assertIsNone(self.store.get_opportunity(333))
+        self.assertEqual(self.store.get_opportunities_ids(), {111, 222})
+
+    def test_unchanged(self):
+        # GIVEN remote end where nothing changed
+        insightly_response_chain = [
+            [],  # No new notes
+            [
+                {'OPPORTUNITY_ID': 111,
+                 'DATE_CREATED_UTC': '2016-03-28 13:11:50',
+                 'DATE_UPDATED_UTC': '2016-03-29 12:03:56'},
+                {'OPPORTUNITY_ID': 333,
+                 'DATE_CREATED_UTC': '2016-03-28 13:11:50',
+                 'DATE_UPDATED_UTC': '2016-03-29 12:03:56'},
+            ],
+        ]
+        patch('insightly_slack_notify.insightly_get',
+              Mock(side_effect=insightly_response_chain)).start()
+
+        # WHEN sync_opportunities() is called
+        insightly_slack_notify.sync_opportunities(self.client, self.store)
 
-        # THEN unknown opportunity should be added to local db
-        self.assertTrue('opportunity_222' in self.local_db)
+        # THEN no full records should be fetched
+        self.assertEqual(insightly_slack_notify.insightly_get.call_count, 2)
 
         # AND no slack message should be sent
         self.assertEqual(insightly_slack_notify.slack_post.call_count, 0)
 
-        # WHEN remote end deleted opportunity op222
+    def test_listed_opportunity_not_fetched(self):
+        # GIVEN remote end with op444 which is listed, but not returned by
+        # ids request
+        op444 = dict(OPPORTUNITY_TEMPLATE, OPPORTUNITY_ID=444,
+                     OPPORTUNITY_NAME='op444')
+        insightly = FakeInsightly([OPPORTUNITY_TEMPLATE, op444])
+
+        def insightly_get(path, client):
+            return [opp for opp in insightly(path, client)
+                    if 'ids=' not in path or opp['OPPORTUNITY_ID'] != 444]
+
+        patch('insightly_slack_notify.insightly_get',
+              Mock(side_effect=insightly_get)).start()
+
+        # WHEN sync_opportunities() is called
+        insightly_slack_notify.sync_opportunities(self.client, self.store)
+
+        # THEN op444 should not be known without its local copy
+        self.assertIsNone(self.store.get_opportunity(444))
+        self.assertEqual(self.store.get_opportunities_ids(), {111})
+
+        # WHEN op444 is deleted and a deleted opportunity without local copy
+        # is known from previous versions
+        insightly.opportunities.remove(op444)
+        self.store.set_opportunities_ids({111, 555})
+        insightly_slack_notify.slack_post.reset_mock()
+
+        # AND sync_opportunities() is called again
+        insightly_slack_notify.sync_opportunities(self.client, self.store)
+
+        # THEN nothing should be reported and the id should be dropped
+        self.assertEqual(insightly_slack_notify.slack_post.call_count, 0)
+        self.assertEqual(self.store.get_opportunities_ids(), {111})
+
+    def test_opportunity_missing_in_listing_is_not_deleted(self):
+        # GIVEN remote end where op333 exists, but is missing in the listing,
+        # as if pages shifted during the listing
+        insightly = FakeInsightly([
+            OPPORTUNITY_TEMPLATE,
+            dict(OPPORTUNITY_TEMPLATE, OPPORTUNITY_ID=333,
+                 OPPORTUNITY_NAME='op333')])
+
+        def insightly_get(path, client):
+            return [opp for opp in insightly(path, client)
+                    if '$select' not in path or opp['OPPORTUNITY_ID'] != 333]
+
+        patch('insightly_slack_notify.insightly_get',
+              Mock(side_effect=insightly_get)).start()
+
+        # WHEN sync_opportunities() is called
+        insightly_slack_notify.sync_opportunities(self.client, self.store)
+
+        # THEN no deletion should be reported
+        self.assertEqual(insightly_slack_notify.slack_post.call_count, 0)
+
+        # AND op333 should be kept in local db
+        self.assertIsNotNone(self.store.get_opportunity(333))
+        self.assertEqual(self.store.get_opportunities_ids(), {111, 333})
+
+    def test_watermarks_follow_server_dates(self):
+        # GIVEN remote end with new note on op111 and op333 deleted
+        note = dict(NOTE_TEMPLATE, NOTE_ID=1)
+        listing = [{'OPPORTUNITY_ID': 111,
+                    'DATE_CREATED_UTC': '2016-03-28 13:11:50',
+                    'DATE_UPDATED_UTC': '2016-03-30 10:00:00'}]
         insightly_response_chain = [
+            [note],
+            listing,
+            [dict(OPPORTUNITY_TEMPLATE,
+                  DATE_UPDATED_UTC='2016-03-30 10:00:00')],
+            [],  # op333 is not returned by id
+            # Second run gets the same note because of overlap window.
+            [note],
+            listing,
+        ]
+        patch('insightly_slack_notify.insightly_get',
+              Mock(side_effect=insightly_response_chain)).start()
+
+        # WHEN sync_opportunities() is called twice
+        insightly_slack_notify.sync_opportunities(self.client, self.store)
+        insightly_slack_notify.sync_opportunities(self.client, self.store)
+
+        # THEN note and deletion should be reported once
+        texts = [c[1]['json']['text'] for c in
+                 insightly_slack_notify.slack_post.call_args_list]
+        self.assertEqual(len(texts), 2)
+        self.assertIn('New note added: lol2', texts[0])
+        self.assertTrue(texts[1].startswith('Opportunity deleted: op333'))
+
+        # AND watermarks should be the latest server dates seen
+        self.assertEqual(
+            self.store.get_watermark('changed_opportunities_last_poll_time'),
+            datetime(2016, 3, 30, 10))
+        self.assertEqual(self.store.get_watermark('notes_last_poll'),
+                         datetime(2016, 3, 31, 17, 9, 54))
+
+        # AND watermark of created opportunities should not move back
+        self.assertEqual(self.store.get_watermark('last_poll'),
+                         datetime(2016, 3, 29))
+
+    def test_deleted_scan_is_deferred_on_low_budget(self):
+        # GIVEN api budget which is almost spent
+        budget = insightly_slack_notify.ApiBudget(daily_limit=100)
+        budget.header_remaining = 10
+
+        # AND remote end where only op111 was updated since last poll
+        insightly_response_chain = [
+            [],  # No new notes
             [
-                {'OPPORTUNITY_ID': 111, 'OPPORTUNITY_NAME': 'op111',
-                 'OPPORTUNITY_DETAILS': 'dddddd'},
-                # op222 was deleted
-            ]
+                {'OPPORTUNITY_ID': 111,
+                 'DATE_CREATED_UTC': '2016-03-28 13:11:50',
+                 'DATE_UPDATED_UTC': '2016-03-30 10:00:00'},
+            ],
+            [
+                dict(OPPORTUNITY_TEMPLATE, BID_AMOUNT=2,
+                     DATE_UPDATED_UTC='2016-03-30 10:00:00'),
+            ],
         ]
         patch('insightly_slack_notify.insightly_get',
               Mock(side_effect=insightly_response_chain)).start()
 
-        # AND notify_deleted_opportunities() is called second time
-        insightly_slack_notify.notify_deleted_opportunities()
+        # WHEN sync_opportunities() is called
+        insightly_slack_notify.sync_opportunities(self.client, self.store,
+                                                  budget=budget)
+
+        # THEN only opportunities updated since last poll minus overlap
+        # window should be listed
+        self.assertIn("$filter=DATE_UPDATED_UTC%20gt%20DateTime"
+                      "'2016-03-28T23:55:00'",
+                      insightly_slack_notify.insightly_get
+                      .call_args_list[1][0][0])
+
+        # AND only changed message should be sent
+        texts = [c[1]['json']['text'] for c in
+                 insightly_slack_notify.slack_post.call_args_list]
+        self.assertEqual(len(texts), 1)
+        self.assertTrue(texts[0].startswith('Opportunity op111 changed'))
+
+        # AND not listed op333 should be kept for the next full scan
+        self.assertIsNotNone(self.store.get_opportunity(333))
+        self.assertEqual(self.store.get_opportunities_ids(), {111, 333})
+
+
+    def test_new_opportunity_of_partial_listing_can_be_deleted(self):
+        # GIVEN remote end where op222 was created
+        op222 = dict(OPPORTUNITY_TEMPLATE, OPPORTUNITY_ID=222,
+                     OPPORTUNITY_NAME='op222', CATEGORY_ID=None,
+                     DATE_CREATED_UTC='2016-03-30 11:00:00',
+                     DATE_UPDATED_UTC='2016-03-30 11:00:00')
+        insightly = FakeInsightly([
+            OPPORTUNITY_TEMPLATE, op222,
+            dict(OPPORTUNITY_TEMPLATE, OPPORTUNITY_ID=333,
+                 OPPORTUNITY_NAME='op333')])
+        patch('insightly_slack_notify.insightly_get',
+              Mock(side_effect=insightly)).start()
 
-        # THEN one slack message should be sent
-        expected_message = '''\
-            Opportunity deleted: op222
-            Description: 2'''
+        # WHEN it is found by sync which lists only updated opportunities
+        insightly_slack_notify.sync_opportunities(self.client, self.store,
+                                                  reconcile=False)
+
+        # THEN its id should be known
+        self.assertEqual(self.store.get_opportunities_ids(), {111, 222, 333})
+
+        # WHEN op222 is deleted and the next sync lists all opportunities
+        insightly.opportunities.remove(op222)
+        insightly_slack_notify.slack_post.reset_mock()
+        insightly_slack_notify.sync_opportunities(self.client, self.store)
+
+        # THEN deletion should be reported
+        texts = [c[1]['json']['text'] for c in
+                 insightly_slack_notify.slack_post.call_args_list]
+        self.assertEqual(len(texts), 1)
+        self.assertTrue(texts[0].startswith('Opportunity deleted: op222'))
+        self.assertIsNone(self.store.get_opportunity(222))
+
+
+class StateStoreTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'db.sqlite3')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def check_store(self, store):
+        # WHEN state is written to the store
+        store.set_watermark('last_poll', datetime(2016, 3, 29, 12, 3, 56))
+        store.put_opportunity(OPPORTUNITY_TEMPLATE)
+        store.set_opportunities_ids({111, 222})
+        store.set_reference_cache([('/users/2', (2.0, {'USER_ID': 2})),
+                                   ('/users/1', (1.0, {'USER_ID': 1}))])
+        store.add_api_usage({3600: 5, 7200: 1}, 0)
+        store.add_api_usage({7200: 2}, 7200)
+        self.assertTrue(store.add_outbox('new:1', 'first'))
+        self.assertTrue(store.add_outbox('new:2', 'second',
+                                         'https://channel'))
+        self.assertFalse(store.add_outbox('new:1', 'first'))
+        store.set_response_cache([('url', ('"v1"', None, {'USER_ID': 1}))])
+        store.set_seen_updates(['note:2:2016', 'note:1:2016'])
+
+        # THEN the same state should be read back
+        self.assertEqual(store.get_watermark('last_poll'),
+                         datetime(2016, 3, 29, 12, 3, 56))
+        self.assertIsNone(store.get_watermark('unknown'))
+        self.assertEqual(store.get_opportunity(111), OPPORTUNITY_TEMPLATE)
+        self.assertIsNone(store.get_opportunity(222))
+        self.assertEqual(store.get_opportunities_ids(), {111, 222})
+        self.assertEqual(store.get_reference_cache(),
+                         [('/users/2', (2.0, {'USER_ID': 2})),
+                          ('/users/1', (1.0, {'USER_ID': 1}))])
+        self.assertEqual(store.get_api_usage(0), {7200: 3})
+        self.assertEqual(store.get_response_cache(),
+                         [('url', ('"v1"', None, {'USER_ID': 1}))])
+        self.assertEqual(store.get_seen_updates(),
+                         ['note:2:2016', 'note:1:2016'])
+        self.assertEqual(list(store.get_outbox(10)),
+                         [('new:1', 'first', None),
+                          ('new:2', 'second', 'https://channel')])
+
+        # WHEN outbox message is sent
+        store.mark_outbox_sent(['new:1'], 100.0)
+        store.purge_outbox(50.0)
+
+        # THEN it should not be pending and its key should be kept
+        self.assertEqual(list(store.get_outbox(10)),
+                         [('new:2', 'second', 'https://channel')])
+        self.assertFalse(store.add_outbox('new:1', 'first'))
+
+        # WHEN it is purged
+        store.purge_outbox(150.0)
+
+        # THEN its key should be dropped
+        self.assertTrue(store.add_outbox('new:1', 'first'))
+
+        # WHEN opportunity is deleted
+        store.delete_opportunity(111)
+
+        # THEN it should not be known anymore
+        self.assertIsNone(store.get_opportunity(111))
+
+    def test_sqlite_store(self):
+        with insightly_slack_notify.SqliteStore(self.path) as store:
+            self.check_store(store)
+
+    def test_shelve_store(self):
+        with insightly_slack_notify.ShelveStore({}) as store:
+            self.check_store(store)
+
+    def test_shelve_is_migrated_to_sqlite(self):
+        # GIVEN state of previous version kept in shelve
+        import shelve
+        cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        self.addCleanup(os.chdir, cwd)
+        with insightly_slack_notify.ShelveStore(
+                shelve.open('db.shelve')) as store:
+            store.set_watermark('last_poll', datetime(2016, 3, 29))
+            store.put_opportunity(OPPORTUNITY_TEMPLATE)
+            store.set_opportunities_ids({111})
+            store.add_outbox('new:1', 'first')
+
+        # WHEN sqlite store is opened the first time
+        with insightly_slack_notify.open_store() as store:
+            # THEN the state should be migrated
+            self.assertEqual(store.get_watermark('last_poll'),
+                             datetime(2016, 3, 29))
+            self.assertEqual(store.get_opportunity(111),
+                             OPPORTUNITY_TEMPLATE)
+            self.assertEqual(store.get_opportunities_ids(), {111})
+            self.assertEqual(store.get_outbox(10), [('new:1', 'first', None)])
+            store.set_opportunities_ids({111, 222})
+
+        # AND it should not be migrated again
+        with insightly_slack_notify.open_store() as store:
+            self.assertEqual(store.get_opportunities_ids(), {111, 222})
+
+    def test_daemon_migrates_store_before_worker_starts(self):
+        # GIVEN state of previous version kept in shelve
+        import shelve
+        cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        self.addCleanup(os.chdir, cwd)
+        with insightly_slack_notify.ShelveStore(
+                shelve.open('db.shelve')) as store:
+            store.set_opportunities_ids({111})
+
+        # AND outbox worker which records migrations done before its start
+        migrations = []
+        migrate_store = Mock(side_effect=insightly_slack_notify.migrate_store)
+
+        class Worker(object):
+            def __init__(self, open_store, sender):
+                pass
+
+            def start(self):
+                migrations.append(migrate_store.call_count)
+
+            def stop(self):
+                pass
+
+        patch('insightly_slack_notify.migrate_store', migrate_store).start()
+        patch('insightly_slack_notify.OutboxWorker', Worker).start()
+        patch('insightly_slack_notify.Daemon.run', Mock()).start()
+        self.addCleanup(patch.stopall)
+
+        # WHEN account daemon is run
+        client = insightly_slack_notify.HttpClient()
+        insightly_slack_notify.run_account_daemon(
+            client, insightly_slack_notify.default_account(),
+            threading.Event())
+
+        # THEN store should be migrated once, before the worker starts
+        self.assertEqual(migrations, [1])
+        self.assertEqual(migrate_store.call_count, 1)
+
+    def test_sqlite_store_commits_run_at_once(self):
+        # GIVEN run which stored opportunity and failed
+        with self.assertRaises(ValueError):
+            with insightly_slack_notify.SqliteStore(self.path) as store:
+                store.put_opportunity(OPPORTUNITY_TEMPLATE)
+                raise ValueError()
+
+        # THEN nothing should be stored
+        with insightly_slack_notify.SqliteStore(self.path) as store:
+            self.assertIsNone(store.get_opportunity(111))
+
+        # WHEN the next run succeeds
+        with insightly_slack_notify.SqliteStore(self.path) as store:
+            store.put_opportunity(OPPORTUNITY_TEMPLATE)
+
+        # THEN its changes should be stored
+        with insightly_slack_notify.SqliteStore(self.path) as store:
+            self.assertEqual(store.get_opportunity(111),
+                             OPPORTUNITY_TEMPLATE)
+
+
+class OutboxTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'db.sqlite3')
+        patch('insightly_slack_notify.slack_post', Mock()).start()
+        patch('insightly_slack_notify.insightly_get',
+              Mock(side_effect=self.insightly_get)).start()
+        patch.object(config, 'SLACK_RATE_LIMIT', 0, create=True).start()
+        self.client = Mock()
+
+        # GIVEN local db with two known opportunities, op333 was deleted
+        with insightly_slack_notify.SqliteStore(self.path) as store:
+            for opp_id in (111, 333):
+                store.put_opportunity(insightly_slack_notify.make_snapshot(
+                    dict(OPPORTUNITY_TEMPLATE, OPPORTUNITY_ID=opp_id,
+                         OPPORTUNITY_NAME='op%d' % opp_id)))
+            store.set_opportunities_ids({111, 333})
+            store.set_watermark('last_poll', datetime(2016, 3, 29))
+            store.set_watermark('changed_opportunities_last_poll_time',
+                                datetime(2016, 3, 29))
+
+    def tearDown(self):
+        patch.stopall()
+        rmtree(self.tmpdir)
+
+    def insightly_get(self, path, client):
+        if path.startswith('/notes'):
+            return []
+        return [dict(OPPORTUNITY_TEMPLATE, OPPORTUNITY_NAME='op111',
+                     DATE_UPDATED_UTC='2016-03-30 10:00:00', BID_AMOUNT=2)]
+
+    def test_failed_delivery_is_resumed(self):
+        # GIVEN slack which fails
+        insightly_slack_notify.slack_post.side_effect = Exception(
+            'Slack api POST error')
+
+        # WHEN sync_opportunities() is called
+        with self.assertRaises(Exception):
+            with insightly_slack_notify.SqliteStore(self.path) as store:
+                insightly_slack_notify.sync_opportunities(self.client, store)
+
+        # THEN state changes and messages should be committed together
+        with insightly_slack_notify.SqliteStore(self.path) as store:
+            self.assertIsNone(store.get_opportunity(333))
+            self.assertEqual(len(store.get_outbox(10)), 2)
+
+        # WHEN slack recovers and outbox is delivered
+        insightly_slack_notify.slack_post.side_effect = None
+        insightly_slack_notify.slack_post.reset_mock()
+        with insightly_slack_notify.SqliteStore(self.path) as store:
+            sender = insightly_slack_notify.SlackSender('url', self.client)
+            insightly_slack_notify.deliver_outbox(store, sender)
+
+        # THEN pending messages should be sent in order
+        texts = [c[1]['json']['text'] for c in
+                 insightly_slack_notify.slack_post.call_args_list]
+        self.assertEqual(len(texts), 2)
+        self.assertTrue(texts[0].startswith('Opportunity op111 changed'))
+        self.assertTrue(texts[1].startswith('Opportunity deleted: op333'))
+
+        # AND outbox should be empty
+        with insightly_slack_notify.SqliteStore(self.path) as store:
+            self.assertEqual(store.get_outbox(10), [])
+
+    def test_same_event_is_sent_once(self):
+        # GIVEN changed message which was already sent
+        with insightly_slack_notify.SqliteStore(self.path) as store:
+            insightly_slack_notify.sync_opportunities(self.client, store)
+        insightly_slack_notify.slack_post.reset_mock()
+
+        # WHEN the same change is found again
+        with insightly_slack_notify.SqliteStore(self.path) as store:
+            store.put_opportunity(insightly_slack_notify.make_snapshot(
+                dict(OPPORTUNITY_TEMPLATE, OPPORTUNITY_NAME='op111')))
+            insightly_slack_notify.sync_opportunities(self.client, store)
+
+        # THEN it should not be sent again
+        self.assertEqual(insightly_slack_notify.slack_post.call_count, 0)
+
+    def test_messages_are_routed_by_account(self):
+        # GIVEN account routing big deals to the sales channel
+        account = insightly_slack_notify.Account(
+            'main', 'key', 'https://default', routes=[
+                {'MIN_BID_AMOUNT': 2, 'SLACK_CHANNEL_URL': 'https://sales'}])
+
+        # WHEN sync_opportunities() is called for the account
+        with insightly_slack_notify.SqliteStore(self.path) as store:
+            insightly_slack_notify.sync_opportunities(self.client, store,
+                                                      account=account)
+
+        # THEN changed op111 with bid amount 2 should be sent to the sales
+        # channel and deleted op333 to the default one
+        calls = insightly_slack_notify.slack_post.call_args_list
+        self.assertEqual(len(calls), 2)
+        sent = dict((c[0][0], c[1]['json']['text']) for c in calls)
+        self.assertTrue(
+            sent['https://sales'].startswith('Opportunity op111 changed'))
+        self.assertTrue(
+            sent['https://default'].startswith('Opportunity deleted: op333'))
+
+    def test_sync_writes_store_after_fetching(self):
+        # GIVEN insightly api which records whether the store is written
+        # during requests, on the first launch
+        os.remove(self.path)
+        in_transaction = []
+
+        def insightly_get(path, client):
+            in_transaction.append(store.connection.in_transaction)
+            return self.insightly_get(path, client)
+        insightly_slack_notify.insightly_get.side_effect = insightly_get
+
+        # WHEN sync_opportunities() is called
+        with insightly_slack_notify.SqliteStore(self.path) as store:
+            insightly_slack_notify.sync_opportunities(self.client, store,
+                                                      deliver=False)
+
+            # THEN no write transaction should be open during requests
+            self.assertEqual(in_transaction, [False] * len(in_transaction))
+            self.assertTrue(in_transaction)
+
+            # AND changes should be written afterwards
+            self.assertIsNotNone(store.get_opportunity(111))
+            self.assertIsNotNone(store.get_watermark('notes_last_poll'))
+
+    def test_message_is_kept_if_process_dies_while_sending(self):
+        # GIVEN outbox with a message
+        with insightly_slack_notify.SqliteStore(self.path) as store:
+            store.add_outbox('deleted:1', 'first')
+
+        # AND process which dies during slack request
+        insightly_slack_notify.slack_post.side_effect = SystemExit()
+
+        # WHEN outbox is delivered
+        with self.assertRaises(SystemExit):
+            with insightly_slack_notify.SqliteStore(self.path) as store:
+                sender = insightly_slack_notify.SlackSender('url',
+                                                            self.client)
+                insightly_slack_notify.deliver_outbox(store, sender)
+
+        # THEN the message should still be pending for the next run
+        with insightly_slack_notify.SqliteStore(self.path) as store:
+            self.assertEqual(store.get_outbox(10),
+                             [('deleted:1', 'first', None)])
+
+    def test_rejected_messages_do_not_block_outbox(self):
+        # GIVEN outbox with message of the removed route webhook first
+        with insightly_slack_notify.SqliteStore(self.path) as store:
+            store.add_outbox('changed:1', 'first', 'https://removed')
+            store.add_outbox('deleted:2', 'second')
+
+        # AND slack which answers 404 to the removed webhook
+        def slack_post(url, client, **kwargs):
+            if url == 'https://removed':
+                raise insightly_slack_notify.SlackPostError(
+                    'Slack api POST error', Mock(status_code=404))
+        insightly_slack_notify.slack_post.side_effect = slack_post
+
+        # WHEN outbox is delivered
+        with insightly_slack_notify.SqliteStore(self.path) as store:
+            sender = insightly_slack_notify.SlackSender('url', self.client)
+            sent = insightly_slack_notify.deliver_outbox(store, sender)
+
+        # THEN message of the default channel should be sent
+        self.assertEqual(sent, 1)
+        calls = insightly_slack_notify.slack_post.call_args_list
+        self.assertEqual([c[0][0] for c in calls], ['https://removed', 'url'])
+
+        # AND rejected message should be kept with the error, not pending
+        with insightly_slack_notify.SqliteStore(self.path) as store:
+            self.assertEqual(store.get_outbox(10), [])
+            error = store.connection.execute(
+                'SELECT error FROM outbox WHERE key = ?',
+                ('changed:1',)).fetchone()[0]
+            self.assertIn('Slack api POST error', error)
+
+    def test_worker_delivers_outbox(self):
+        # GIVEN sync which only fills the outbox
+        with insightly_slack_notify.SqliteStore(self.path) as store:
+            insightly_slack_notify.sync_opportunities(self.client, store,
+                                                      deliver=False)
+        self.assertEqual(insightly_slack_notify.slack_post.call_count, 0)
+
+        # WHEN delivery worker with its own connection is run
+        worker = insightly_slack_notify.OutboxWorker(
+            lambda: insightly_slack_notify.SqliteStore(self.path),
+            insightly_slack_notify.SlackSender('url', self.client))
+        worker.start()
+        worker.wake()
+        worker.stop()
+
+        # THEN messages should be sent
+        self.assertEqual(insightly_slack_notify.slack_post.call_count, 2)
+
+
+class AccountTestCase(TestCase):
+    def setUp(self):
+        self.account = insightly_slack_notify.Account(
+            'sales', 'key', 'https://default', routes=[
+                {'PIPELINE_ID': [1, 2], 'SLACK_CHANNEL_URL': 'https://a'},
+                {'RESPONSIBLE_USER_ID': 5, 'MIN_BID_AMOUNT': 100,
+                 'SLACK_CHANNEL_URL': 'https://b'}])
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_channels(self):
+        # WHEN opportunity matches conditions of both routes
+        opp = {'PIPELINE_ID': 2, 'RESPONSIBLE_USER_ID': 5, 'BID_AMOUNT': 100}
+
+        # THEN it should be routed to both channels
+        self.assertEqual(self.account.channels(opp),
+                         ['https://a', 'https://b'])
+
+        # WHEN opportunity matches only some conditions of the second route
+        opp = {'PIPELINE_ID': 3, 'RESPONSIBLE_USER_ID': 5, 'BID_AMOUNT': 99}
+
+        # THEN it should be sent to the default channel
+        self.assertEqual(self.account.channels(opp), [None])
+
+    def test_state_file_per_account(self):
+        # GIVEN config with state file
+        patch.object(config, 'STATE_FILE', '/var/lib/db.sqlite3',
+                     create=True).start()
+
+        # THEN default account should use it
+        self.assertEqual(insightly_slack_notify.state_file_path(),
+                         '/var/lib/db.sqlite3')
+
+        # AND named account should use its own file
+        self.assertEqual(insightly_slack_notify.state_file_path(self.account),
+                         '/var/lib/db.sales.sqlite3')
+
+    def test_load_accounts(self):
+        # GIVEN config without ACCOUNTS
+        patch.object(config, 'ACCOUNTS', None, create=True).start()
+        patch.object(config, 'SLACK_ROUTES', self.account.routes,
+                     create=True).start()
+
+        # THEN default account should be configured by top level config
+        account, = insightly_slack_notify.load_accounts()
+        self.assertIsNone(account.name)
+        self.assertEqual(account.api_key, config.INSIGHTLY_API_KEY)
+        self.assertEqual(account.channel_url, config.SLACK_CHANNEL_URL)
+        self.assertEqual(account.routes, self.account.routes)
+
+        # WHEN ACCOUNTS are set
+        config.ACCOUNTS = [
+            {'NAME': 'sales', 'INSIGHTLY_API_KEY': 'key1',
+             'SLACK_CHANNEL_URL': 'https://sales'},
+            {'NAME': 'support', 'INSIGHTLY_API_KEY': 'key2',
+             'SLACK_CHANNEL_URL': 'https://support',
+             'STATE_FILE': 'support.sqlite3'}]
+
+        # THEN they should be loaded in order
+        sales, support = insightly_slack_notify.load_accounts()
+        self.assertEqual((sales.name, sales.api_key, sales.routes),
+                         ('sales', 'key1', []))
+        self.assertEqual(support.state_file, 'support.sqlite3')
+
+    def test_failed_account_does_not_stop_others(self):
+        # GIVEN two accounts, sync of the first one fails
+        patch.object(config, 'ACCOUNTS', [
+            {'NAME': 'a', 'INSIGHTLY_API_KEY': 'key1',
+             'SLACK_CHANNEL_URL': 'https://a'},
+            {'NAME': 'b', 'INSIGHTLY_API_KEY': 'key2',
+             'SLACK_CHANNEL_URL': 'https://b'}], create=True).start()
+        sync_account = patch('insightly_slack_notify.sync_account',
+                             Mock(side_effect=[Exception('error'), None]))
+        sync_account.start()
+        patch('insightly_slack_notify.export_metrics').start()
+
+        # WHEN run_once() is called
+        with self.assertRaises(Exception) as error:
+            insightly_slack_notify.run_once()
+
+        # THEN both accounts should be synced and the failed one reported
+        self.assertEqual(
+            [c[0][1].name for c in
+             insightly_slack_notify.sync_account.call_args_list],
+            ['a', 'b'])
+        self.assertIn('accounts failed: a', str(error.exception))
+
+
+def fake_account_worker(name, sync, results):
+    """
+    Worker process target of RunParallelTestCase.
+    """
+    if name == 'hung':
+        time.sleep(60)
+    elif name == 'crashed':
+        os._exit(3)
+    results.put({'account': name, 'time': 0.5, 'api_calls': 2, 'error': None,
+                 'metrics': ({('parallel_test_total', ()): 1.0}, {})})
+
+
+class RunParallelTestCase(TestCase):
+    def setUp(self):
+        self.metrics = insightly_slack_notify.Metrics()
+        patch('insightly_slack_notify.metrics', self.metrics).start()
+        self.addCleanup(patch.stopall)
+
+    def test_failed_workers_do_not_block_others(self):
+        # GIVEN accounts whose workers hang, crash and succeed
+        accounts = [insightly_slack_notify.Account(name) for name in
+                    ('hung', 'crashed', 'first', 'second')]
+
+        # WHEN they are synced by two workers with timeout
+        started = time.time()
+        results = insightly_slack_notify.run_parallel(
+            accounts, workers=2, timeout=1, target=fake_account_worker)
+
+        # THEN hung worker should be terminated after the timeout
+        self.assertLess(time.time() - started, 10)
+        self.assertEqual([result['account'] for result in results],
+                         ['hung', 'crashed', 'first', 'second'])
+        self.assertIn('terminated after 1 seconds', results[0]['error'])
+
+        # AND crashed worker should be reported
+        self.assertIn('exited with code 3', results[1]['error'])
+
+        # AND other accounts should be synced with metrics merged
+        self.assertEqual([(result['api_calls'], result['error'])
+                          for result in results[2:]], [(2, None), (2, None)])
+        self.assertEqual(self.metrics.counters[('parallel_test_total', ())],
+                         2)
+
+
+class ApiBudgetTestCase(TestCase):
+    def setUp(self):
+        self.now = [86400 * 10]
+        self.budget = insightly_slack_notify.ApiBudget(
+            daily_limit=100, reserve=0.2, clock=lambda: self.now[0])
+
+    def test_calls_are_counted_per_endpoint(self):
+        # WHEN insightly api is called
+        url = insightly_slack_notify.INSIGHTLY_URL
+        for path in ('/users/1', '/users/2', '/opportunities?ids=1,2',
+                     '/opportunities?$top=500&$skip=0'):
+            self.budget.record(url + path, Mock(headers={}))
+
+        # THEN calls should be counted per endpoint template
+        self.assertEqual(dict(self.budget.calls),
+                         {'/users/{id}': 2, '/opportunities': 2})
+        self.assertEqual(self.budget.remaining(), 96)
+
+    def test_rate_limit_headers_are_preferred(self):
+        # WHEN api reports its limit and remaining calls
+        self.budget.record('url', Mock(headers={
+            'X-RateLimit-Limit': '1000', 'X-RateLimit-Remaining': '150'}))
+
+        # THEN they should be used
+        self.assertEqual(self.budget.limit(), 1000)
+        self.assertEqual(self.budget.remaining(), 150)
+        self.assertTrue(self.budget.low())
+
+    def test_remaining_header_without_limit_is_ignored(self):
+        # GIVEN budget without configured limit
+        budget = insightly_slack_notify.ApiBudget()
+
+        # WHEN api reports remaining calls, but not its limit
+        budget.record('url', Mock(headers={'X-RateLimit-Remaining': '50'}))
+
+        # THEN budget should be unknown, not low
+        self.assertIsNone(budget.remaining())
+        self.assertFalse(budget.low())
+        self.assertIsNone(budget.poll_interval(10))
+        budget.log_stats()
+
+    def test_budget_is_shared_by_runs_for_a_day(self):
+        # GIVEN run which made 85 calls
+        store = insightly_slack_notify.SqliteStore(':memory:')
+        for _ in range(85):
+            self.budget.record('url', Mock(headers={}))
+        self.budget.save(store)
+
+        # WHEN the next run starts an hour later
+        self.now[0] += 3600
+        budget = insightly_slack_notify.ApiBudget(
+            daily_limit=100, reserve=0.2, clock=lambda: self.now[0])
+        budget.load(store)
+
+        # THEN budget should be low
+        self.assertEqual(budget.remaining(), 15)
+        self.assertTrue(budget.low())
+
+        # WHEN the next run starts a day later
+        self.now[0] += 86400
+        budget.load(store)
+
+        # THEN whole budget should be available
+        self.assertEqual(budget.remaining(), 100)
+        self.assertFalse(budget.low())
+
+    def test_stale_reference_is_served_on_low_budget(self):
+        # GIVEN expired cached user and low budget
+        store = insightly_slack_notify.SqliteStore(':memory:')
+        store.set_reference_cache([('/users/1', (0, {'USER_ID': 1}))])
+        self.budget.header_remaining = 0
+        cache = insightly_slack_notify.ReferenceCache(store, ttl=60,
+                                                      budget=self.budget)
+
+        # WHEN the user is requested
+        with patch('insightly_slack_notify.insightly_get', Mock()) as get:
+            user = cache.get('/users/1', Mock())
+
+        # THEN cached user should be returned without api call
+        self.assertEqual(user, {'USER_ID': 1})
+        self.assertEqual(get.call_count, 0)
+
+
+class DaemonTestCase(TestCase):
+    def setUp(self):
+        self.now = [0]
+        self.store = insightly_slack_notify.SqliteStore(':memory:')
+        self.budget = insightly_slack_notify.ApiBudget()
+        self.daemon = insightly_slack_notify.Daemon(
+            Mock(), self.store, self.budget, poll_interval=0,
+            reconcile_interval=250, clock=lambda: self.now[0])
+        # Signal handler installed by daemon_main().
+        self.stop = insightly_slack_notify.stop_handler(self.daemon.stopping)
+        patch('insightly_slack_notify.prefetch_reference_data',
+              Mock(return_value={})).start()
+        self.addCleanup(patch.stopall)
+
+    def test_reconcile_is_scheduled_separately(self):
+        # GIVEN sync which takes 100 seconds, daemon is stopped after four
+        # cycles
+        reconciles = []
+
+        def sync(client, store, **kwargs):
+            reconciles.append(kwargs['reconcile'])
+            self.now[0] += 100
+            if len(reconciles) == 4:
+                self.stop(signal.SIGTERM, None)
+
+        patch('insightly_slack_notify.sync_opportunities',
+              Mock(side_effect=sync)).start()
+
+        # WHEN daemon is run
+        self.daemon.run()
+
+        # THEN deleted opportunities should be searched on the first cycle
+        # and after reconcile interval
+        self.assertEqual(reconciles, [True, False, False, True])
+
+        # AND reference data should be prefetched with full listing only
+        self.assertEqual(
+            insightly_slack_notify.prefetch_reference_data.call_count, 2)
+
+    def test_failed_cycle_is_rolled_back(self):
+        # GIVEN sync which stores opportunity and fails on the first cycle
+        def sync(client, store, **kwargs):
+            store.put_opportunity(OPPORTUNITY_TEMPLATE)
+            if sync.calls == 0:
+                sync.calls += 1
+                raise Exception('Insightly api GET error')
+            self.stop(signal.SIGTERM, None)
+        sync.calls = 0
+
+        patch('insightly_slack_notify.sync_opportunities',
+              Mock(side_effect=sync)).start()
+
+        # WHEN daemon is run
+        self.daemon.run()
+
+        # THEN it should keep running and commit the next cycle
+        self.assertEqual(
+            insightly_slack_notify.sync_opportunities.call_count, 2)
+        self.store.rollback()
+        self.assertIsNotNone(self.store.get_opportunity(111))
+
+
+class SnapshotTestCase(TestCase):
+    def setUp(self):
+        # GIVEN local database with snapshot of one opportunity
+        self.store = insightly_slack_notify.SqliteStore(':memory:')
+        self.store.put_opportunity(
+            insightly_slack_notify.make_snapshot(OPPORTUNITY_TEMPLATE))
+        self.store.set_opportunities_ids({111})
+        self.store.set_watermark('last_poll', datetime(2016, 3, 29))
+
+        patch('insightly_slack_notify.slack_post', Mock()).start()
+        self.client = Mock()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_snapshot_is_compact(self):
+        snapshot = self.store.get_opportunity(111)
+
+        # THEN only tracked fields and digest should be stored
+        self.assertEqual(
+            set(snapshot),
+            set(insightly_slack_notify.SNAPSHOT_FIELDS) | {'DIGEST'})
+
+        # AND digest should not depend on fields order
+        self.assertEqual(snapshot['DIGEST'],
+                         insightly_slack_notify.opportunity_digest(
+                             dict(reversed(OPPORTUNITY_TEMPLATE.items()))))
+
+    def test_untracked_field_changed(self):
+        # WHEN only IMAGE_URL changed
+        opportunity = dict(OPPORTUNITY_TEMPLATE, IMAGE_URL='http://new/',
+                           DATE_UPDATED_UTC='2016-03-30 10:00:00')
+        patch('insightly_slack_notify.insightly_get',
+              Mock(side_effect=FakeInsightly([opportunity]))).start()
+
+        # AND sync_opportunities() is called
+        insightly_slack_notify.sync_opportunities(self.client, self.store)
+
+        # THEN no slack message should be sent
+        self.assertEqual(insightly_slack_notify.slack_post.call_count, 0)
+
+        # AND local digest should get updated
+        self.assertEqual(self.store.get_opportunity(111)['DIGEST'],
+                         insightly_slack_notify.opportunity_digest(
+                             opportunity))
+
+    def test_is_changed(self):
+        snapshot = self.store.get_opportunity(111)
+
+        # THEN the same record should not be changed
+        self.assertFalse(insightly_slack_notify.is_changed(
+            dict(OPPORTUNITY_TEMPLATE), snapshot, None))
+
+        # AND record with new notes should be changed
+        self.assertTrue(insightly_slack_notify.is_changed(
+            dict(OPPORTUNITY_TEMPLATE), snapshot, [NOTE_TEMPLATE]))
+
+        # AND record with different field should be changed
+        self.assertTrue(insightly_slack_notify.is_changed(
+            dict(OPPORTUNITY_TEMPLATE, TAGS=['tag']), snapshot, None))
+
+
+class MapConcurrentlyTestCase(TestCase):
+    def test_order_is_kept(self):
+        # GIVEN function which returns later for smaller items
+        def func(item):
+            time.sleep(0.01 * (5 - item))
+            return item * 10
+
+        # WHEN it is called for items concurrently
+        results = insightly_slack_notify.map_concurrently(func, range(5),
+                                                          concurrency=5)
+
+        # THEN results should be in the order of items
+        self.assertEqual(results, [0, 10, 20, 30, 40])
+
+    def test_concurrency_is_bounded(self):
+        # GIVEN function which tracks number of concurrent calls
+        lock = threading.Lock()
+        state = {'running': 0, 'max': 0}
+
+        def func(item):
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+
+        # WHEN it is called for ten items with concurrency limit 3
+        insightly_slack_notify.map_concurrently(func, range(10),
+                                                concurrency=3)
+
+        # THEN no more than three calls should run at once
+        self.assertLessEqual(state['max'], 3)
+
+    def test_changed_opportunities_are_sent_in_order(self):
+        # GIVEN local db with ten opportunities
+        store = insightly_slack_notify.SqliteStore(':memory:')
+        for opp_id in range(10):
+            store.put_opportunity(insightly_slack_notify.make_snapshot(
+                dict(OPPORTUNITY_TEMPLATE, OPPORTUNITY_ID=opp_id,
+                     OPPORTUNITY_NAME='op%d' % opp_id)))
+        store.set_opportunities_ids(set(range(10)))
+        store.set_watermark('last_poll', datetime(2016, 3, 29))
+
+        # AND remote end where stages of all opportunities changed
+        insightly = FakeInsightly(
+            dict(OPPORTUNITY_TEMPLATE, OPPORTUNITY_ID=opp_id,
+                 OPPORTUNITY_NAME='op%d' % opp_id, STAGE_ID=opp_id,
+                 DATE_UPDATED_UTC='2016-03-30 10:00:00')
+            for opp_id in range(10))
+
+        def insightly_get(path, client):
+            if path.startswith('/PipelineStages'):
+                time.sleep(0.001)
+                return {'STAGE_NAME': path}
+            if path.startswith('/Pipelines'):
+                return {'PIPELINE_NAME': path}
+            return insightly(path, client)
+
+        patch('insightly_slack_notify.insightly_get',
+              Mock(side_effect=insightly_get)).start()
+        patch('insightly_slack_notify.slack_post', Mock()).start()
+        patch.object(config, 'SLACK_RATE_LIMIT', 0, create=True).start()
+        self.addCleanup(patch.stopall)
+
+        # WHEN sync_opportunities() is called
+        insightly_slack_notify.sync_opportunities(Mock(), store)
+
+        # THEN messages should be sent in order of opportunities
+        texts = [c[1]['json']['text'] for c in
+                 insightly_slack_notify.slack_post.call_args_list]
+        self.assertEqual([text.split()[1] for text in texts],
+                         ['op%d' % opp_id for opp_id in range(10)])
+
+
+class SlackSenderTestCase(TestCase):
+    def setUp(self):
+        patch('insightly_slack_notify.slack_post', Mock()).start()
+        self.addCleanup(patch.stopall)
+        self.sender = insightly_slack_notify.SlackSender(
+            'url', 'client', max_size=20)
+
+    def payloads(self):
+        return [c[1]['json'] for c in
+                insightly_slack_notify.slack_post.call_args_list]
+
+    def test_burst_is_sent_as_digests(self):
+        # WHEN 45 messages are sent at once
+        for i in range(45):
+            self.sender.send('message %d' % i)
+        self.sender.flush()
+
+        # THEN they should be sent with three requests of 20, 20 and 5
+        # section blocks in original order
+        payloads = self.payloads()
+        self.assertEqual([len(p['blocks']) for p in payloads], [20, 20, 5])
+        texts = [block['text']['text'] for p in payloads
+                 for block in p['blocks']]
+        self.assertEqual(texts, ['message %d' % i for i in range(45)])
+        self.assertEqual(payloads[0]['text'],
+                         '20 insightly opportunities updates')
+
+    def test_single_message_is_sent_as_text(self):
+        # WHEN single message is sent
+        self.sender.send('message')
+        self.sender.flush()
+
+        # THEN it should be sent as plain text
         insightly_slack_notify.slack_post.assert_called_once_with(
-            config.SLACK_CHANNEL_URL, json={'text': dedent(expected_message)})
+            'url', 'client', json={'text': 'message'})
+
+    def test_slack_limits_are_kept(self):
+        # WHEN messages longer than section block limit are sent
+        message = 'x' * (insightly_slack_notify.SLACK_SECTION_TEXT_LIMIT * 3)
+        for _ in range(20):
+            self.sender.send(message)
+        self.sender.flush()
+
+        # THEN every digest should fit into slack limits
+        for payload in self.payloads():
+            blocks = payload.get('blocks', [])
+            self.assertLessEqual(len(blocks),
+                                 insightly_slack_notify.SLACK_BLOCKS_LIMIT)
+            self.assertLessEqual(
+                sum(len(block['text']['text']) for block in blocks),
+                insightly_slack_notify.SLACK_TEXT_LIMIT)
+            for block in blocks:
+                self.assertLessEqual(
+                    len(block['text']['text']),
+                    insightly_slack_notify.SLACK_SECTION_TEXT_LIMIT)
+
+        # AND no text should be lost
+        texts = [''.join(block['text']['text'] for block in p['blocks'])
+                 for p in self.payloads()]
+        self.assertEqual(''.join(texts), message * 20)
+
+
+class SlackRetryTestCase(TestCase):
+    def setUp(self):
+        patch('insightly_slack_notify.slack_post', Mock()).start()
+        self.addCleanup(patch.stopall)
+        self.sleep = Mock()
+        self.sender = insightly_slack_notify.SlackSender(
+            'url', 'client', max_retries=2, sleep=self.sleep)
+
+    def error(self, status, headers=None):
+        response = Mock(status_code=status, headers=headers or {})
+        return insightly_slack_notify.SlackPostError('error', response)
+
+    def test_retry_after_is_honored(self):
+        # GIVEN slack which rate limits first request
+        insightly_slack_notify.slack_post.side_effect = [
+            self.error(429, {'Retry-After': '7'}), Mock()]
+
+        # WHEN message is sent
+        self.sender.send('message')
+
+        # THEN it should be sent again after Retry-After seconds
+        self.sleep.assert_called_once_with(7.0)
+        self.assertEqual(insightly_slack_notify.slack_post.call_count, 2)
+        self.assertEqual((self.sender.throttled, self.sender.retried), (1, 0))
+
+    def test_server_error_is_retried_with_backoff(self):
+        # GIVEN slack which fails two requests with server error
+        insightly_slack_notify.slack_post.side_effect = [
+            self.error(503), self.error(500), Mock()]
+
+        # WHEN message is sent
+        with patch('random.uniform', Mock(side_effect=lambda a, b: b)):
+            self.sender.send('message')
+
+        # THEN it should be retried with growing delays
+        self.assertEqual(self.sleep.call_args_list, [call(2), call(4)])
+        self.assertEqual((self.sender.throttled, self.sender.retried), (0, 2))
+
+    def test_error_is_raised_when_retries_run_out(self):
+        # GIVEN slack which always fails with server error
+        insightly_slack_notify.slack_post.side_effect = self.error(502)
+
+        # WHEN message is sent
+        # THEN error should be raised after max_retries retries
+        with self.assertRaises(insightly_slack_notify.SlackPostError):
+            self.sender.send('message')
+        self.assertEqual(insightly_slack_notify.slack_post.call_count, 3)
+
+    def test_client_error_is_not_retried(self):
+        # GIVEN slack which rejects request
+        insightly_slack_notify.slack_post.side_effect = self.error(400)
+
+        # WHEN message is sent
+        # THEN error should be raised at once
+        with self.assertRaises(insightly_slack_notify.SlackPostError):
+            self.sender.send('message')
+        self.assertEqual(insightly_slack_notify.slack_post.call_count, 1)
+        self.assertEqual(self.sleep.call_count, 0)
+
+    def test_token_bucket_paces_requests(self):
+        # GIVEN bucket with one token per second and burst of two
+        now = [0]
+        sleep = Mock(side_effect=lambda delay: now.__setitem__(
+            0, now[0] + delay))
+        bucket = insightly_slack_notify.TokenBucket(
+            1, 2, clock=lambda: now[0], sleep=sleep)
+
+        # WHEN five tokens are taken at once
+        waits = [bucket.acquire() for _ in range(5)]
+
+        # THEN burst should pass and the rest should wait a second each
+        self.assertEqual(waits, [0, 0, 1, 1, 1])
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.metrics = insightly_slack_notify.Metrics()
+        patch('insightly_slack_notify.metrics', self.metrics).start()
+        self.addCleanup(patch.stopall)
+
+    def test_endpoint_templates(self):
+        url = insightly_slack_notify.INSIGHTLY_URL
+        endpoint = insightly_slack_notify.metrics_endpoint
+
+        self.assertEqual(endpoint(url + '/users/123'), '/users/{id}')
+        self.assertEqual(
+            endpoint(url + "/opportunities?$filter=DATE_UPDATED_UTC%20gt%20"
+                     "DateTime'2016-03-29'&$top=500&$skip=0"),
+            '/opportunities?$filter,$skip,$top')
+        self.assertEqual(
+            endpoint('https://hooks.slack.com/services/a/b/c'), 'webhook')
+
+    def test_render(self):
+        # WHEN request latency and count are recorded
+        self.metrics.observe('http_request_duration_seconds', 0.3,
+                             {'endpoint': '/users/{id}'})
+        self.metrics.inc('http_responses_total',
+                         {'endpoint': '/users/{id}', 'status': '200'})
+
+        # THEN they should be rendered in Prometheus text format
+        text = self.metrics.render()
+        self.assertIn('# TYPE insightly_slack_http_responses_total counter\n'
+                      'insightly_slack_http_responses_total'
+                      '{endpoint="/users/{id}",status="200"} 1.0\n', text)
+        self.assertIn('insightly_slack_http_request_duration_seconds_bucket'
+                      '{endpoint="/users/{id}",le="0.25"} 0\n', text)
+        self.assertIn('insightly_slack_http_request_duration_seconds_bucket'
+                      '{endpoint="/users/{id}",le="0.5"} 1\n', text)
+        self.assertIn('insightly_slack_http_request_duration_seconds_count'
+                      '{endpoint="/users/{id}"} 1\n', text)
+
+    def test_phase_is_timed(self):
+        # WHEN decorated function is called
+        @self.metrics.timed('sync')
+        def sync():
+            return 1
+
+        # THEN its result should be returned and its time observed
+        self.assertEqual(sync(), 1)
+        self.assertIn('insightly_slack_phase_duration_seconds_count'
+                      '{phase="sync"} 1\n', self.metrics.render())
+
+    def test_merge(self):
+        # GIVEN metrics of other process
+        other = insightly_slack_notify.Metrics()
+        other.inc('opportunities_total', {'kind': 'new'}, 2)
+        other.observe('phase_duration_seconds', 0.3, {'phase': 'sync'})
+        self.metrics.observe('phase_duration_seconds', 3, {'phase': 'sync'})
+
+        # WHEN they are merged
+        self.metrics.merge(other.snapshot())
+
+        # THEN counters and histograms should be added up
+        text = self.metrics.render()
+        self.assertIn('insightly_slack_opportunities_total{kind="new"} 2.0\n',
+                      text)
+        self.assertIn('insightly_slack_phase_duration_seconds_bucket'
+                      '{phase="sync",le="0.5"} 1\n', text)
+        self.assertIn('insightly_slack_phase_duration_seconds_count'
+                      '{phase="sync"} 2\n', text)
+
+    def test_requests_are_recorded_and_served(self):
+        # GIVEN local server and metrics endpoint
+        server = StubServer({'/users/1': {'USER_ID': 1}})
+        self.addCleanup(server.stop)
+        metrics_server = insightly_slack_notify.start_metrics_server(
+            0, '127.0.0.1')
+        self.addCleanup(metrics_server.server_close)
+        self.addCleanup(metrics_server.shutdown)
+
+        # WHEN request is sent
+        client = insightly_slack_notify.HttpClient()
+        self.addCleanup(client.close)
+        client.get(server.url + '/users/1')
+
+        # THEN its status and size should be served on /metrics
+        text = client.get('http://127.0.0.1:{}/metrics'.format(
+            metrics_server.server_port)).text
+        self.assertIn('insightly_slack_http_received_bytes_total'
+                      '{endpoint="webhook",method="GET"} 14.0', text)
+        self.assertIn('insightly_slack_http_responses_total'
+                      '{endpoint="webhook",method="GET",status="200"}', text)
+
+
+class ProfileRunTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.addCleanup(rmtree, self.tmpdir)
 
-        # AND deleted opportunity should be deleted drom local db
-        self.assertFalse('opportunity_222' in self.local_db)
-        self.assertFalse(222 in self.local_db['opportunities_ids'])
+    def test_reports_are_written(self):
+        # GIVEN run with nested phases
+        metrics = insightly_slack_notify.metrics
+
+        def run():
+            with metrics.phase('sync'):
+                with metrics.phase('render'):
+                    data = [str(i) * 100 for i in range(1000)]
+            return len(data)
+
+        # WHEN it is profiled
+        result = insightly_slack_notify.profile_run(run, self.tmpdir)
+
+        # THEN its result should be returned
+        self.assertEqual(result, 1000)
+
+        # AND cProfile and phase reports should be written
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['phases.txt', 'run.prof', 'run.txt'])
+        with open(os.path.join(self.tmpdir, 'phases.txt')) as report:
+            lines = report.read().splitlines()
+        phases = [line.split(':')[0] for line in lines
+                  if not line.startswith(' ')]
+        self.assertEqual(phases, ['render', 'sync'])
+        self.assertIn('peak memory', lines[0])
+
+        # AND profiler should be removed from metrics
+        self.assertEqual(metrics.listeners, [])
+
+
+class InitConfigTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.addCleanup(rmtree, self.tmpdir)
+        cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        self.addCleanup(os.chdir, cwd)
+        patch.object(config, 'LOG_FILE',
+                     os.path.join(self.tmpdir, 'logs', 'notify.log'),
+                     create=True).start()
+        self.addCleanup(patch.stopall)
+
+        with open('insightly_slack_notify_config.py.example', 'w') as f:
+            f.write('LOG_LEVEL = "INFO"\n')
+
+    def test_config_is_created(self):
+        # GIVEN writable log directory
+        os.mkdir(os.path.join(self.tmpdir, 'logs'))
+
+        # WHEN init is run
+        insightly_slack_notify.init_config()
+
+        # THEN default config should be copied from the example
+        with open('insightly_slack_notify_config.py') as f:
+            self.assertEqual(f.read(), 'LOG_LEVEL = "INFO"\n')
+
+        # AND permissions test file should be removed
+        self.assertEqual(
+            os.listdir(os.path.join(self.tmpdir, 'logs')), [])
+
+    def test_missing_log_directory(self):
+        # GIVEN log directory which does not exist
+        # WHEN init is run
+        # THEN it should fail
+        with self.assertRaises(Exception) as context:
+            insightly_slack_notify.init_config()
+        self.assertIn('logs/" directory failed', str(context.exception))
+
+    def test_configure_without_init(self):
+        # GIVEN log directory which does not exist
+        # WHEN configure is run
+        # THEN it should fail and suggest init
+        with self.assertRaises(Exception) as context:
+            insightly_slack_notify.configure()
+        self.assertIn('insightly_slack_notify.py init',
+                      str(context.exception))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubServer(object):
+    """
+    Local http server answering insightly api and slack webhook requests.
+    """
+
+    def __init__(self, responses):
+        # Mapping of request path to json response.
+        self.responses = responses
+        self.posted = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                path = unquote(self.path)
+                if path not in stub.responses:
+                    self.reply(404, b'{}')
+                else:
+                    self.reply(200, json.dumps(stub.responses[path])
+                               .encode('utf-8'))
+
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                stub.posted.append(json.loads(
+                    self.rfile.read(length).decode('utf-8'))['text'])
+                self.reply(200, b'ok')
+
+            def reply(self, status, body):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@skipIf(sys.version_info < (3, 6), 'asyncio pipeline requires python 3.6')
+class AsyncPipelineTestCase(TestCase):
+    def setUp(self):
+        # GIVEN local db with op111 and op333 polled at 2016-03-29
+        last_poll = datetime(2016, 3, 29)
+        self.store = insightly_slack_notify.SqliteStore(':memory:')
+        self.store.put_opportunity(
+            insightly_slack_notify.make_snapshot(OPPORTUNITY_TEMPLATE))
+        self.store.put_opportunity(insightly_slack_notify.make_snapshot(
+            dict(OPPORTUNITY_TEMPLATE, OPPORTUNITY_ID=333,
+                 OPPORTUNITY_NAME='op333')))
+        self.store.set_opportunities_ids({111, 333})
+        self.store.set_watermark('last_poll', last_poll)
+        self.store.set_watermark('changed_opportunities_last_poll_time',
+                                 last_poll)
+
+    def test_new_changed_and_deleted(self):
+        import insightly_slack_notify_async
+
+        # GIVEN stub insightly api where op111 stage changed, op222 was
+        # created and op333 was deleted
+        changed = dict(OPPORTUNITY_TEMPLATE, STAGE_ID=222,
+                       DATE_UPDATED_UTC='2016-03-30 10:00:00')
+        new = dict(OPPORTUNITY_TEMPLATE, OPPORTUNITY_ID=222,
+                   OPPORTUNITY_NAME='op222', RESPONSIBLE_USER_ID=1,
+                   DATE_CREATED_UTC='2016-03-30 11:00:00',
+                   DATE_UPDATED_UTC='2016-03-30 11:00:00')
+        # Notes are fetched since last poll minus overlap window.
+        notes_path = ("/v2.1/notes?$filter=DATE_CREATED_UTC gt "
+                      "DateTime'2016-03-28T23:55:00'&$orderby=NOTE_ID"
+                      "&$top=500&$skip=0")
+        listing_path = ('/v2.1/opportunities?$select=OPPORTUNITY_ID,'
+                        'DATE_CREATED_UTC,DATE_UPDATED_UTC'
+                        '&$orderby=OPPORTUNITY_ID&$top=10&$skip=0')
+        server = StubServer({
+            notes_path: [],
+            listing_path: [
+                {'OPPORTUNITY_ID': x['OPPORTUNITY_ID'],
+                 'DATE_CREATED_UTC': x['DATE_CREATED_UTC'],
+                 'DATE_UPDATED_UTC': x['DATE_UPDATED_UTC']}
+                for x in (changed, new)],
+            '/v2.1/opportunities?ids=111,222': [changed, new],
+            # Deleted op333 is checked again by id.
+            '/v2.1/opportunities?ids=333': [],
+            '/v2.1/users/1': {'FIRST_NAME': 'First', 'LAST_NAME': 'Last',
+                              'EMAIL_ADDRESS': 'email@test.com'},
+            '/v2.1/OpportunityCategories/111': {'CATEGORY_NAME': 'Cat'},
+            '/v2.1/PipelineStages/111': {'STAGE_NAME': 'Old stage'},
+            '/v2.1/PipelineStages/222': {'STAGE_NAME': 'New stage'},
+        })
+        self.addCleanup(server.stop)
+        patch('insightly_slack_notify.INSIGHTLY_URL',
+              server.url + '/v2.1').start()
+        patch.object(config, 'SLACK_CHANNEL_URL', server.url + '/slack',
+                     create=True).start()
+        self.addCleanup(patch.stopall)
+
+        # WHEN pipeline is run
+        client = insightly_slack_notify.HttpClient()
+        self.addCleanup(client.close)
+        insightly_slack_notify_async.run_pipeline(client, self.store,
+                                                  page_size=10)
+
+        # THEN new, changed and deleted messages should be sent in order,
+        # same as sync_opportunities() does
+        self.assertEqual(len(server.posted), 3)
+        self.assertIn('Category: Cat\n'
+                      'Responsible user: First Last email@test.com',
+                      server.posted[0])
+        self.assertIn('Stage changed from Old stage to New stage',
+                      server.posted[1])
+        self.assertEqual(server.posted[2], 'Opportunity deleted: op333\n'
+                                           'Description: dddddd')
+
+        # AND local db should be updated
+        self.assertEqual(self.store.get_opportunity(111)['STAGE_ID'], 222)
+        self.assertIsNone(self.store.get_opportunity(333))
+        self.assertEqual(self.store.get_opportunities_ids(), {111, 222})
+
+    def test_messages_are_sent_while_listing_is_fetched(self):
+        import insightly_slack_notify_async
+
+        # GIVEN remote end where op222 was created, listed before op333
+        new = dict(OPPORTUNITY_TEMPLATE, OPPORTUNITY_ID=222,
+                   OPPORTUNITY_NAME='op222', CATEGORY_ID=None,
+                   DATE_CREATED_UTC='2016-03-30 11:00:00',
+                   DATE_UPDATED_UTC='2016-03-30 11:00:00')
+        insightly = FakeInsightly([
+            OPPORTUNITY_TEMPLATE, new,
+            dict(OPPORTUNITY_TEMPLATE, OPPORTUNITY_ID=333,
+                 OPPORTUNITY_NAME='op333')])
+
+        # AND slack which records sent messages
+        posted = threading.Event()
+        patch('insightly_slack_notify.slack_post',
+              Mock(side_effect=lambda *args, **kwargs: posted.set())).start()
+
+        # AND api which answers the last listing page after a message is
+        # sent, or in 5 seconds
+        sent_before_last_page = []
+
+        def insightly_get(path, client):
+            if '$skip=2' in path:
+                sent_before_last_page.append(posted.wait(5))
+            return insightly(path, client)
+
+        patch('insightly_slack_notify.insightly_get',
+              Mock(side_effect=insightly_get)).start()
+        self.addCleanup(patch.stopall)
+
+        # WHEN pipeline fetches the listing page by page
+        insightly_slack_notify_async.run_pipeline(
+            Mock(response_cache=None), self.store, page_size=1,
+            chunk_size=1)
+
+        # THEN new message should be sent before the listing is done
+        self.assertEqual(sent_before_last_page, [True])
+        self.assertEqual(insightly_slack_notify.slack_post.call_count, 1)
+        self.assertEqual(self.store.get_outbox(10), [])